@@ -2,8 +2,10 @@
 
 import logging
 import asyncio
+import contextlib
 import csv
 import os
+import time
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, FSInputFile
@@ -11,7 +13,9 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.client.default import DefaultBotProperties
 from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError
 from news_parser import *
-from news_analyzer import analyze_all_news
+from news_analyzer import analyze_all_news, analyze_news_stream
+from embedding_index import EMBEDDING_WINDOW_DAYS, find_similar_news, get_encoder
+from tfidf_model import refresh_model_periodically
 from datetime import datetime, timedelta
 import locale
 import html
@@ -41,6 +45,12 @@ dp = Dispatcher()
 MAX_CONCURRENT_TASKS = 100
 semaphore = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
 
+# Пояснение к пустому результату, если запрос не уложился в дедлайн
+PARTIAL_RESULTS_HINT = "\n⏳ Часть источников ещё обрабатывается в фоне, повторите запрос через несколько минут."
+
+# Новостей на странице при просмотре
+NEWS_PER_PAGE = 5
+
 # Хранилище данных пользователей
 user_data = {}
 
@@ -118,6 +128,29 @@ async def start_command(message: types.Message):
         disable_web_page_preview=True
     )
 
+# Число новостей в ответе на поиск по сущности
+ENTITY_SEARCH_LIMIT = 10
+
+async def entity_command(message: types.Message):
+    """/entity <сущность> — последние проанализированные новости, упоминающие сущность (индекс news_entities)"""
+    entity = (message.text or "").partition(" ")[2].strip()
+    logging.info(f"Команда /entity от {message.chat.id}: {entity}")
+    if not entity:
+        await message.answer("Укажите сущность после команды, например: /entity ЦБ")
+        return
+    found = await find_news_by_entity(entity, limit=ENTITY_SEARCH_LIMIT)
+    if not found:
+        await message.answer(f"Новостей с упоминанием «{sanitize_text(entity)}» не найдено.")
+        return
+    text = f"<b>Новости с упоминанием «{sanitize_text(entity)}»:</b>\n"
+    for number, item in enumerate(found, start=1):
+        text += (
+            f"<b>{number}.</b> {sanitize_text(item['bank'])}: {sanitize_text((item['summary'] or '')[:300])}\n"
+            f"Дата события: {sanitize_text(item['event_date'] or 'Неизвестно')}\n"
+            f"Ссылка: {sanitize_text(item['link'] or 'Неизвестно')}\n"
+        )
+    await message.answer(text, disable_web_page_preview=True)
+
 async def generate_calendar(year, month):
     keyboard = InlineKeyboardBuilder()
     first_day = datetime(year, month, 1)
@@ -157,6 +190,117 @@ async def update_status_message(message: types.Message, statuses: list, bot: Bot
             logging.warning(f"Ошибка при обновлении статуса: {e}")
             break
 
+def group_news_by_sentiment(news_list):
+    """Сортировка новостей: негативные, нейтральные, позитивные, внутри группы — по дате (новые первыми)"""
+    sentiment_groups = {
+        "Негативная": [],
+        "Нейтральная": [],
+        "Позитивная": []
+    }
+    for item in news_list:
+        sentiment = item.get("sentiment", "Нейтральная")
+        if sentiment in sentiment_groups:
+            sentiment_groups[sentiment].append(item)
+        else:
+            sentiment_groups["Нейтральная"].append(item)
+    for sentiment in sentiment_groups:
+        sentiment_groups[sentiment].sort(
+            key=lambda x: datetime.strptime(x["date"], "%Y-%m-%d") if x["date"] else datetime.now(),
+            reverse=True
+        )
+    sorted_news = (
+        sentiment_groups["Негативная"] +
+        sentiment_groups["Нейтральная"] +
+        sentiment_groups["Позитивная"]
+    )
+    sentiment_counts = {sentiment: len(items) for sentiment, items in sentiment_groups.items()}
+    return sorted_news, sentiment_counts
+
+class LiveStatusRenderer:
+    """
+    Живой статус запроса вместо ротации фиксированных фраз: счётчики найденных,
+    проанализированных и отобранных по тональности новостей по событиям
+    analyze_news_stream. Как только набирается первая страница, по кнопке можно открыть
+    снимок уже отобранных новостей отдельным сообщением до окончания анализа.
+    """
+
+    REFRESH_INTERVAL = 2.0
+
+    def __init__(self, status_message: types.Message, chat_id: int, categories: list, date_from: str, date_to: str, topic: str = None):
+        self.status_message = status_message
+        self.chat_id = chat_id
+        self.categories = categories
+        self.date_from = date_from
+        self.date_to = date_to
+        self.topic = topic
+        self.status_task = None
+        self.stage = "Собираю и анализирую новости"
+        self.found = 0
+        self.total = 0
+        self.done = 0
+        self.kept = []
+        self._last_refresh = 0.0
+        self._last_text = None
+
+    def start_stage(self, stage: str):
+        self.stage = stage
+        self.found = 0
+        self.total = 0
+        self.done = 0
+        self.kept = []
+
+    async def on_event(self, event: dict):
+        if self.status_task is not None:
+            # Реальный прогресс заменяет ротацию статусов
+            self.status_task.cancel()
+            self.status_task = None
+        if event["type"] == "started":
+            self.found += event["found"]
+            self.total += event["total"]
+        elif event["type"] == "analyzed":
+            self.done += 1
+            if event["item"] is not None:
+                self.kept.append(event["item"])
+        else:
+            return
+        now = time.monotonic()
+        if now - self._last_refresh >= self.REFRESH_INTERVAL or self.done >= self.total:
+            self._last_refresh = now
+            await self.refresh()
+
+    def _publish_preview(self):
+        # Список пополняется по ходу анализа; снимок для просмотра делается при открытии
+        user_data.setdefault(self.chat_id, {}).update({
+            "preview_source": self.kept,
+            "categories": self.categories,
+            "date_from": self.date_from,
+            "date_to": self.date_to,
+            "topic": self.topic
+        })
+
+    async def refresh(self):
+        _, counts = group_news_by_sentiment(self.kept)
+        text = (
+            f"{self.stage}{f' по теме \"{self.topic}\"' if self.topic else ''}... 🧠\n"
+            f"Найдено: {self.found}\n"
+            f"Проанализировано: {self.done} из {self.total}\n"
+            f"Отобрано: {len(self.kept)} "
+            f"(🔴 {counts['Негативная']} / 🔵 {counts['Нейтральная']} / 🟢 {counts['Позитивная']})"
+        )
+        keyboard = None
+        if len(self.kept) >= NEWS_PER_PAGE:
+            self._publish_preview()
+            builder = InlineKeyboardBuilder()
+            builder.row(InlineKeyboardButton(text="👀 Первые новости (анализ продолжается)", callback_data="show_preview_news"))
+            keyboard = builder.as_markup()
+        if text == self._last_text:
+            return
+        self._last_text = text
+        try:
+            await self.status_message.edit_text(text, reply_markup=keyboard)
+        except Exception as e:
+            logging.warning(f"Ошибка при обновлении статуса: {e}")
+
 async def process_news_for_category(message: types.Message, categories: list, chat_id: int, date_from: str, date_to: str, topic: str = None):
     async with semaphore:
         status_message = await bot.send_message(
@@ -172,9 +316,19 @@ async def process_news_for_category(message: types.Message, categories: list, ch
             status_task = asyncio.create_task(
                 update_status_message(status_message, fetch_statuses, bot)
             )
+            # Общий бюджет времени на сбор и анализ; по истечении показываем готовое.
+            # Итоговому проходу по всем категориям оставляется ANALYSIS_RESERVE_SECONDS,
+            # остальное делится между категориями, чтобы первый банк не выбрал весь бюджет
+            deadline = RequestDeadline()
+            categories_deadline = deadline.reserve(ANALYSIS_RESERVE_SECONDS)
+            renderer = LiveStatusRenderer(status_message, chat_id, categories, date_from, date_to, topic)
+            renderer.status_task = status_task
             all_news = []
-            for category in categories:
-                news = await fetch_all_news(category, date_from, date_to, topic=topic)
+            for i, category in enumerate(categories):
+                news = await fetch_all_news(
+                    category, date_from, date_to, topic=topic,
+                    deadline=categories_deadline.share(len(categories) - i), progress=renderer.on_event
+                )
                 all_news.extend(news)
             status_task.cancel()
             logging.info(f"Получено {len(all_news)} новостей для категорий {categories}")
@@ -188,21 +342,25 @@ async def process_news_for_category(message: types.Message, categories: list, ch
                 else:
                     keyboard.row(InlineKeyboardButton(text="🏠 В главное меню", callback_data="return_to_main_menu"))
                 await status_message.edit_text(
-                    f"Новостей{f' по теме \"{topic}\"' if topic else ''} не найдено.",
+                    f"Новостей{f' по теме \"{topic}\"' if topic else ''} не найдено."
+                    + (PARTIAL_RESULTS_HINT if deadline.partial else ""),
                     reply_markup=keyboard.as_markup(),
                     disable_web_page_preview=True
                 )
                 return
-            analyze_statuses = [
-                "Анализирую новости... 🧠",
-                "Оцениваю тональность... 📊",
-                "Категоризирую данные... 📑",
-            ]
-            status_task = asyncio.create_task(
-                update_status_message(status_message, analyze_statuses, bot)
-            )
-            analyzed_news = await analyze_all_news(all_news, topic=topic)
-            status_task.cancel()
+            renderer.start_stage("Отбираю новости")
+            analyzed_news = []
+            final_deadline = deadline.reserve(0)
+            async with contextlib.aclosing(analyze_news_stream(all_news, topic=topic, deadline=final_deadline)) as events:
+                async for event in events:
+                    await renderer.on_event(event)
+                    if event["type"] == "final":
+                        analyzed_news = event["news"]
+            if final_deadline.partial:
+                # Итоговый проход не уложился в остаток бюджета — показываем то, что
+                # fetch_all_news уже проанализировал и отобрал по каждой категории
+                logging.warning(f"Итоговый проход для {categories} прерван дедлайном, показываем результаты по категориям")
+                analyzed_news = all_news
             logging.info(f"После анализа: {len(analyzed_news)} новостей для {categories}")
             if not analyzed_news:
                 keyboard = InlineKeyboardBuilder()
@@ -214,38 +372,14 @@ async def process_news_for_category(message: types.Message, categories: list, ch
                 else:
                     keyboard.row(InlineKeyboardButton(text="🏠 В главное меню", callback_data="return_to_main_menu"))
                 await status_message.edit_text(
-                    f"Релевантных новостей{f' по теме \"{topic}\"' if topic else ''} после анализа не найдено.",
+                    f"Релевантных новостей{f' по теме \"{topic}\"' if topic else ''} после анализа не найдено."
+                    + (PARTIAL_RESULTS_HINT if deadline.partial else ""),
                     reply_markup=keyboard.as_markup(),
                     disable_web_page_preview=True
                 )
                 return
-            sentiment_groups = {
-                "Негативная": [],
-                "Нейтральная": [],
-                "Позитивная": []
-            }
-            for item in analyzed_news:
-                sentiment = item.get("sentiment", "Нейтральная")
-                if sentiment in sentiment_groups:
-                    sentiment_groups[sentiment].append(item)
-                else:
-                    sentiment_groups["Нейтральная"].append(item)
-            for sentiment in sentiment_groups:
-                sentiment_groups[sentiment].sort(
-                    key=lambda x: datetime.strptime(x["date"], "%Y-%m-%d") if x["date"] else datetime.now(),
-                    reverse=True
-                )
-            sorted_news = (
-                sentiment_groups["Негативная"] +
-                sentiment_groups["Нейтральная"] +
-                sentiment_groups["Позитивная"]
-            )
+            sorted_news, sentiment_counts = group_news_by_sentiment(analyzed_news)
             await status_message.edit_text("Сохраняю результаты... 💾")
-            sentiment_counts = {
-                "Негативная": len(sentiment_groups["Негативная"]),
-                "Нейтральная": len(sentiment_groups["Нейтральная"]),
-                "Позитивная": len(sentiment_groups["Позитивная"])
-            }
             total_news = len(sorted_news)
             user_data[chat_id] = {
                 "news": sorted_news,
@@ -253,7 +387,10 @@ async def process_news_for_category(message: types.Message, categories: list, ch
                 "categories": categories,
                 "date_from": date_from,
                 "date_to": date_to,
-                "topic": topic
+                "topic": topic,
+                "partial": deadline.partial,
+                # Открытый до окончания анализа снимок остаётся листаемым
+                "preview": user_data.get(chat_id, {}).get("preview")
             }
             # Фикс для длинного имени файла: используем фиксированное имя с timestamp
             csv_filename = f"news_{int(datetime.now().timestamp())}.csv"
@@ -283,6 +420,11 @@ async def process_news_for_category(message: types.Message, categories: list, ch
                 f"🔵 Нейтральных: {sentiment_counts['Нейтральная']}\n"
                 f"🟢 Позитивных: {sentiment_counts['Позитивная']}"
             )
+            if deadline.partial:
+                news_count_text += (
+                    "\n\n⏳ Результаты частичные: часть источников или анализа не уложилась "
+                    f"в {deadline.seconds} сек. и продолжается в фоне. Повторите запрос позже, чтобы получить полный список."
+                )
             await bot.send_message(
                 chat_id,
                 f"Новости{f' по теме \"{topic}\"' if topic else ''} собраны и проанализированы:\n{news_count_text}\nНажмите, чтобы просмотреть:",
@@ -292,19 +434,27 @@ async def process_news_for_category(message: types.Message, categories: list, ch
             logging.error(f"Ошибка в process_news_for_category: {e}", exc_info=True)
             await status_message.edit_text("Произошла ошибка. Попробуйте позже.")
 
-async def send_news_page(message_or_query: types.Message | types.CallbackQuery, chat_id: int, page: int):
-    logging.info(f"send_news_page для chat_id {chat_id}, страница {page}")
+async def send_news_page(message_or_query: types.Message | types.CallbackQuery, chat_id: int, page: int, preview: bool = False):
+    """
+    Страница новостей. preview=True — страница снимка, открытого до окончания анализа:
+    у него свои кнопки (preview_page_*, preview_similar_*), и номера новостей
+    не сдвигаются, пока анализ пополняет список.
+    """
+    logging.info(f"send_news_page для chat_id {chat_id}, страница {page}{' (предпросмотр)' if preview else ''}")
+    news_key = "preview" if preview else "news"
+    prefix = "preview_" if preview else ""
     try:
-        if chat_id not in user_data or not user_data[chat_id].get("news"):
+        if chat_id not in user_data or not user_data[chat_id].get(news_key):
             await bot.send_message(chat_id, "Новостей не найдено.")
             return
-        news_list = user_data[chat_id]["news"]
+        news_list = user_data[chat_id][news_key]
         categories = user_data[chat_id]["categories"]
-        news_per_page = 5
+        news_per_page = NEWS_PER_PAGE
         total_news = len(news_list)
         total_pages = (total_news + news_per_page - 1) // news_per_page
         page = max(0, min(page, total_pages - 1))
-        user_data[chat_id]["current_page"] = page
+        if not preview:
+            user_data[chat_id]["current_page"] = page
         start_idx = page * news_per_page
         end_idx = min(start_idx + news_per_page, total_news)
         news_subset = news_list[start_idx:end_idx]
@@ -314,6 +464,8 @@ async def send_news_page(message_or_query: types.Message | types.CallbackQuery,
         f"<b>Новости для {bank_display}"
         f"(страница {page + 1} из {total_pages}, всего новостей: {total_news}):</b>\n"
     )
+        if preview:
+            message_text += "<i>⏳ Первые новости: анализ ещё идёт, полный список придёт отдельным сообщением.</i>\n"
         for idx, news in enumerate(news_subset, start=start_idx + 1):
             sentiment = news.get("sentiment", "Неизвестно")
             sentiment_text = (
@@ -341,10 +493,18 @@ async def send_news_page(message_or_query: types.Message | types.CallbackQuery,
                 f"Ссылка: {link}\n"
             )
         keyboard = InlineKeyboardBuilder()
+        if "monitoring" not in categories:
+            keyboard.row(*[
+                InlineKeyboardButton(text=f"🔎 {idx}", callback_data=f"{prefix}similar_{idx - 1}")
+                for idx in range(start_idx + 1, end_idx + 1)
+            ])
+        navigation = []
         if page > 0:
-            keyboard.add(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"page_{page-1}"))
+            navigation.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"{prefix}page_{page-1}"))
         if page < total_pages - 1:
-            keyboard.add(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"page_{page+1}"))
+            navigation.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"{prefix}page_{page+1}"))
+        if navigation:
+            keyboard.row(*navigation)
         if "monitoring" in categories:
             keyboard.row(InlineKeyboardButton(text="💾 Сохранить в Excel", callback_data="save_monitoring_to_excel"))
         if any(cat in BANKS for cat in categories):
@@ -488,7 +648,7 @@ async def handle_text(message: types.Message):
             await message.answer("Ни один из введенных банков не найден. Попробуйте снова:")
             return
         for bank in selected_banks:
-            add_subscription(chat_id, bank)
+            await add_subscription(chat_id, bank)
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔍 Запарсить новости за неделю", callback_data="parse_last_week_monitoring")],
             [InlineKeyboardButton(text="🏠 В главное меню", callback_data="return_to_main_menu")]
@@ -505,7 +665,7 @@ async def handle_text(message: types.Message):
         return
     elif state == WAITING_FOR_MONITORING_BANK_UNSUBSCRIBE:
         banks_input = [bank.strip() for bank in query.split(",")]
-        subscriptions = get_user_subscriptions(chat_id)
+        subscriptions = await get_user_subscriptions(chat_id)
         current_banks = [bank[0] for bank in subscriptions]
         
         removed_banks = []
@@ -517,7 +677,7 @@ async def handle_text(message: types.Message):
                     normalized_bank in [normalize_text(alias) for alias in aliases] or 
                     normalized_bank == info.get("reg_number")):
                     if bank_name in current_banks:
-                        remove_subscription(chat_id, bank_name)
+                        await remove_subscription(chat_id, bank_name)
                         removed_banks.append(bank_name)
                     break
         
@@ -526,7 +686,7 @@ async def handle_text(message: types.Message):
             return
         
         # Обновляем список подписок
-        remaining_subscriptions = get_user_subscriptions(chat_id)
+        remaining_subscriptions = await get_user_subscriptions(chat_id)
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🏠 В главное меню", callback_data="return_to_main_menu")]
@@ -722,6 +882,42 @@ async def handle_callback(query: types.CallbackQuery):
             await send_news_page(query, chat_id, page)
             return
 
+        elif data.startswith("preview_page_"):
+            page = int(data.split("_")[2])
+            await send_news_page(query, chat_id, page, preview=True)
+            return
+
+        elif data == "show_preview_news":
+            kept = user_data.get(chat_id, {}).get("preview_source")
+            if not kept:
+                await bot.send_message(chat_id, "Анализ уже завершён, воспользуйтесь кнопкой «Показать новости».")
+                return
+            # Снимок на момент нажатия: статус продолжает обновляться, а номера новостей не плывут
+            user_data[chat_id]["preview"], _ = group_news_by_sentiment(kept)
+            await send_news_page(query.message, chat_id, 0, preview=True)
+            return
+
+        elif data.startswith("similar_") or data.startswith("preview_similar_"):
+            idx = int(data.rsplit("_", 1)[1])
+            news_list = user_data[chat_id].get("preview" if data.startswith("preview_") else "news") or []
+            if idx >= len(news_list):
+                await bot.send_message(chat_id, "Новость не найдена, повторите поиск.")
+                return
+            news = news_list[idx]
+            similar = await find_similar_news(news.get("bank", ""), news.get("summary", ""))
+            if not similar:
+                await bot.send_message(chat_id, f"Похожих новостей для №{idx + 1} за последние {EMBEDDING_WINDOW_DAYS} дней не найдено.")
+                return
+            similar_text = f"<b>Похожие новости для №{idx + 1}:</b>\n"
+            for number, item in enumerate(similar, start=1):
+                similar_text += (
+                    f"<b>{number}.</b> {sanitize_text(item['summary'][:300])}\n"
+                    f"Дата: {sanitize_text(item['date'] or 'Неизвестно')}, сходство {item['similarity']:.2f}\n"
+                    f"Ссылка: {sanitize_text(item['link'] or 'Неизвестно')}\n"
+                )
+            await bot.send_message(chat_id, similar_text, disable_web_page_preview=True)
+            return
+
         elif data == "info":
             new_text = "Загружаю информацию об источниках..."
             if await safe_edit_message(new_text):
@@ -808,7 +1004,7 @@ async def handle_callback(query: types.CallbackQuery):
                 InlineKeyboardButton(text="➖ Отписаться", callback_data="unsubscribe_monitoring")
             )
             keyboard.row(InlineKeyboardButton(text="🏠 В главное меню", callback_data="return_to_main_menu"))
-            subscriptions = get_user_subscriptions(chat_id)
+            subscriptions = await get_user_subscriptions(chat_id)
             if subscriptions:
                 current_subscriptions = "\n".join([f"• {bank[0]}" for bank in subscriptions])
                 message_text = (
@@ -835,7 +1031,7 @@ async def handle_callback(query: types.CallbackQuery):
             return
 
         elif data == "unsubscribe_monitoring":
-            subscriptions = get_user_subscriptions(chat_id)
+            subscriptions = await get_user_subscriptions(chat_id)
             if not subscriptions:
                 new_text = (
                     "📭 <b>У вас пока нет активных подписок на мониторинг новостей.</b>\n"
@@ -867,10 +1063,7 @@ async def handle_callback(query: types.CallbackQuery):
 
         elif data == "view_monitoring_news":
             try:
-                conn = sqlite3.connect('monitoring.db')
-                cursor = conn.cursor()
-                cursor.execute('SELECT bank_name FROM subscriptions WHERE chat_id = ?', (chat_id,))
-                banks = [row[0] for row in cursor.fetchall()]
+                banks = [row[0] for row in await get_user_subscriptions(chat_id)]
                 if not banks:
                     new_text = "Вы не подписаны ни на один банк."
                     await safe_edit_message(
@@ -880,16 +1073,7 @@ async def handle_callback(query: types.CallbackQuery):
                         ])
                     )
                     return
-                placeholders = ','.join(['?'] * len(banks))
-                cursor.execute(f'''
-                    SELECT bank_name, reg_number, text, summary, event_type, event_date, entities, 
-                           date, link, source, category, sentiment, informativeness
-                    FROM analyzed_monitored_news
-                    WHERE bank_name IN ({placeholders})
-                    ORDER BY created_at DESC
-                ''', banks)
-                rows = cursor.fetchall()
-                conn.close()
+                rows = await fetchall(MONITORING_DB, MONITORED_NEWS_QUERY, banks, placeholders=len(banks))
                 if not rows:
                     new_text = "Новостей для отслеживаемых банков пока нет."
                     await safe_edit_message(
@@ -1018,10 +1202,7 @@ async def handle_callback(query: types.CallbackQuery):
         # Обработка просмотра архива мониторинга (всех новостей из базы)
         elif data == "view_monitoring_archive":
             try:
-                conn = sqlite3.connect('monitoring.db')
-                cursor = conn.cursor()
-                cursor.execute('SELECT bank_name FROM subscriptions WHERE chat_id = ?', (chat_id,))
-                banks = [row[0] for row in cursor.fetchall()]
+                banks = [row[0] for row in await get_user_subscriptions(chat_id)]
                 if not banks:
                     new_text = "Вы не подписаны ни на один банк."
                     await safe_edit_message(
@@ -1031,17 +1212,8 @@ async def handle_callback(query: types.CallbackQuery):
                         ])
                     )
                     return
-                placeholders = ','.join(['?'] * len(banks))
-                cursor.execute(f'''
-                    SELECT bank_name, reg_number, text, summary, event_type, event_date, entities, 
-                           date, link, source, category, sentiment, informativeness
-                    FROM analyzed_monitored_news
-                    WHERE bank_name IN ({placeholders})
-                    ORDER BY created_at DESC
-                    LIMIT 100  # Ограничиваем для производительности
-                ''', banks)
-                rows = cursor.fetchall()
-                conn.close()
+                # Ограничиваем 100 последними для производительности
+                rows = await fetchall(MONITORING_DB, MONITORED_ARCHIVE_QUERY, banks, placeholders=len(banks))
                 
                 if not rows:
                     new_text = "Новостей для отслеживаемых банков пока нет."
@@ -1129,7 +1301,7 @@ async def handle_callback(query: types.CallbackQuery):
                 return
             new_news = hot_news_cache.get(chat_id, [])
             if not new_news:
-                new_news = get_new_analyzed_news(chat_id)
+                new_news = await get_new_analyzed_news(chat_id)
                 if not new_news:
                     new_text = "📭 Новых новостей для отслеживаемых банков пока нет."
                     await safe_edit_message(
@@ -1167,7 +1339,7 @@ async def handle_callback(query: types.CallbackQuery):
                 negative_count = sum(1 for n in news_list if n.get("sentiment") == "Негативная")
                 message_lines.append(f"• {bank}: {len(news_list)} новых (🔴 {negative_count} негативных)")
             message_text = "\n".join(message_lines)
-            subscriptions = get_user_subscriptions(chat_id)
+            subscriptions = await get_user_subscriptions(chat_id)
             if subscriptions:
                 current_subscriptions = "\n".join([f"• {bank[0]}" for bank in subscriptions])
                 message_text += f"\n<b>Ваши подписки:</b>\n{current_subscriptions}"
@@ -1180,19 +1352,8 @@ async def handle_callback(query: types.CallbackQuery):
                 message_text,
                 keyboard.as_markup()
             )
-            try:
-                conn = sqlite3.connect('monitoring.db')
-                cursor = conn.cursor()
-                cursor.execute('''
-                    UPDATE subscriptions 
-                    SET last_notification = CURRENT_TIMESTAMP 
-                    WHERE chat_id = ?
-                ''', (chat_id,))
-                conn.commit()
-                conn.close()
-                logging.info(f"Обновлено время last_notification для chat_id={chat_id}")
-            except sqlite3.Error as e:
-                logging.error(f"Ошибка обновления last_notification для chat_id {chat_id}: {e}")
+            await update_last_notification(chat_id)
+            logging.info(f"Обновлено время last_notification для chat_id={chat_id}")
             return
 
         elif data == "start_display_news":
@@ -1225,7 +1386,7 @@ async def handle_callback(query: types.CallbackQuery):
             return
 
         elif data == "parse_last_week_monitoring":
-            subscriptions = get_user_subscriptions(chat_id)
+            subscriptions = await get_user_subscriptions(chat_id)
             if not subscriptions:
                 new_text = "У вас нет подписок на банки."
                 await safe_edit_message(new_text)
@@ -1378,10 +1539,14 @@ async def handle_callback(query: types.CallbackQuery):
 
 async def main():
     dp.message.register(start_command, Command(commands=["start", "menu"]))
+    dp.message.register(entity_command, Command(commands=["entity"]))
     dp.message.register(handle_text, F.text)
     dp.message.register(handle_photo, F.photo)
     dp.callback_query.register(handle_callback)
+    # Модель эмбеддингов загружается один раз при старте, а не при первом запросе
+    await asyncio.to_thread(get_encoder)
     asyncio.create_task(monitoring_loop(bot))
+    run_in_background(refresh_model_periodically(), name="обучение TF-IDF модели")
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
@@ -0,0 +1,656 @@
+# dedup_index.py (кандидаты для дедубликации: окно дат + индекс сущностей и шинглов, MinHash/LSH-индексы, кластеры дубликатов,
+# канонические URL и SimHash для схлопывания копий до анализа)
+
+import hashlib
+import logging
+import re
+import sqlite3
+import zlib
+from collections import Counter, defaultdict, deque
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import numpy as np
+
+from storage import NEWS_DB, fetchall, register_query, sql_for, write
+from utils import normalize_entity, normalize_text_for_aliases
+
+# Максимальная разница дат событий для пары-кандидата (дни)
+DATE_WINDOW_DAYS = 3
+
+# Длина шингла в словах
+SHINGLE_SIZE = 3
+
+# Ключ, встречающийся у большей доли новостей пакета, не блокирует (например, название самого банка)
+MAX_KEY_SHARE = 0.3
+
+# ...но стоп-ключом считается только при абсолютной частоте выше этого порога
+MIN_STOP_KEY_COUNT = 10
+
+# MinHash/LSH: число перестановок и полос (16 полос по 4 строки — порог LSH около 0.5)
+MINHASH_NUM_PERM = 64
+MINHASH_BANDS = 16
+
+# Окно хранения сигнатур в индексе банка (дни)
+MINHASH_WINDOW_DAYS = 30
+
+# Выжимки с оценкой Жаккара не ниже порога считаются дубликатами без LLM, ниже нижнего — разными событиями
+SUMMARY_MERGE_THRESHOLD = 0.8
+SUMMARY_DISTINCT_THRESHOLD = 0.05
+
+# Сырые тексты с оценкой Жаккара не ниже порога считаются перепечатками
+TEXT_REPRINT_THRESHOLD = 0.9
+
+# Числа (ставки, суммы, даты) и названия месяцев: шаблонные новости ("ставка повышена до 7%" и "до 8%")
+# почти совпадают по словам, поэтому без LLM объединяются только тексты с одинаковым набором таких токенов
+NUMBER_PATTERN = re.compile(r"\d+(?:[.,]\d+)*")
+MONTH_PATTERN = re.compile(
+    r"\b(январ|феврал|март|апрел|ма[йя]\b|июн|июл|август|сентябр|октябр|ноябр|декабр)", re.IGNORECASE
+)
+
+_MINHASH_PRIME = (1 << 31) - 1
+
+
+def word_shingles(text, size=SHINGLE_SIZE):
+    """Множество словесных шинглов нормализованного текста; короткий текст — один шингл"""
+    words = normalize_text_for_aliases(text).split()
+    if not words:
+        return set()
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def numeric_tokens(text):
+    """Числа и месяцы текста: {"7.5", "28", "м:июл", ...}"""
+    text = text or ""
+    numbers = {number.replace(",", ".") for number in NUMBER_PATTERN.findall(text)}
+    months = {"м:" + ("май" if month.lower() == "мая" else month.lower()) for month in MONTH_PATTERN.findall(text)}
+    return frozenset(numbers | months)
+
+
+def same_numbers(a, b):
+    """True, если числа и даты двух текстов совпадают (условие объединения без LLM)"""
+    return numeric_tokens(a) == numeric_tokens(b)
+
+
+def numbers_key(text):
+    """Строковый отпечаток numeric_tokens для хранения рядом с сигнатурой"""
+    return " ".join(sorted(numeric_tokens(text)))
+
+
+def blocking_keys(summary, entities, shingles=True):
+    """Ключи блокировки новости: нормализованные сущности и (если shingles) шинглы выжимки"""
+    keys = {"e:" + e for e in (normalize_entity(entity) for entity in entities or []) if e}
+    if shingles:
+        keys.update("s:" + shingle for shingle in word_shingles(summary or ""))
+    return keys
+
+
+class EntityInvertedIndex:
+    """Инвертированный индекс нормализованная сущность -> новости пакета"""
+
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.entities = {}
+
+    def add(self, item_id, entities):
+        normalized = {normalize_entity(entity) for entity in entities or []}
+        normalized.discard("")
+        self.entities[item_id] = normalized
+        for entity in normalized:
+            self.postings[entity].add(item_id)
+
+    def items_with(self, entity):
+        return self.postings.get(normalize_entity(entity), set())
+
+    def shares_entity(self, a, b):
+        return not self.entities.get(a, set()).isdisjoint(self.entities.get(b, ()))
+
+
+def candidate_pairs(items, window_days=DATE_WINDOW_DAYS, max_key_share=MAX_KEY_SHARE):
+    """
+    Пары-кандидаты (i, j), i < j, у которых даты событий отличаются не более чем на
+    window_days и есть общий ключ блокировки. items — список (дата события, ключи).
+
+    Проход по новостям, отсортированным по дате, со скользящим окном на каждый ключ:
+    работа пропорциональна размерам блоков внутри окна, а не квадрату размера пакета.
+    Возвращает (пары, статистика), где в статистике число пар в окне дат без блокировки
+    и число отсечённых блокировкой пар.
+    """
+    n = len(items)
+    key_counts = Counter(key for _, keys in items for key in keys)
+    stop_limit = max(MIN_STOP_KEY_COUNT, max_key_share * n)
+    stop_keys = {key for key, count in key_counts.items() if count > stop_limit}
+
+    order = sorted(range(n), key=lambda idx: items[idx][0])
+    windows = defaultdict(deque)
+    pairs = set()
+    window_pairs = 0
+    left = 0
+    for pos, i in enumerate(order):
+        day = items[i][0]
+        # Общее окно дат — только для подсчёта отсечённых пар
+        while (day - items[order[left]][0]).days > window_days:
+            left += 1
+        window_pairs += pos - left
+        for key in items[i][1]:
+            if key in stop_keys or key_counts[key] < 2:
+                continue
+            bucket = windows[key]
+            while bucket and (day - items[bucket[0]][0]).days > window_days:
+                bucket.popleft()
+            for j in bucket:
+                pairs.add((j, i) if j < i else (i, j))
+            bucket.append(i)
+
+    stats = {
+        "items": n,
+        "window_pairs": window_pairs,
+        "candidate_pairs": len(pairs),
+        "pruned_pairs": window_pairs - len(pairs),
+        "stop_keys": len(stop_keys),
+    }
+    return sorted(pairs), stats
+
+
+# Групповая проверка дубликатов LLM — одно разбиение группы на события вместо k(k-1)/2 попарных запросов.
+# Группы меньше этого размера проверяются попарно, крупнее — делятся на части по дате
+CLUSTER_MIN_SIZE = 3
+CLUSTER_MAX_SIZE = 12
+
+_PARTITION_LINE_RE = re.compile(r"Событие\s*\d*\s*:\s*\[?([\d,;\s]+)\]?", re.IGNORECASE)
+
+
+def adjudication_groups(pairs, order_key, min_size=CLUSTER_MIN_SIZE, max_size=CLUSTER_MAX_SIZE):
+    """
+    Группы для одного запроса разбиения: компоненты связности графа пар-кандидатов.
+    Компоненты крупнее max_size делятся на части подряд по order_key. Возвращает
+    (группы, пары для попарной проверки): пары малых компонент и пары между частями.
+    """
+    graph = defaultdict(set)
+    for i, j in pairs:
+        graph[i].add(j)
+        graph[j].add(i)
+    group_of = {}
+    groups = []
+    for start in sorted(graph):
+        if start in group_of:
+            continue
+        component = []
+        stack = [start]
+        group_of[start] = None
+        while stack:
+            node = stack.pop()
+            component.append(node)
+            for other in graph[node]:
+                if other not in group_of:
+                    group_of[other] = None
+                    stack.append(other)
+        if len(component) < min_size:
+            continue
+        component.sort(key=order_key)
+        for offset in range(0, len(component), max_size):
+            chunk = component[offset:offset + max_size]
+            if len(chunk) < min_size:
+                continue
+            for node in chunk:
+                group_of[node] = len(groups)
+            groups.append(chunk)
+    pairwise = [(i, j) for i, j in pairs if group_of[i] is None or group_of[i] != group_of[j]]
+    return groups, pairwise
+
+
+def parse_event_partition(response, ids):
+    """Разбиение из ответа LLM: список множеств id, если каждый id встречается ровно один раз, иначе None"""
+    partition = []
+    seen = set()
+    for match in _PARTITION_LINE_RE.finditer(response or ""):
+        members = {int(token) for token in re.findall(r"\d+", match.group(1))}
+        if not members or members & seen:
+            return None
+        seen |= members
+        partition.append(members)
+    if seen != set(ids):
+        return None
+    return partition
+
+
+class MinHashLSHIndex:
+    """
+    MinHash-сигнатуры шинглов и LSH-корзины по полосам сигнатуры. Поиск кандидатов
+    для нового элемента — константное число обращений к словарю корзин; оценка
+    сходства — доля совпавших позиций сигнатур (оценка коэффициента Жаккара).
+    """
+
+    def __init__(self, num_perm=MINHASH_NUM_PERM, bands=MINHASH_BANDS, seed=1):
+        if num_perm % bands:
+            raise ValueError("num_perm должно делиться на bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, _MINHASH_PRIME, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, _MINHASH_PRIME, size=num_perm).astype(np.uint64)
+        self._signatures = {}  # key -> (signature, date)
+        self._numbers = {}  # key -> numbers_key текста (если известен)
+        self._buckets = defaultdict(set)
+        self._new_keys = []
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def __contains__(self, key):
+        return key in self._signatures
+
+    def signature(self, shingles):
+        if not shingles:
+            return np.full(self.num_perm, _MINHASH_PRIME, dtype=np.uint32)
+        # crc32 стабилен между запусками, в отличие от hash()
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) % _MINHASH_PRIME for shingle in shingles),
+            dtype=np.uint64, count=len(shingles)
+        )
+        permuted = (np.outer(self._a, hashes) + self._b[:, None]) % _MINHASH_PRIME
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def get_signature(self, key):
+        entry = self._signatures.get(key)
+        return entry[0] if entry else None
+
+    def numbers(self, key):
+        return self._numbers.get(key)
+
+    def insert(self, key, signature, date, persist=True, numbers=None):
+        if key in self._signatures:
+            return
+        self._signatures[key] = (signature, date)
+        if numbers is not None:
+            self._numbers[key] = numbers
+        for band_key in self._band_keys(signature):
+            self._buckets[band_key].add(key)
+        if persist:
+            self._new_keys.append(key)
+
+    def remove(self, key):
+        entry = self._signatures.pop(key, None)
+        if entry is None:
+            return
+        self._numbers.pop(key, None)
+        for band_key in self._band_keys(entry[0]):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def query(self, signature, min_similarity=0.0):
+        """Кандидаты из общих LSH-корзин: список (key, оценка Жаккара) по убыванию сходства"""
+        candidates = set()
+        for band_key in self._band_keys(signature):
+            candidates.update(self._buckets.get(band_key, ()))
+        scored = []
+        for key in candidates:
+            similarity = estimate_jaccard(signature, self._signatures[key][0])
+            if similarity >= min_similarity:
+                scored.append((key, similarity))
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored
+
+    def prune(self, min_date):
+        """Удаление сигнатур старше окна (даты — строки YYYY-MM-DD)"""
+        for key in [k for k, (_, date) in self._signatures.items() if date and date < min_date]:
+            self.remove(key)
+
+    def collect_new_rows(self, bank, kind):
+        keys, self._new_keys = self._new_keys, []
+        return [
+            {"bank": bank, "kind": kind, "item_key": key, "signature": self._signatures[key][0].tobytes(),
+             "item_date": self._signatures[key][1], "numbers": self._numbers.get(key)}
+            for key in keys if key in self._signatures
+        ]
+
+
+def estimate_jaccard(signature1, signature2):
+    return float(np.mean(signature1 == signature2))
+
+
+# Индексы по (банк, вид): вид "text" — сырые тексты до анализа, "summary" — выжимки
+_minhash_indexes = {}
+
+
+def _window_start(window_days=MINHASH_WINDOW_DAYS):
+    return (datetime.now() - timedelta(days=window_days)).strftime("%Y-%m-%d")
+
+
+EXPIRE_MINHASH_QUERY = register_query(
+    "expire_minhash_signatures", "DELETE FROM minhash_signatures WHERE bank = ? AND kind = ? AND item_date < ?"
+)
+MINHASH_QUERY = register_query(
+    "minhash_signatures_by_bank", "SELECT item_key, signature, item_date, numbers FROM minhash_signatures WHERE bank = ? AND kind = ?"
+)
+
+
+async def load_minhash_index(bank, kind, db_path=NEWS_DB, window_days=MINHASH_WINDOW_DAYS):
+    """Загрузка сигнатур банка за скользящее окно; устаревшие строки удаляются через писателя БД"""
+    index = MinHashLSHIndex()
+    min_date = _window_start(window_days)
+
+    def expire(cursor):
+        cursor.execute(sql_for(EXPIRE_MINHASH_QUERY), (bank, kind, min_date))
+
+    try:
+        await write(db_path, expire)
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка удаления устаревших MinHash-сигнатур {kind} для {bank}: {e}")
+    try:
+        for item_key, signature, item_date, numbers in await fetchall(db_path, MINHASH_QUERY, (bank, kind)):
+            index.insert(item_key, np.frombuffer(signature, dtype=np.uint32), item_date, persist=False, numbers=numbers)
+        logging.info(f"Загружен MinHash-индекс {kind} для {bank}: {len(index)} сигнатур")
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка загрузки MinHash-индекса {kind} для {bank}: {e}")
+    return index
+
+
+async def ensure_minhash_indexes(bank_kinds):
+    """
+    Загрузка индексов (банк, вид) до синхронных проверок перепечаток и выжимок,
+    чтобы чтение из БД не блокировало event loop внутри get_minhash_index.
+    """
+    for bank, kind in set(bank_kinds):
+        if (bank, kind) not in _minhash_indexes:
+            index = await load_minhash_index(bank, kind)
+            # Индекс мог загрузить параллельный анализ, пока шло чтение
+            _minhash_indexes.setdefault((bank, kind), index)
+
+
+def get_minhash_index(bank, kind):
+    """Загруженный индекс (банк, вид); загрузка — ensure_minhash_indexes"""
+    index = _minhash_indexes.get((bank, kind))
+    if index is None:
+        raise KeyError(f"MinHash-индекс {kind} для {bank} не загружен (ensure_minhash_indexes)")
+    return index
+
+
+def _is_reprint(index, key, signature, numbers):
+    # Перепечатка — тот же текст или почти тот же с теми же числами и датами (сигнатуры без отпечатка чисел — из старых строк)
+    if key in index:
+        return True
+    return any(
+        index.numbers(other) in (None, numbers) for other, _ in index.query(signature, TEXT_REPRINT_THRESHOLD)
+    )
+
+
+def collapse_reprints(news_list, text_key, day, include_history=False):
+    """
+    Отбрасывание перепечаток до анализа по MinHash сырых текстов: перепечатка новости
+    из того же пакета не анализируется повторно, а при include_history (мониторинг) — и
+    перепечатка текста, обработанного в предыдущих итерациях (индекс банка за скользящее окно).
+    Шаблонные новости с другими числами или датами перепечатками не считаются.
+    text_key(text) — ключ текста, day(news) — дата новости "ГГГГ-ММ-ДД"; индексы банков
+    загружаются заранее (ensure_minhash_indexes).
+    Возвращает (оставшиеся новости, сигнатуры для remember_texts после анализа, число перепечаток).
+    """
+    batch_index = MinHashLSHIndex()
+    kept = []
+    records = []
+    for news in news_list:
+        bank = news.get("bank", "")
+        text = news.get("text", "")
+        key = text_key(text)
+        numbers = numbers_key(text)
+        bank_index = get_minhash_index(bank, "text")
+        signature = bank_index.get_signature(key)
+        if signature is None:
+            signature = batch_index.signature(word_shingles(text))
+        if _is_reprint(batch_index, key, signature, numbers):
+            continue
+        if include_history and _is_reprint(bank_index, key, signature, numbers):
+            continue
+        batch_index.insert(key, signature, day(news), persist=False, numbers=numbers)
+        records.append((bank, key, signature, day(news), numbers))
+        kept.append(news)
+    reprints = len(news_list) - len(kept)
+    if reprints:
+        logging.info(f"MinHash: отброшено {reprints} перепечаток до анализа")
+    return kept, records, reprints
+
+
+def remember_texts(records):
+    for bank, key, signature, day, numbers in records:
+        get_minhash_index(bank, "text").insert(key, signature, day, numbers=numbers)
+
+
+def collect_minhash_rows():
+    """Новые сигнатуры всех индексов для сохранения через save_to_db_async(..., "minhash_signatures")"""
+    min_date = _window_start()
+    rows = []
+    for (bank, kind), index in _minhash_indexes.items():
+        index.prune(min_date)
+        rows.extend(index.collect_new_rows(bank, kind))
+    return rows
+
+
+class DuplicateClusterIndex:
+    """
+    Кластеры дубликатов: union-find по ключам новостей (хэш выжимки) и представитель
+    каждого кластера по функции ранжирования rank. Новые новости достаточно сравнить
+    с представителями и между собой — пары старых новостей уже были проверены.
+    """
+
+    def __init__(self, rank):
+        self.rank = rank
+        self.items = {}
+        self.parent = {}
+        self.members = {}
+        self.dirty = set()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def add(self, key, item, persist=True):
+        if key in self.items:
+            return
+        self.items[key] = item
+        self.parent[key] = key
+        self.members[key] = {key}
+        if persist:
+            self.dirty.add(key)
+
+    def restore(self, nodes):
+        """Восстановление из сохранённых (ключ, корень кластера, новость)"""
+        for key, _, item in nodes:
+            self.add(key, item, persist=False)
+        replaced_roots = {}
+        for key, root, _ in nodes:
+            if root == key:
+                continue
+            if root not in self.items:
+                # Корень вышел из окна хранения: его роль переходит к первому оставшемуся узлу кластера
+                root = replaced_roots.setdefault(root, key)
+                self.dirty.add(key)
+                if root == key:
+                    continue
+            self.union(root, key, persist=False)
+
+    def find(self, key):
+        root = key
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while key != root:
+            self.parent[key], key = root, self.parent[key]
+        return root
+
+    def union(self, a, b, persist=True):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return root_a
+        # Меньший кластер вливается в больший; при равенстве корнем остаётся первый (более старый)
+        if len(self.members[root_a]) < len(self.members[root_b]):
+            root_a, root_b = root_b, root_a
+        moved = self.members.pop(root_b)
+        for key in moved:
+            self.parent[key] = root_a
+        self.members[root_a].update(moved)
+        if persist:
+            self.dirty.update(moved)
+        return root_a
+
+    def representative(self, root):
+        return max((self.items[key] for key in self.members[root]), key=self.rank)
+
+    def representatives(self):
+        """Список (ключ корня, новость-представитель) по всем кластерам"""
+        return [(root, self.representative(root)) for root in self.members]
+
+    def collect_dirty(self):
+        keys, self.dirty = self.dirty, set()
+        return [(key, self.find(key), self.items[key]) for key in keys if key in self.items]
+
+
+# --- КАНОНИЧЕСКИЕ URL И SIMHASH: схлопывание копий одной статьи до анализа ---
+# Параметры отслеживания, не меняющие содержимое страницы
+TRACKING_PARAMS = {
+    "fbclid", "gclid", "yclid", "ysclid", "dclid", "msclkid", "_openstat", "from", "ref", "ref_src",
+    "rss", "share", "amp", "outputtype",
+}
+TRACKING_PREFIXES = ("utm_", "at_", "mc_")
+
+# Поддомены мобильных и AMP-версий
+MIRROR_SUBDOMAINS = ("www.", "m.", "amp.", "mobile.", "pda.")
+
+# Максимальное расстояние Хэмминга между 64-битными SimHash слов почти одинаковых текстов
+# (на новостях в 100–300 слов копии с другой подписью дают 1–6 бит, разные события — от 15, но шаблонные
+# новости с другими числами — тоже единицы бит). Порог занижен и дополнен сверкой чисел; копии дальше
+# порога отсекает MinHash перепечаток (collapse_reprints)
+SIMHASH_MAX_DISTANCE = 3
+SIMHASH_BITS = 64
+SIMHASH_SHINGLE_SIZE = 1
+# Блоки по 8 бит: при расстоянии ≤ 7 хотя бы один блок совпадает полностью
+SIMHASH_BLOCKS = 8
+
+
+def canonical_url(url):
+    """
+    Канонический URL: https, хост без www/m/amp, путь без AMP-суффиксов и завершающего
+    слэша, запрос без параметров отслеживания (остальные отсортированы), без фрагмента.
+    Не-URL (например, имя API) возвращается как есть.
+    """
+    if not url or "://" not in url:
+        return url or ""
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url
+    host = (parts.hostname or "").lower()
+    stripped = True
+    while stripped:
+        stripped = False
+        for prefix in MIRROR_SUBDOMAINS:
+            if host.startswith(prefix) and host.count(".") > 1:
+                host = host[len(prefix):]
+                stripped = True
+    path = parts.path or "/"
+    if host == "t.me" and path.startswith("/s/"):
+        path = path[2:]
+    for suffix in ("/amp", "/amp/", ".amp", "/index.html", "/index.php"):
+        if path.endswith(suffix):
+            path = path[:-len(suffix)] or "/"
+    if path.startswith("/amp/"):
+        path = path[4:]
+    path = path.rstrip("/") or "/"
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS and not key.lower().startswith(TRACKING_PREFIXES)
+    )
+    return urlunsplit(("https", host, path, urlencode(query), ""))
+
+
+def simhash(text, size=SIMHASH_SHINGLE_SIZE):
+    """64-битный SimHash словесных шинглов нормализованного текста (0 для пустого текста)"""
+    shingles = word_shingles(text, size)
+    if not shingles:
+        return 0
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little") for shingle in shingles),
+        dtype=np.uint64, count=len(shingles)
+    )
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    votes = 2 * bits.sum(axis=0, dtype=np.int64) - len(shingles)
+    return int.from_bytes(np.packbits(votes > 0, bitorder="little").tobytes(), "little")
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class SimHashIndex:
+    """Поиск SimHash в пределах расстояния Хэмминга через точное совпадение одного из блоков"""
+
+    def __init__(self, max_distance=SIMHASH_MAX_DISTANCE, blocks=SIMHASH_BLOCKS):
+        self.max_distance = max_distance
+        self.block_bits = SIMHASH_BITS // blocks
+        self.blocks = blocks
+        self._tables = [defaultdict(list) for _ in range(blocks)]
+
+    def _block_keys(self, value):
+        mask = (1 << self.block_bits) - 1
+        return [(value >> (block * self.block_bits)) & mask for block in range(self.blocks)]
+
+    def add(self, key, value):
+        for table, block_key in zip(self._tables, self._block_keys(value)):
+            table[block_key].append((key, value))
+
+    def query(self, value, accept=None):
+        """Первый ключ с расстоянием не больше max_distance (и accept(key), если задан) или None"""
+        for table, block_key in zip(self._tables, self._block_keys(value)):
+            for key, other in table.get(block_key, ()):
+                if hamming_distance(value, other) <= self.max_distance and (accept is None or accept(key)):
+                    return key
+        return None
+
+
+def collapse_exact_duplicates(news_list, rank):
+    """
+    Схлопывание копий статьи по каноническому URL и SimHash текста в пределах банка
+    (по SimHash — только при совпадении чисел и дат, см. same_numbers).
+    Из каждой группы остаётся лучшая по rank новость (на месте первой копии).
+    Возвращает (оставшиеся новости, число схлопнутых по URL, число схлопнутых по тексту).
+    """
+    groups = []
+    group_numbers = []
+    by_url = {}
+    simhash_indexes = defaultdict(SimHashIndex)
+    url_collapsed = text_collapsed = 0
+    for news in news_list:
+        bank = news.get("bank", "")
+        url = canonical_url(news.get("link", ""))
+        group = by_url.get((bank, url)) if "://" in url else None
+        if group is not None:
+            url_collapsed += 1
+        else:
+            fingerprint = simhash(news.get("text", ""))
+            numbers = numeric_tokens(news.get("text", ""))
+            group = (
+                simhash_indexes[bank].query(fingerprint, accept=lambda candidate: group_numbers[candidate] == numbers)
+                if fingerprint else None
+            )
+            if group is not None:
+                text_collapsed += 1
+            else:
+                group = len(groups)
+                groups.append([])
+                group_numbers.append(numbers)
+                if fingerprint:
+                    simhash_indexes[bank].add(group, fingerprint)
+            if "://" in url:
+                by_url[(bank, url)] = group
+        groups[group].append(news)
+    kept = [max(members, key=rank) if len(members) > 1 else members[0] for members in groups]
+    return kept, url_collapsed, text_collapsed
@@ -0,0 +1,346 @@
+# embedding_index.py (локальные эмбеддинги выжимок на CPU и индекс ближайших соседей по банкам)
+
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from storage import NEWS_DB, fetchall, register_query, sql_for
+from utils import normalize_text_for_aliases
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# "auto" — sentence-transformers при наличии, иначе хэширующий векторизатор; "hashing"; "off"
+EMBEDDING_BACKEND = "auto"
+EMBEDDING_MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+# Размерность векторов хэширующего векторизатора (символьные n-граммы)
+HASHING_DIM = 1024
+
+# Окно индекса банка (дни)
+EMBEDDING_WINDOW_DAYS = 30
+
+# Порог косинусного сходства для объединения выжимок без LLM и для поиска кандидатов
+EMBEDDING_DUPLICATE_THRESHOLD = 0.92
+EMBEDDING_CANDIDATE_THRESHOLD = 0.75
+
+# Брутфорс по NumPy быстрее HNSW на небольших индексах
+HNSW_MIN_ITEMS = 2000
+
+_encoder = None
+_encoder_loaded = False
+_encoder_lock = threading.Lock()
+_embedding_indexes = {}
+# Индексы банков читаются и пополняются из потоков (embed_summaries) и из event loop (collect_embedding_rows)
+_indexes_lock = threading.Lock()
+
+
+class HashingEncoder:
+    """Запасной кодировщик без сети и моделей: символьные n-граммы, хэшированные в фиксированную размерность"""
+
+    name = "hashing"
+
+    def __init__(self, dim=HASHING_DIM):
+        self.dim = dim
+        self._vectorizer = HashingVectorizer(
+            n_features=dim,
+            analyzer="char_wb",
+            ngram_range=(3, 5),
+            alternate_sign=False,
+            norm="l2",
+            preprocessor=normalize_text_for_aliases
+        )
+
+    def encode(self, texts):
+        return self._vectorizer.transform(texts).toarray().astype(np.float32)
+
+
+class SentenceEncoder:
+    name = "minilm"
+
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME):
+        self._model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self._model.get_sentence_embedding_dimension()
+
+    def encode(self, texts):
+        vectors = self._model.encode(list(texts), batch_size=32, normalize_embeddings=True, show_progress_bar=False)
+        return np.asarray(vectors, dtype=np.float32)
+
+
+def get_encoder():
+    """Кодировщик по EMBEDDING_BACKEND или None, если эмбеддинги отключены"""
+    global _encoder, _encoder_loaded
+    if _encoder_loaded:
+        return _encoder
+    with _encoder_lock:
+        if _encoder_loaded:
+            return _encoder
+        if EMBEDDING_BACKEND == "auto" and SentenceTransformer is not None:
+            try:
+                _encoder = SentenceEncoder()
+                logging.info(f"Эмбеддинги: модель {EMBEDDING_MODEL_NAME} на CPU")
+            except Exception as e:
+                logging.warning(f"Модель эмбеддингов недоступна ({e}), используется хэширующий векторизатор")
+        if _encoder is None and EMBEDDING_BACKEND != "off":
+            _encoder = HashingEncoder()
+            logging.info("Эмбеддинги: хэширующий векторизатор")
+        _encoder_loaded = True
+    return _encoder
+
+
+def summary_hash(summary):
+    return hashlib.md5(summary.encode('utf-8')).hexdigest()
+
+
+class VectorIndex:
+    """
+    Индекс нормированных векторов с поиском по косинусному сходству: HNSW (hnswlib),
+    если он установлен и индекс достаточно велик, иначе брутфорс умножением матриц.
+    """
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.keys = []
+        self.dates = []
+        self._positions = {}
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._hnsw = None
+        self._new_keys = []
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def vector(self, key):
+        position = self._positions.get(key)
+        return None if position is None else self._vectors[position]
+
+    def add(self, keys, vectors, dates, persist=True):
+        """Пакетное добавление: матрица расширяется одним копированием, позиции появляются после неё"""
+        fresh = []
+        seen = set()
+        for i, key in enumerate(keys):
+            if key not in self._positions and key not in seen:
+                seen.add(key)
+                fresh.append(i)
+        if not fresh:
+            return
+        start = len(self.keys)
+        new_vectors = np.asarray(vectors, dtype=np.float32)[fresh]
+        self._vectors = np.vstack([self._vectors, new_vectors])
+        for offset, i in enumerate(fresh):
+            self.keys.append(keys[i])
+            self.dates.append(dates[i])
+            self._positions[keys[i]] = start + offset
+            if persist:
+                self._new_keys.append(keys[i])
+        if self._hnsw is not None:
+            self._hnsw_add(new_vectors, range(start, start + len(fresh)))
+        elif hnswlib is not None and len(self) >= HNSW_MIN_ITEMS:
+            self._build_hnsw()
+
+    def _build_hnsw(self):
+        self._hnsw = hnswlib.Index(space="cosine", dim=self.dim)
+        self._hnsw.init_index(max_elements=max(2 * len(self.keys), 1024), ef_construction=200, M=16)
+        self._hnsw.set_ef(64)
+        self._hnsw_add(self._vectors, range(len(self.keys)))
+
+    def _hnsw_add(self, vectors, positions):
+        positions = list(positions)
+        needed = positions[-1] + 1 if positions else 0
+        if needed > self._hnsw.get_max_elements():
+            self._hnsw.resize_index(2 * needed)
+        self._hnsw.add_items(vectors, positions)
+
+    def prune(self, min_date):
+        """Удаление векторов старше окна: матрица и списки уплотняются, позиции и HNSW перестраиваются"""
+        kept = [position for position, date in enumerate(self.dates) if not (date and date < min_date)]
+        if len(kept) == len(self.keys):
+            return
+        self._vectors = self._vectors[kept]
+        self.keys = [self.keys[position] for position in kept]
+        self.dates = [self.dates[position] for position in kept]
+        self._positions = {key: position for position, key in enumerate(self.keys)}
+        self._hnsw = None
+        if hnswlib is not None and len(self) >= HNSW_MIN_ITEMS:
+            self._build_hnsw()
+
+    def query(self, vector, k=10, min_similarity=EMBEDDING_CANDIDATE_THRESHOLD):
+        """До k ближайших (key, косинусное сходство) не ниже min_similarity"""
+        if not self._positions:
+            return []
+        vector = np.asarray(vector, dtype=np.float32)
+        if self._hnsw is not None:
+            labels, distances = self._hnsw.knn_query(vector, k=min(k, len(self)))
+            candidates = [(int(label), 1.0 - float(distance)) for label, distance in zip(labels[0], distances[0])]
+        else:
+            scores = self._vectors @ vector
+            top = np.argsort(-scores)[:k]
+            candidates = [(int(position), float(scores[position])) for position in top]
+        return [(self.keys[position], similarity) for position, similarity in candidates if similarity >= min_similarity]
+
+    def collect_new_rows(self, bank, backend):
+        keys, self._new_keys = self._new_keys, []
+        return [
+            (bank, key, backend, self._vectors[self._positions[key]].tobytes(), self.dates[self._positions[key]])
+            for key in keys if key in self._positions
+        ]
+
+
+def _window_start(window_days=EMBEDDING_WINDOW_DAYS):
+    return (datetime.now() - timedelta(days=window_days)).strftime("%Y-%m-%d")
+
+
+EMBEDDINGS_QUERY = register_query(
+    "embeddings_by_bank",
+    "SELECT summary_hash, vector, item_date FROM news_embeddings WHERE bank = ? AND backend = ? AND item_date >= ?"
+)
+SIMILAR_NEWS_QUERY = register_query("analyzed_news_by_hashes", '''
+    SELECT summary_hash, summary, date, link FROM analyzed_news
+    WHERE bank = ? AND summary_hash IN ({placeholders})
+    GROUP BY summary_hash
+''')
+
+
+def load_embedding_index(bank, encoder, db_path='news.db', window_days=EMBEDDING_WINDOW_DAYS):
+    """Загрузка закэшированных векторов банка за окно"""
+    index = VectorIndex(encoder.dim)
+    try:
+        conn = sqlite3.connect(db_path, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute(sql_for(EMBEDDINGS_QUERY), (bank, encoder.name, _window_start(window_days)))
+        rows = cursor.fetchall()
+        if rows:
+            index.add(
+                [row[0] for row in rows],
+                np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in rows]),
+                [row[2] for row in rows],
+                persist=False
+            )
+        logging.info(f"Загружен индекс эмбеддингов для {bank}: {len(index)} векторов")
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка загрузки индекса эмбеддингов для {bank}: {e}")
+    finally:
+        if 'conn' in locals() and conn:
+            conn.close()
+    return index
+
+
+def get_embedding_index(bank):
+    """Индекс банка или None, если эмбеддинги отключены (вызывается под _indexes_lock)"""
+    encoder = get_encoder()
+    if encoder is None:
+        return None
+    index = _embedding_indexes.get(bank)
+    if index is None:
+        index = load_embedding_index(bank, encoder)
+        _embedding_indexes[bank] = index
+    return index
+
+
+def _event_day(news):
+    event_date = news.get("event_date") or news.get("date") or ""
+    if isinstance(event_date, datetime):
+        event_date = event_date.strftime("%Y-%m-%d")
+    return event_date[:10]
+
+
+def embed_summaries(news_list):
+    """
+    Векторы выжимок (матрица строк в порядке news_list) с кэшем по хэшу выжимки
+    в индексах банков; кодируются только новые выжимки. None, если эмбеддинги отключены.
+    Выполняется в потоке: кодирование моделью занимает CPU и идёт без блокировки,
+    индексы читаются и пополняются (одним пакетом на банк) под _indexes_lock.
+    """
+    encoder = get_encoder()
+    if encoder is None or not news_list:
+        return None
+    keys = [summary_hash(news.get("summary", "")) for news in news_list]
+    vectors = np.zeros((len(news_list), encoder.dim), dtype=np.float32)
+    missing = []
+    with _indexes_lock:
+        for position, (news, key) in enumerate(zip(news_list, keys)):
+            cached = get_embedding_index(news.get("bank", "")).vector(key)
+            if cached is not None:
+                vectors[position] = cached
+            else:
+                missing.append(position)
+    if missing:
+        encoded = encoder.encode([news_list[position].get("summary", "") for position in missing])
+        vectors[missing] = encoded
+        by_bank = defaultdict(list)
+        for offset, position in enumerate(missing):
+            by_bank[news_list[position].get("bank", "")].append((offset, position))
+        with _indexes_lock:
+            for bank, items in by_bank.items():
+                get_embedding_index(bank).add(
+                    [keys[position] for _, position in items],
+                    encoded[[offset for offset, _ in items]],
+                    [_event_day(news_list[position]) for _, position in items]
+                )
+    return vectors
+
+
+def collect_embedding_rows():
+    """Новые векторы всех индексов для сохранения через save_to_db_async(..., "news_embeddings")"""
+    encoder = get_encoder()
+    if encoder is None:
+        return []
+    min_date = _window_start()
+    rows = []
+    with _indexes_lock:
+        for bank, index in _embedding_indexes.items():
+            index.prune(min_date)
+            rows.extend(index.collect_new_rows(bank, encoder.name))
+    return [
+        {"bank": bank, "summary_hash": key, "backend": backend, "vector": vector, "item_date": item_date}
+        for bank, key, backend, vector, item_date in rows
+    ]
+
+
+def _nearest_summaries(bank, summary, k, min_similarity):
+    """Соседи выжимки в индексе банка [(summary_hash, сходство)]; выполняется в потоке (кодирование)"""
+    if get_encoder() is None:
+        return []
+    key = summary_hash(summary)
+    with _indexes_lock:
+        vector = get_embedding_index(bank).vector(key)
+    if vector is None:
+        vector = get_encoder().encode([summary])[0]
+    with _indexes_lock:
+        found = get_embedding_index(bank).query(vector, k=k + 1, min_similarity=min_similarity)
+    return [(other, score) for other, score in found if other != key][:k]
+
+
+async def find_similar_news(bank, summary, k=5, min_similarity=0.5):
+    """Похожие проанализированные новости банка: список словарей с summary, date, link и similarity"""
+    if not summary:
+        return []
+    neighbours = await asyncio.to_thread(_nearest_summaries, bank, summary, k, min_similarity)
+    if not neighbours:
+        return []
+    scores = dict(neighbours)
+    try:
+        rows = await fetchall(NEWS_DB, SIMILAR_NEWS_QUERY, [bank] + list(scores), placeholders=len(scores))
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка поиска похожих новостей для {bank}: {e}")
+        return []
+    similar = [{"summary": row[1], "date": row[2], "link": row[3], "similarity": scores[row[0]]} for row in rows]
+    similar.sort(key=lambda item: item["similarity"], reverse=True)
+    return similar
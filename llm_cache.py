@@ -0,0 +1,125 @@
+# llm_cache.py (двухуровневый кэш ответов LLM: LRU в памяти + индексированная таблица SQLite)
+
+import logging
+import sqlite3
+import sys
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from storage import fetchone, register_query, sql_for
+
+
+class TieredResponseCache:
+    """
+    Кэш ответов LLM с "горячим" LRU в памяти, ограниченным по байтам, и
+    холодным уровнем в SQLite. При промахе в памяти ответ лениво читается
+    из БД по первичному ключу, поэтому полная загрузка при старте не нужна.
+    Значения в БД хранятся сжатыми (zlib), ключи — md5 нормализованного промпта.
+    """
+
+    def __init__(self, db_path='news.db', table_name='gemini_cache', max_memory_bytes=64 * 1024 * 1024, ttl_hours=24):
+        self.db_path = db_path
+        self.table_name = table_name
+        self.max_memory_bytes = max_memory_bytes
+        self.ttl = timedelta(hours=ttl_hours)
+        self._hot = OrderedDict()  # key -> (response, timestamp, size)
+        self._hot_bytes = 0
+        self._pending = {}  # key -> (response, timestamp), ещё не записано в БД
+        self._query = register_query(
+            f"{table_name}_by_key", f"SELECT response, timestamp FROM {table_name} WHERE cache_key = ?", db_path
+        )
+        self._expire_query = register_query(f"expire_{table_name}", f"DELETE FROM {table_name} WHERE timestamp < ?", db_path)
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def __len__(self):
+        return len(self._hot)
+
+    @property
+    def memory_bytes(self):
+        return self._hot_bytes
+
+    @staticmethod
+    def _decode(raw):
+        # Старые записи хранились несжатым текстом
+        if isinstance(raw, bytes):
+            return zlib.decompress(raw).decode('utf-8')
+        return raw
+
+    def _is_fresh(self, ts, now=None):
+        return ((now or datetime.now()) - ts) < self.ttl
+
+    def _drop_hot(self, key):
+        entry = self._hot.pop(key, None)
+        if entry is not None:
+            self._hot_bytes -= entry[2]
+
+    def _store_hot(self, key, value, ts):
+        self._drop_hot(key)
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        self._hot[key] = (value, ts, size)
+        self._hot_bytes += size
+        while self._hot_bytes > self.max_memory_bytes and len(self._hot) > 1:
+            _, (_, _, evicted_size) = self._hot.popitem(last=False)
+            self._hot_bytes -= evicted_size
+
+    async def _load_from_disk(self, key):
+        try:
+            row = await fetchone(self.db_path, self._query, (key,))
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка чтения кэша LLM из БД: {e}")
+            return None
+        if not row:
+            return None
+        try:
+            return self._decode(row[0]), datetime.fromisoformat(row[1])
+        except (ValueError, TypeError, zlib.error) as e:
+            logging.warning(f"Повреждённая запись кэша LLM {key}: {e}")
+            return None
+
+    async def get(self, key):
+        """Ответ из кэша или None. Устаревшие записи считаются промахом; чтение БД — в пуле потоков."""
+        now = datetime.now()
+        entry = self._hot.get(key)
+        if entry is not None:
+            value, ts, _ = entry
+            if self._is_fresh(ts, now):
+                self._hot.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return value
+            self._drop_hot(key)
+        loaded = self._pending.get(key) or await self._load_from_disk(key)
+        if loaded is not None and self._is_fresh(loaded[1], now):
+            self._store_hot(key, loaded[0], loaded[1])
+            self.stats["disk_hits"] += 1
+            return loaded[0]
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key, value, timestamp=None):
+        ts = timestamp or datetime.now()
+        self._store_hot(key, value, ts)
+        self._pending[key] = (value, ts)
+
+    def collect_pending_rows(self):
+        """Снимок несохранённых записей (вызывается из event loop)."""
+        pending, self._pending = self._pending, {}
+        rows = [
+            (key, zlib.compress(value.encode('utf-8')), ts.isoformat())
+            for key, (value, ts) in pending.items()
+        ]
+        return pending, rows
+
+    def restore_pending(self, pending):
+        for key, entry in pending.items():
+            self._pending.setdefault(key, entry)
+
+    def write_rows_to(self, cursor, rows):
+        """UPSERT новых записей и удаление устаревших по TTL на переданном курсоре (операция писателя БД)."""
+        cutoff = (datetime.now() - self.ttl).isoformat()
+        if rows:
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO {self.table_name} (cache_key, response, timestamp) VALUES (?, ?, ?)",
+                rows
+            )
+        cursor.execute(sql_for(self._expire_query), (cutoff,))
@@ -0,0 +1,439 @@
+# llm_control.py (управление запросами к LLM: token bucket + AIMD, приоритетные полосы)
+
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+
+def parse_retry_after(value):
+    """Заголовок Retry-After в секундах (число секунд или HTTP-дата), None если не задан"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+async def coalesce_request(inflight, key, request, stats=None):
+    """
+    Одинаковые одновременные запросы ждут один результат. inflight — словарь
+    key -> asyncio.Future выполняющихся запросов, request — фабрика корутины запроса.
+    Отмена владельца не отменяет присоединившихся: первый из них выполняет запрос
+    сам, остальные присоединяются к нему.
+    """
+    while (future := inflight.get(key)) is not None:
+        if stats is not None:
+            stats["coalesced"] += 1
+        logging.debug(f"Запрос к LLM объединён с уже выполняющимся ({key[:8]})")
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Отменён сам ожидающий, а не владелец запроса
+            if not future.cancelled() or asyncio.current_task().cancelling():
+                raise
+
+    future = asyncio.get_running_loop().create_future()
+    # Исключение помечается полученным, даже если других ожидающих нет
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    inflight[key] = future
+    try:
+        if stats is not None:
+            stats["sent"] += 1
+        result = await request()
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        # Ожидающие просыпаются и повторяют запрос без отменённого владельца
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        if inflight.get(key) is future:
+            del inflight[key]
+
+
+class LLMRateController:
+    """
+    Ограничитель запросов к LLM: token bucket задаёт скорость (запросов в секунду),
+    отдельный лимит — число одновременных запросов. Скорость подстраивается по AIMD:
+    каждая успешная секунда трафика добавляет additive_step к скорости, 429/5xx
+    умножают её на decrease_factor (не чаще раза в decrease_window секунд).
+    Retry-After останавливает выдачу разрешений до указанного момента.
+    """
+
+    def __init__(self, initial_rate=3.0, min_rate=0.2, max_rate=20.0, max_concurrency=10,
+                 additive_step=0.2, decrease_factor=0.5, decrease_window=2.0, burst=None):
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.additive_step = additive_step
+        self.decrease_factor = decrease_factor
+        self.decrease_window = decrease_window
+        self.burst = burst or max(1.0, float(max_concurrency))
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        self._cooldown_until = 0.0
+        self._in_flight = 0
+        self._queue_depth = 0
+        self._cond = asyncio.Condition()
+        self.stats = {"granted": 0, "success": 0, "throttled": 0, "decreases": 0}
+
+    # --- Текущее состояние ---
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def queue_depth(self):
+        return self._queue_depth
+
+    def snapshot(self):
+        return {
+            "rate": round(self.rate, 3),
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self._in_flight,
+            "queue_depth": self._queue_depth,
+            "cooldown": max(0.0, round(self._cooldown_until - time.monotonic(), 1)),
+            **self.stats,
+        }
+
+    # --- Выдача разрешений ---
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+
+    def try_acquire(self):
+        """Неблокирующая попытка: None, если разрешение выдано, иначе сколько секунд стоит подождать"""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self._cooldown_until:
+            return self._cooldown_until - now
+        if self._in_flight >= self.max_concurrency:
+            # Разбудит release()
+            return 1.0
+        if self._tokens < 1.0:
+            return (1.0 - self._tokens) / self.rate
+        self._tokens -= 1.0
+        self._in_flight += 1
+        self.stats["granted"] += 1
+        return None
+
+    async def acquire(self):
+        self._queue_depth += 1
+        try:
+            async with self._cond:
+                while True:
+                    delay = self.try_acquire()
+                    if delay is None:
+                        return self
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout=max(delay, 0.01))
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self._queue_depth -= 1
+
+    def release_nowait(self):
+        self._in_flight -= 1
+
+    async def release(self, grant=None):
+        async with self._cond:
+            self.release_nowait()
+            self._cond.notify()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+    # --- Обратная связь от ответов сервера ---
+    def record_success(self):
+        self.stats["success"] += 1
+        # +additive_step за каждую секунду успешного трафика при текущей скорости
+        self.rate = min(self.max_rate, self.rate + self.additive_step / max(self.rate, 1.0))
+
+    def record_throttle(self, retry_after=None):
+        """429 или 5xx: мультипликативное снижение скорости и учёт Retry-After"""
+        now = time.monotonic()
+        self.stats["throttled"] += 1
+        if retry_after:
+            self._cooldown_until = max(self._cooldown_until, now + retry_after)
+            self._tokens = 0.0
+        # Пачка одновременных 429 снижает скорость один раз
+        if now - self._last_decrease >= self.decrease_window:
+            self._last_decrease = now
+            old_rate = self.rate
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self.stats["decreases"] += 1
+            logging.warning(
+                f"LLM: скорость снижена {old_rate:.2f} -> {self.rate:.2f} запр/с"
+                f"{f', пауза {retry_after:.1f} сек по Retry-After' if retry_after else ''}"
+            )
+
+
+# --- Пул эндпоинтов / ключей LLM ---
+class LLMEndpoint:
+    """Один эндпоинт (URL + ключ) со своим ограничителем скорости и метриками"""
+
+    def __init__(self, url, api_key, weight=1.0, name=None, **controller_kwargs):
+        self.url = url
+        self.api_key = api_key
+        self.weight = weight
+        self.name = name or url
+        self.controller = LLMRateController(**controller_kwargs)
+        self.consecutive_errors = 0
+        self.ejected_until = 0.0
+        self.stats = {"requests": 0, "success": 0, "errors": 0, "throttled": 0, "ejections": 0}
+
+    @property
+    def load(self):
+        """Доля занятой ёмкости с учётом веса (меньше — свободнее)"""
+        return self.controller.in_flight / (self.controller.max_concurrency * self.weight)
+
+    def is_ejected(self, now=None):
+        return (now or time.monotonic()) < self.ejected_until
+
+    def record_success(self):
+        self.stats["success"] += 1
+        self.consecutive_errors = 0
+        self.controller.record_success()
+
+    def record_throttle(self, retry_after=None):
+        self.stats["throttled"] += 1
+        self.controller.record_throttle(retry_after)
+
+    def record_error(self, eject_after, eject_seconds):
+        """5xx, таймауты, сетевые ошибки и отказ в авторизации; после серии ошибок эндпоинт исключается"""
+        self.stats["errors"] += 1
+        self.consecutive_errors += 1
+        if self.consecutive_errors >= eject_after:
+            self.ejected_until = time.monotonic() + eject_seconds
+            self.consecutive_errors = 0
+            self.stats["ejections"] += 1
+            logging.warning(f"LLM-эндпоинт {self.name} исключён из пула на {eject_seconds} сек после серии ошибок")
+
+    def snapshot(self):
+        return {
+            "ejected": self.is_ejected(),
+            **self.controller.snapshot(),
+            **{f"endpoint_{key}": value for key, value in self.stats.items()},
+        }
+
+
+class LLMEndpointPool:
+    """
+    Пул эндпоинтов LLM с тем же интерфейсом, что и LLMRateController (acquire/release/snapshot).
+    Разрешение выдаёт наименее загруженный (с учётом веса) неисключённый эндпоинт,
+    у которого есть свободный токен. Если исключены все, используются и исключённые.
+    """
+
+    def __init__(self, endpoints, eject_after=5, eject_seconds=60):
+        if not endpoints:
+            raise ValueError("Пул LLM-эндпоинтов пуст")
+        self.endpoints = list(endpoints)
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self._queue_depth = 0
+        self._cond = asyncio.Condition()
+
+    @classmethod
+    def from_config(cls, endpoint_configs, **controller_kwargs):
+        """endpoint_configs: список словарей {"url", "api_key", "weight", "name", "initial_rate", "max_concurrency"}"""
+        endpoints = []
+        for i, cfg in enumerate(endpoint_configs):
+            kwargs = dict(controller_kwargs)
+            for key in ("initial_rate", "max_rate", "max_concurrency"):
+                if key in cfg:
+                    kwargs[key] = cfg[key]
+            endpoints.append(LLMEndpoint(
+                cfg["url"], cfg["api_key"], weight=cfg.get("weight", 1.0),
+                name=cfg.get("name", f"endpoint_{i}"), **kwargs
+            ))
+        return cls(endpoints)
+
+    @property
+    def queue_depth(self):
+        return self._queue_depth
+
+    def _try_take(self):
+        now = time.monotonic()
+        candidates = [e for e in self.endpoints if not e.is_ejected(now)] or self.endpoints
+        min_delay = None
+        for endpoint in sorted(candidates, key=lambda e: e.load):
+            delay = endpoint.controller.try_acquire()
+            if delay is None:
+                endpoint.stats["requests"] += 1
+                return endpoint, None
+            min_delay = delay if min_delay is None else min(min_delay, delay)
+        return None, min_delay
+
+    async def acquire(self):
+        self._queue_depth += 1
+        try:
+            async with self._cond:
+                while True:
+                    endpoint, delay = self._try_take()
+                    if endpoint is not None:
+                        return endpoint
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout=max(delay, 0.01))
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self._queue_depth -= 1
+
+    async def release(self, endpoint):
+        async with self._cond:
+            endpoint.controller.release_nowait()
+            self._cond.notify()
+
+    def record_error(self, endpoint):
+        endpoint.record_error(self.eject_after, self.eject_seconds)
+
+    def snapshot(self):
+        return {
+            "queue_depth": self._queue_depth,
+            "total_rate": round(sum(e.controller.rate for e in self.endpoints if not e.is_ejected()), 3),
+            "endpoints": {e.name: e.snapshot() for e in self.endpoints},
+        }
+
+
+# --- Приоритеты LLM-запросов ---
+# Веса полос для взвешенной справедливой очереди
+LLM_LANE_WEIGHTS = {"interactive": 8, "dedup": 3, "background": 1}
+
+# Полоса текущей задачи; наследуется задачами, созданными через gather/create_task
+LLM_PRIORITY = contextvars.ContextVar("llm_priority", default="interactive")
+
+
+@contextmanager
+def llm_priority(lane):
+    """Выполнение блока с заданной полосой приоритета LLM-запросов"""
+    token = LLM_PRIORITY.set(lane)
+    try:
+        yield
+    finally:
+        LLM_PRIORITY.reset(token)
+
+
+class LLMPriorityDispatcher:
+    """
+    Диспетчер разрешений ограничителя между полосами interactive / dedup / background.
+    Разрешение выдаётся в момент, когда ограничитель готов пропустить запрос, полосе
+    с минимальным виртуальным временем завершения (WFQ). Пока есть ожидающие
+    интерактивные запросы, ещё не начатые фоновые не обслуживаются, если только
+    они не ждут дольше background_max_wait секунд.
+    """
+
+    def __init__(self, controller, weights=None, background_max_wait=120.0):
+        self.controller = controller
+        self.weights = dict(weights or LLM_LANE_WEIGHTS)
+        self.background_max_wait = background_max_wait
+        self._queues = {lane: deque() for lane in self.weights}  # lane -> deque[(enqueued_at, future)]
+        self._finish = {lane: 0.0 for lane in self.weights}
+        self._virtual_time = 0.0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.stats = {lane: {"granted": 0, "wait_total": 0.0, "preempted": 0} for lane in self.weights}
+
+    def queue_depths(self):
+        return {lane: sum(1 for _, f in queue if not f.done()) for lane, queue in self._queues.items()}
+
+    def snapshot(self):
+        lanes = {}
+        for lane, lane_stats in self.stats.items():
+            granted = lane_stats["granted"]
+            lanes[lane] = {
+                "queued": self.queue_depths()[lane],
+                "granted": granted,
+                "avg_wait": round(lane_stats["wait_total"] / granted, 2) if granted else 0.0,
+                "preempted": lane_stats["preempted"],
+            }
+        return {"controller": self.controller.snapshot(), "lanes": lanes}
+
+    def _has_waiters(self, lane):
+        queue = self._queues[lane]
+        while queue and queue[0][1].done():
+            queue.popleft()
+        return bool(queue)
+
+    def _pick_lane(self):
+        candidates = [lane for lane in self._queues if self._has_waiters(lane)]
+        if not candidates:
+            return None
+        if "background" in candidates and "interactive" in candidates:
+            oldest_background = self._queues["background"][0][0]
+            if time.monotonic() - oldest_background < self.background_max_wait:
+                candidates.remove("background")
+                self.stats["background"]["preempted"] += 1
+        lane = min(
+            candidates,
+            key=lambda l: max(self._finish[l], self._virtual_time) + 1.0 / self.weights[l]
+        )
+        start = max(self._finish[lane], self._virtual_time)
+        self._finish[lane] = start + 1.0 / self.weights[lane]
+        self._virtual_time = start
+        return lane
+
+    async def _run(self):
+        while True:
+            if not any(self._has_waiters(lane) for lane in self._queues):
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            grant = await self.controller.acquire()
+            lane = self._pick_lane()
+            if lane is None:
+                await self.controller.release(grant)
+                continue
+            enqueued_at, future = self._queues[lane].popleft()
+            future.set_result(grant)
+            self.stats[lane]["granted"] += 1
+            self.stats[lane]["wait_total"] += time.monotonic() - enqueued_at
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    @asynccontextmanager
+    async def slot(self, lane=None):
+        """
+        Разрешение ограничителя для одного HTTP-запроса в полосе lane (по умолчанию — из LLM_PRIORITY).
+        Возвращает то, что выдал ограничитель (для пула — выбранный эндпоинт).
+        """
+        lane = lane or LLM_PRIORITY.get()
+        if lane not in self._queues:
+            lane = "interactive"
+        self._ensure_running()
+        future = asyncio.get_running_loop().create_future()
+        self._queues[lane].append((time.monotonic(), future))
+        self._wakeup.set()
+        try:
+            grant = await future
+        except asyncio.CancelledError:
+            # Отмена могла прийти уже после выдачи разрешения
+            if future.done() and not future.cancelled():
+                await self.controller.release(future.result())
+            raise
+        try:
+            yield grant
+        finally:
+            await self.controller.release(grant)
@@ -5,8 +5,11 @@ import logging
 from datetime import datetime, timedelta
 import pytz
 from config import *
-from news_analyzer import analyze_all_news, deduplicate_in_parallel, is_duplicate, calculate_informativeness
-from utils import normalize_text_for_aliases, DB_WRITE_LOCK
+from news_analyzer import analyze_all_news, deduplicate_in_parallel, is_duplicate, calculate_informativeness, representative_rank
+from dedup_index import DuplicateClusterIndex
+from utils import normalize_text_for_aliases, create_entity_table, entity_rows, save_entity_rows, parse_entities
+from llm_control import LLM_PRIORITY
+from storage import MONITORING_DB, enable_wal, write, execute as storage_execute, fetchall, fetchone, register_query, query_stats_report, create_indexes, sql_for, check_query_plans
 from aiogram import Bot
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import aiohttp
@@ -48,10 +51,21 @@ BATCH_SIZE = 10
 DELAY_BETWEEN_BANKS = 2
 DELAY_BETWEEN_BATCHES = 15
 ACTIVE_SUBSCRIPTION_DAYS = 30
+DEDUP_HISTORY_DAYS = 30                  # Окно кластеров дубликатов для сравнения новых новостей
+
+# Составные и покрывающие индексы под запросы мониторинга: (имя, таблица, столбцы)
+MONITORING_INDEXES = [
+    ("idx_subscriptions_bank_chat", "subscriptions", ("bank_name", "chat_id")),
+    ("idx_subscriptions_created_bank", "subscriptions", ("created_at", "bank_name")),
+    ("idx_subscriptions_notified_bank", "subscriptions", ("last_notification", "bank_name")),
+    ("idx_analyzed_monitored_bank_created", "analyzed_monitored_news", ("bank_name", "created_at")),
+    ("idx_analyzed_monitored_bank_hash", "analyzed_monitored_news", ("bank_name", "summary_hash")),
+]
 
 # Инициализация базы данных
 def init_monitoring_db():
     try:
+        enable_wal(MONITORING_DB)
         conn = sqlite3.connect('monitoring.db')
         cursor = conn.cursor()
         cursor.execute('''
@@ -100,6 +114,30 @@ def init_monitoring_db():
                 UNIQUE (link, bank_name)
             )
         ''')
+        # Кластеры дубликатов: узел — выжимка новости, cluster_id — корень union-find
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS dedup_clusters (
+                bank_name TEXT,
+                news_key TEXT,
+                cluster_id TEXT,
+                summary TEXT,
+                event_type TEXT,
+                event_date TEXT,
+                entities TEXT,
+                date TEXT,
+                source TEXT,
+                category TEXT,
+                informativeness INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (bank_name, news_key)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_dedup_clusters_created ON dedup_clusters (bank_name, created_at)")
+        # Решения по парам не хранятся: новость, уже попавшая в кластер, повторно не сравнивается (отсекается по ключу)
+        cursor.execute("DROP TABLE IF EXISTS dedup_verdicts")
+        # Сущности новостей мониторинга (поиск всех новостей по сущности)
+        create_entity_table(cursor)
+        create_indexes(cursor, MONITORING_INDEXES)
         conn.commit()
         logging.info("База данных monitoring.db инициализирована.")
     except sqlite3.Error as e:
@@ -107,171 +145,167 @@ def init_monitoring_db():
     finally:
         conn.close()
 
-# Асинхронное сохранение
+# Асинхронное сохранение через писателя monitoring.db
 async def save_to_monitoring_db_async(data, table_name="monitored_news"):
     if not data:
         return
-    async with DB_WRITE_LOCK:
-        try:
-            conn = sqlite3.connect('monitoring.db')
-            cursor = conn.cursor()
-            inserted_count = 0
-            if table_name == "monitored_news":
-                for item in data:
-                    cursor.execute('''
-                        INSERT OR IGNORE INTO monitored_news (bank_name, reg_number, text, date, link, source, topic, is_monitoring)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        item.get("bank", ""),
-                        item.get("reg_number", ""),
-                        item.get("text", ""),
-                        item.get("date", ""),
-                        item.get("link", ""),
-                        item.get("source", ""),
-                        item.get("topic", ""),
-                        1
-                    ))
-                    if cursor.rowcount > 0:
-                        inserted_count += 1
-            elif table_name == "analyzed_monitored_news":
-                for item in data:
-                    summary_hash = hashlib.md5(item.get("summary", "").encode('utf-8')).hexdigest()
-                    cursor.execute('''
-                        INSERT OR IGNORE INTO analyzed_monitored_news (
-                            bank_name, reg_number, text, summary, event_type, event_date,
-                            entities, date, link, source, category, sentiment, informativeness, summary_hash
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        item.get("bank", ""),
-                        item.get("reg_number", ""),
-                        item.get("text", ""),
-                        item.get("summary", ""),
-                        item.get("event_type", ""),
-                        item.get("event_date", "").strftime("%Y-%m-%d") if isinstance(item.get("event_date"), datetime) else item.get("event_date", ""),
-                        json.dumps(item.get("entities", [])),
-                        item.get("date", ""),
-                        item.get("link", ""),
-                        item.get("source", ""),
-                        item.get("category", ""),
-                        item.get("sentiment", ""),
-                        item.get("informativeness", 0),
-                        summary_hash
-                    ))
-                    if cursor.rowcount > 0:
-                        inserted_count += 1
-            conn.commit()
-            logging.info(f"Сохранено {inserted_count} новых уникальных записей в {table_name}")
-        except sqlite3.Error as e:
-            logging.error(f"Ошибка сохранения в {table_name}: {e}")
-        finally:
-            conn.close()
+
+    def operation(cursor):
+        if table_name == "monitored_news":
+            cursor.executemany('''
+                INSERT OR IGNORE INTO monitored_news (bank_name, reg_number, text, date, link, source, topic, is_monitoring)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [(
+                item.get("bank", ""),
+                item.get("reg_number", ""),
+                item.get("text", ""),
+                item.get("date", ""),
+                item.get("link", ""),
+                item.get("source", ""),
+                item.get("topic", ""),
+                1
+            ) for item in data])
+            return max(cursor.rowcount, 0)
+        inserted_count = 0
+        if table_name == "analyzed_monitored_news":
+            # Построчно: сущности сохраняются только для действительно вставленных новостей
+            for item in data:
+                summary_hash = hashlib.md5(item.get("summary", "").encode('utf-8')).hexdigest()
+                cursor.execute('''
+                    INSERT OR IGNORE INTO analyzed_monitored_news (
+                        bank_name, reg_number, text, summary, event_type, event_date,
+                        entities, date, link, source, category, sentiment, informativeness, summary_hash
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    item.get("bank", ""),
+                    item.get("reg_number", ""),
+                    item.get("text", ""),
+                    item.get("summary", ""),
+                    item.get("event_type", ""),
+                    item.get("event_date", "").strftime("%Y-%m-%d") if isinstance(item.get("event_date"), datetime) else item.get("event_date", ""),
+                    json.dumps(item.get("entities", [])),
+                    item.get("date", ""),
+                    item.get("link", ""),
+                    item.get("source", ""),
+                    item.get("category", ""),
+                    item.get("sentiment", ""),
+                    item.get("informativeness", 0),
+                    summary_hash
+                ))
+                if cursor.rowcount > 0:
+                    inserted_count += 1
+                    save_entity_rows(cursor, entity_rows(item.get("bank", ""), summary_hash, item.get("entities", []), item.get("event_date", "")))
+        return inserted_count
+
+    try:
+        inserted_count = await write(MONITORING_DB, operation)
+        logging.info(f"Сохранено {inserted_count} новых уникальных записей в {table_name}")
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка сохранения в {table_name}: {e}")
 
 # Управление подписками
-def add_subscription(chat_id, bank_name):
+async def add_subscription(chat_id, bank_name):
+    reg_number = BANKS.get(bank_name, {}).get("reg_number", bank_name)
     try:
-        conn = sqlite3.connect('monitoring.db')
-        cursor = conn.cursor()
-        reg_number = BANKS.get(bank_name, {}).get("reg_number", bank_name)
-        cursor.execute('''
+        await storage_execute(MONITORING_DB, '''
             INSERT OR IGNORE INTO subscriptions (chat_id, bank_name, reg_number, last_notification)
             VALUES (?, ?, ?, '1970-01-01 00:00:00')
         ''', (chat_id, bank_name, reg_number))
-        conn.commit()
         logging.info(f"Подписка добавлена: chat_id={chat_id}, bank={bank_name}.")
     except sqlite3.Error as e:
         logging.error(f"Ошибка добавления подписки: {e}")
-    finally:
-        conn.close()
 
-def remove_subscription(chat_id, bank_name):
+async def remove_subscription(chat_id, bank_name):
     try:
-        conn = sqlite3.connect('monitoring.db')
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM subscriptions WHERE chat_id = ? AND bank_name = ?', (chat_id, bank_name))
-        conn.commit()
+        await storage_execute(MONITORING_DB, 'DELETE FROM subscriptions WHERE chat_id = ? AND bank_name = ?', (chat_id, bank_name))
         logging.info(f"Подписка удалена: chat_id={chat_id}, bank={bank_name}")
     except sqlite3.Error as e:
         logging.error(f"Ошибка удаления подписки: {e}")
-    finally:
-        conn.close()
 
-def get_user_subscriptions(chat_id):
+USER_SUBSCRIPTIONS_QUERY = register_query(
+    "user_subscriptions", 'SELECT bank_name, reg_number FROM subscriptions WHERE chat_id = ?', MONITORING_DB
+)
+BANK_SUBSCRIBERS_QUERY = register_query(
+    "bank_subscribers", 'SELECT chat_id FROM subscriptions WHERE bank_name = ?', MONITORING_DB
+)
+ALL_SUBSCRIPTIONS_QUERY = register_query(
+    "all_subscriptions", 'SELECT chat_id, bank_name FROM subscriptions', MONITORING_DB
+)
+# UNION вместо OR: каждая ветка — диапазон по своему покрывающему индексу
+ACTIVE_BANKS_QUERY = register_query("active_banks", '''
+    SELECT bank_name FROM subscriptions WHERE created_at >= ?
+    UNION
+    SELECT bank_name FROM subscriptions WHERE last_notification >= ?
+''', MONITORING_DB)
+LAST_NOTIFICATION_QUERY = register_query(
+    "last_notification", 'SELECT last_notification FROM subscriptions WHERE chat_id = ? LIMIT 1', MONITORING_DB
+)
+NEW_MONITORED_NEWS_QUERY = register_query("new_monitored_news", '''
+    SELECT bank_name, reg_number, text, summary, event_type, event_date, entities, 
+           date, link, source, category, sentiment, informativeness
+    FROM analyzed_monitored_news
+    WHERE bank_name IN ({placeholders}) AND created_at > ?
+    ORDER BY created_at DESC
+''', MONITORING_DB)
+MONITORED_NEWS_QUERY = register_query("monitored_news_by_banks", '''
+    SELECT bank_name, reg_number, text, summary, event_type, event_date, entities, 
+           date, link, source, category, sentiment, informativeness
+    FROM analyzed_monitored_news
+    WHERE bank_name IN ({placeholders})
+    ORDER BY created_at DESC
+''', MONITORING_DB)
+MONITORED_ARCHIVE_QUERY = register_query("monitored_news_archive", '''
+    SELECT bank_name, reg_number, text, summary, event_type, event_date, entities, 
+           date, link, source, category, sentiment, informativeness
+    FROM analyzed_monitored_news
+    WHERE bank_name IN ({placeholders})
+    ORDER BY created_at DESC
+    LIMIT 100
+''', MONITORING_DB)
+
+async def get_user_subscriptions(chat_id):
     try:
-        conn = sqlite3.connect('monitoring.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT bank_name, reg_number FROM subscriptions WHERE chat_id = ?', (chat_id,))
-        return cursor.fetchall()
+        return await fetchall(MONITORING_DB, USER_SUBSCRIPTIONS_QUERY, (chat_id,))
     except sqlite3.Error as e:
         logging.error(f"Ошибка чтения подписок для chat_id {chat_id}: {e}")
         return []
-    finally:
-        conn.close()
 
-def get_user_subscriptions_by_bank(bank_name):
+async def get_user_subscriptions_by_bank(bank_name):
     try:
-        conn = sqlite3.connect('monitoring.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT chat_id FROM subscriptions WHERE bank_name = ?', (bank_name,))
-        rows = cursor.fetchall()
+        rows = await fetchall(MONITORING_DB, BANK_SUBSCRIBERS_QUERY, (bank_name,))
         return [row[0] for row in rows]
     except sqlite3.Error as e:
         logging.error(f"Ошибка чтения подписок для {bank_name}: {e}")
         return []
-    finally:
-        conn.close()
 
-def get_all_subscriptions():
+async def get_all_subscriptions():
     try:
-        conn = sqlite3.connect('monitoring.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT chat_id, bank_name FROM subscriptions')
-        return cursor.fetchall()
+        return await fetchall(MONITORING_DB, ALL_SUBSCRIPTIONS_QUERY)
     except sqlite3.Error as e:
         logging.error(f"Ошибка чтения всех подписок: {e}")
         return []
-    finally:
-        conn.close()
 
-def get_active_banks(days=ACTIVE_SUBSCRIPTION_DAYS):
+async def get_active_banks(days=ACTIVE_SUBSCRIPTION_DAYS):
     try:
-        conn = sqlite3.connect('monitoring.db')
-        cursor = conn.cursor()
         cutoff_date = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute('''
-            SELECT DISTINCT bank_name 
-            FROM subscriptions 
-            WHERE created_at >= ? OR last_notification >= ?
-        ''', (cutoff_date, cutoff_date))
-        banks = [row[0] for row in cursor.fetchall()]
+        rows = await fetchall(MONITORING_DB, ACTIVE_BANKS_QUERY, (cutoff_date, cutoff_date))
+        banks = [row[0] for row in rows]
         logging.info(f"Найдено {len(banks)} активных банков для мониторинга (за последние {days} дней)")
         return banks
     except sqlite3.Error as e:
         logging.error(f"Ошибка получения активных банков: {e}")
         return []
-    finally:
-        conn.close()
 
-def get_new_analyzed_news(chat_id):
-    conn = None
+async def get_new_analyzed_news(chat_id):
     try:
-        conn = sqlite3.connect('monitoring.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT bank_name FROM subscriptions WHERE chat_id = ?', (chat_id,))
-        banks = [row[0] for row in cursor.fetchall()]
+        banks = [row[0] for row in await fetchall(MONITORING_DB, USER_SUBSCRIPTIONS_QUERY, (chat_id,))]
         if not banks:
             return []
-        cursor.execute('SELECT last_notification FROM subscriptions WHERE chat_id = ? LIMIT 1', (chat_id,))
-        last_notif_row = cursor.fetchone()
+        last_notif_row = await fetchone(MONITORING_DB, LAST_NOTIFICATION_QUERY, (chat_id,))
         last_notification = last_notif_row[0] if last_notif_row else '1970-01-01 00:00:00'
-        placeholders = ','.join(['?'] * len(banks))
-        cursor.execute(f'''
-            SELECT bank_name, reg_number, text, summary, event_type, event_date, entities, 
-                   date, link, source, category, sentiment, informativeness
-            FROM analyzed_monitored_news
-            WHERE bank_name IN ({placeholders}) AND created_at > ?
-            ORDER BY created_at DESC
-        ''', banks + [last_notification])
-        rows = cursor.fetchall()
+        rows = await fetchall(
+            MONITORING_DB, NEW_MONITORED_NEWS_QUERY, banks + [last_notification], placeholders=len(banks)
+        )
         news_list = []
         for row in rows:
             news_item = {
@@ -295,20 +329,12 @@ def get_new_analyzed_news(chat_id):
     except sqlite3.Error as e:
         logging.error(f"Ошибка при получении новых новостей для chat_id {chat_id}: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
-def update_last_notification(chat_id):
+async def update_last_notification(chat_id):
     try:
-        conn = sqlite3.connect('monitoring.db')
-        cursor = conn.cursor()
-        cursor.execute('UPDATE subscriptions SET last_notification = CURRENT_TIMESTAMP WHERE chat_id = ?', (chat_id,))
-        conn.commit()
+        await storage_execute(MONITORING_DB, 'UPDATE subscriptions SET last_notification = CURRENT_TIMESTAMP WHERE chat_id = ?', (chat_id,))
     except sqlite3.Error as e:
         logging.error(f"Ошибка обновления last_notification для {chat_id}: {e}")
-    finally:
-        conn.close()
 
 # === ФУНКЦИИ ПАРСИНГА ===
 async def fetch_1000bankov_news_monitoring(bank_name, date_from, date_to):
@@ -604,34 +630,189 @@ def is_bank_name_match(text, aliases):
             return True
     return False
 
-def is_news_already_in_db(link, bank_name, table_name="analyzed_monitored_news"):
+# Ограничение числа параметров в одном запросе SQLite
+KNOWN_LINKS_CHUNK = 500
+
+KNOWN_LINKS_QUERIES = {
+    table_name: register_query(
+        f"known_links_{table_name}",
+        f'SELECT link FROM {table_name} WHERE bank_name = ? AND link IN ({{placeholders}})',
+        MONITORING_DB
+    )
+    for table_name in ("monitored_news", "analyzed_monitored_news")
+}
+
+async def get_known_links(links, bank_name, table_name="analyzed_monitored_news"):
+    """Ссылки из списка, уже сохранённые для банка: один запрос на пачку вместо запроса на каждую новость"""
+    links = list({link for link in links if link})
+    known = set()
     try:
-        conn = sqlite3.connect('monitoring.db')
-        cursor = conn.cursor()
-        cursor.execute(f'SELECT 1 FROM {table_name} WHERE link = ? AND bank_name = ? LIMIT 1', (link, bank_name))
-        return cursor.fetchone() is not None
+        for start in range(0, len(links), KNOWN_LINKS_CHUNK):
+            chunk = links[start:start + KNOWN_LINKS_CHUNK]
+            rows = await fetchall(MONITORING_DB, KNOWN_LINKS_QUERIES[table_name], [bank_name] + chunk, placeholders=len(chunk))
+            known.update(row[0] for row in rows)
     except sqlite3.Error as e:
-        logging.error(f"Ошибка проверки дубликата для link={link}, bank={bank_name}: {e}")
-        return False
-    finally:
-        conn.close()
+        logging.error(f"Ошибка проверки дубликатов ссылок для bank={bank_name}: {e}")
+    return known
+
+EXISTING_SUMMARIES_QUERY = register_query("existing_monitored_summaries", '''
+    SELECT summary, date, event_type, event_date, entities, category, source, informativeness FROM analyzed_monitored_news 
+    WHERE bank_name = ? AND created_at > ?
+''', MONITORING_DB)
 
-def get_existing_analyzed_summaries(bank_name, days=30):
+async def get_existing_analyzed_summaries(bank_name, days=DEDUP_HISTORY_DAYS):
     last_date = datetime.now() - timedelta(days=days)
     try:
-        conn = sqlite3.connect('monitoring.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT summary, date, event_type, entities, category FROM analyzed_monitored_news 
-            WHERE bank_name = ? AND created_at > ?
-        ''', (bank_name, last_date.strftime("%Y-%m-%d %H:%M:%S")))
-        rows = cursor.fetchall()
-        return [(row[0], row[1], row[2], row[3], row[4]) for row in rows]
-    except sqlite3.Error as e:
+        rows = await fetchall(MONITORING_DB, EXISTING_SUMMARIES_QUERY, (bank_name, last_date.strftime("%Y-%m-%d %H:%M:%S")))
+        return [{
+            "bank": bank_name,
+            "summary": row[0] or "",
+            "date": row[1] or "",
+            "event_type": row[2] or "",
+            "event_date": row[3] or row[1] or "",
+            "entities": json.loads(row[4]) if row[4] else [],
+            "category": row[5] or "Обычная",
+            "source": row[6] or "database",
+            "informativeness": row[7] if row[7] is not None else calculate_informativeness(row[0] or "")
+        } for row in rows]
+    except (sqlite3.Error, ValueError) as e:
         logging.error(f"Ошибка чтения существующих summaries для {bank_name}: {e}")
         return []
-    finally:
-        conn.close()
+
+def news_key(news):
+    return hashlib.md5(news.get("summary", "").encode('utf-8')).hexdigest()
+
+EXPIRE_CLUSTERS_QUERY = register_query(
+    "expire_dedup_clusters", 'DELETE FROM dedup_clusters WHERE bank_name = ? AND created_at <= ?', MONITORING_DB
+)
+CLUSTERS_QUERY = register_query("dedup_clusters_by_bank", '''
+    SELECT news_key, cluster_id, summary, event_type, event_date, entities, date, source, category, informativeness
+    FROM dedup_clusters WHERE bank_name = ?
+''', MONITORING_DB)
+
+async def load_duplicate_clusters(bank_name, days=DEDUP_HISTORY_DAYS, exclude_keys=()):
+    """
+    Загрузка кластеров дубликатов банка за окно. При первом запуске индекс
+    заполняется проанализированными новостями мониторинга (каждая — свой кластер),
+    кроме exclude_keys — новостей текущей итерации, уже записанных анализом.
+    """
+    index = DuplicateClusterIndex(rank=representative_rank)
+    cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    nodes = []
+
+    # Устаревшие узлы удаляются через очередь писателя БД
+    def expire(cursor):
+        cursor.execute(sql_for(EXPIRE_CLUSTERS_QUERY), (bank_name, cutoff))
+
+    try:
+        await write(MONITORING_DB, expire)
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка удаления устаревших кластеров дубликатов для {bank_name}: {e}")
+    try:
+        for row in await fetchall(MONITORING_DB, CLUSTERS_QUERY, (bank_name,)):
+            nodes.append((row[0], row[1], {
+                "bank": bank_name,
+                "summary": row[2] or "",
+                "event_type": row[3] or "",
+                "event_date": row[4] or "",
+                "entities": json.loads(row[5]) if row[5] else [],
+                "date": row[6] or "",
+                "source": row[7] or "database",
+                "category": row[8] or "Обычная",
+                "informativeness": row[9] or 0
+            }))
+    except (sqlite3.Error, ValueError) as e:
+        logging.error(f"Ошибка загрузки кластеров дубликатов для {bank_name}: {e}")
+    if nodes:
+        index.restore(nodes)
+    else:
+        for news in await get_existing_analyzed_summaries(bank_name, days):
+            key = news_key(news)
+            if key not in exclude_keys:
+                index.add(key, news)
+    logging.info(f"Кластеры дубликатов {bank_name}: {len(index)} новостей в {len(index.members)} кластерах")
+    return index
+
+async def save_duplicate_clusters(bank_name, index):
+    """Сохранение изменённых узлов кластеров"""
+    nodes = index.collect_dirty()
+    if not nodes:
+        return
+
+    def operation(cursor):
+        cursor.executemany('''
+            INSERT INTO dedup_clusters (
+                bank_name, news_key, cluster_id, summary, event_type, event_date, entities, date, source, category, informativeness
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(bank_name, news_key) DO UPDATE SET cluster_id = excluded.cluster_id
+        ''', [(
+            bank_name, key, root,
+            item.get("summary", ""),
+            item.get("event_type", ""),
+            item["event_date"].strftime("%Y-%m-%d") if isinstance(item.get("event_date"), datetime) else item.get("event_date", ""),
+            json.dumps(item.get("entities", []), ensure_ascii=False),
+            item.get("date", ""),
+            item.get("source", ""),
+            item.get("category", ""),
+            item.get("informativeness", 0)
+        ) for key, root, item in nodes])
+
+    try:
+        await write(MONITORING_DB, operation)
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка сохранения кластеров дубликатов для {bank_name}: {e}")
+
+async def deduplicate_against_clusters(bank_name, analyzed_news):
+    """
+    Инкрементальная дедубликация мониторинга: новые новости сравниваются только
+    с представителями кластеров за окно и между собой. Возвращает новые события —
+    новости, не примкнувшие ни к одному существующему кластеру (лучшая из кластера новых).
+    """
+    index = await load_duplicate_clusters(bank_name, exclude_keys={news_key(news) for news in analyzed_news})
+    new_news = []
+    seen_keys = set()
+    for news in analyzed_news:
+        key = news_key(news)
+        # Та же выжимка уже есть в индексе или в пакете — событие известно
+        if key in index or key in seen_keys:
+            continue
+        seen_keys.add(key)
+        new_news.append((key, news))
+    if not new_news:
+        return []
+
+    representatives = index.representatives()
+    combined = [rep for _, rep in representatives] + [news for _, news in new_news]
+    combined_keys = [root for root, _ in representatives] + [key for key, _ in new_news]
+    old_count = len(representatives)
+    verdicts = []
+    async with aiohttp.ClientSession() as session:
+        semaphore = asyncio.Semaphore(5)
+        await deduplicate_in_parallel(
+            combined, session, semaphore, similarity_threshold=0.85,
+            pair_filter=lambda i, j: i >= old_count or j >= old_count,
+            verdicts=verdicts
+        )
+    logging.info(
+        f"Инкрементальная дедубликация {bank_name}: {len(new_news)} новых × {old_count} представителей, "
+        f"решений по парам: {len(verdicts)}"
+    )
+
+    for key, news in new_news:
+        index.add(key, news)
+    for i, j, is_dupe in verdicts:
+        if is_dupe:
+            index.union(combined_keys[i], combined_keys[j])
+
+    old_roots = {index.find(root) for root, _ in representatives}
+    new_clusters = defaultdict(list)
+    for key, news in new_news:
+        root = index.find(key)
+        if root not in old_roots:
+            new_clusters[root].append(news)
+    unique_news = [max(cluster, key=representative_rank) for cluster in new_clusters.values()]
+    await save_duplicate_clusters(bank_name, index)
+    return unique_news
 
 # --- ОСНОВНАЯ ФУНКЦИЯ ОБРАБОТКИ БАНКА ---
 async def process_bank_monitoring(bank_name, date_from, date_to):
@@ -645,7 +826,8 @@ async def process_bank_monitoring(bank_name, date_from, date_to):
     telegram_news = await fetch_telegram_news_monitoring(bank_name, date_from, date_to)
     all_news.extend(telegram_news)
     await asyncio.sleep(1)
-    filtered_news = [item for item in all_news if not is_news_already_in_db(item.get("link", ""), bank_name, "monitored_news")]
+    known_links = await get_known_links([item.get("link", "") for item in all_news], bank_name, "monitored_news")
+    filtered_news = [item for item in all_news if item.get("link", "") not in known_links]
     if not filtered_news:
         logging.info(f"Нет новых raw новостей для {bank_name}")
         return []
@@ -654,30 +836,7 @@ async def process_bank_monitoring(bank_name, date_from, date_to):
     if not analyzed_news:
         logging.info(f"После анализа нет релевантных новостей для {bank_name}")
         return []
-    existing_summaries = get_existing_analyzed_summaries(bank_name)
-    if not existing_summaries:
-        async with aiohttp.ClientSession() as session:
-            semaphore = asyncio.Semaphore(5)
-            unique_news = await deduplicate_in_parallel(analyzed_news, session, semaphore, similarity_threshold=0.85)
-    else:
-        combined_news = []
-        for summary, date_str, event_type, entities_str, category in existing_summaries:
-            combined_news.append({
-                "summary": summary,
-                "date": date_str,
-                "event_type": event_type,
-                "entities": [e.strip() for e in entities_str.split(',')] if entities_str else [],
-                "source": "database",
-                "informativeness": calculate_informativeness(summary),
-                "category": category or "Обычная",
-                "is_from_db": True
-            })
-        for news in analyzed_news:
-            combined_news.append({**news, "is_from_db": False})
-        async with aiohttp.ClientSession() as session:
-            semaphore = asyncio.Semaphore(5)
-            unique_combined = await deduplicate_in_parallel(combined_news, session, semaphore, similarity_threshold=0.85)
-        unique_news = [news for news in unique_combined if not news.get("is_from_db", False)]
+    unique_news = await deduplicate_against_clusters(bank_name, analyzed_news)
     if not unique_news:
         logging.info(f"Нет новых analyzed новостей для {bank_name}")
         return []
@@ -686,6 +845,10 @@ async def process_bank_monitoring(bank_name, date_from, date_to):
 
 async def monitoring_loop(bot):
     init_monitoring_db()
+    # Полные просмотры таблиц в зарегистрированных запросах логируются как ошибки
+    check_query_plans()
+    # Все LLM-запросы цикла мониторинга (и его дочерних задач) — фоновые
+    LLM_PRIORITY.set("background")
     scheduled_hours = [7, 11, 15, 19]
     moscow_tz = pytz.timezone('Europe/Moscow')
 
@@ -712,7 +875,7 @@ async def monitoring_loop(bot):
             run_time = datetime.now(moscow_tz)
             date_to = run_time.strftime("%Y-%m-%d")
             date_from = (run_time - timedelta(hours=12)).strftime("%Y-%m-%d")
-            banks = get_active_banks()
+            banks = await get_active_banks()
             if not banks:
                 logging.info("Нет активных банков — пропускаем цикл.")
                 continue
@@ -738,14 +901,14 @@ async def monitoring_loop(bot):
                         logging.error(f"Ошибка обработки банка {bank_name}: {result}")
                         continue
                     if result:
-                        subs = get_user_subscriptions_by_bank(bank_name)
+                        subs = await get_user_subscriptions_by_bank(bank_name)
                         for chat_id in subs:
                             user_notifications[chat_id][bank_name].extend(result)
 
                 await asyncio.sleep(DELAY_BETWEEN_BATCHES)
 
             # === ОТПРАВКА УВЕДОМЛЕНИЙ ===
-            all_subscriptions = get_all_subscriptions()
+            all_subscriptions = await get_all_subscriptions()
             unique_chats = {chat_id for chat_id, _ in all_subscriptions}
 
             for chat_id in unique_chats:
@@ -800,10 +963,14 @@ async def monitoring_loop(bot):
                 try:
                     await bot.send_message(chat_id, message, parse_mode="HTML", reply_markup=keyboard, disable_web_page_preview=True)
                     if total > 0:
-                        update_last_notification(chat_id)
+                        await update_last_notification(chat_id)
                 except Exception as e:
                     logging.error(f"Не удалось отправить уведомление chat_id={chat_id}: {e}")
 
+            report = query_stats_report()
+            if report:
+                logging.info(f"Статистика запросов чтения: {report}")
+
         except Exception as e:
             logging.error(f"Критическая ошибка в monitoring_loop: {e}", exc_info=True)
             await asyncio.sleep(60)
\ No newline at end of file
@@ -1,6 +1,7 @@
 # news_analyzer.py (улучшенная версия с оптимизированным обнаружением дубликатов и параллельной проверкой по парам)
 import asyncio
 import aiohttp
+import contextlib
 import re
 import hashlib
 import json
@@ -11,6 +12,22 @@ import logging
 from config import *
 import sqlite3
 from utils import *
+from storage import NEWS_DB, write, fetchone, register_query, sql_for
+from news_search import TOPIC_KEYWORDS
+from relevance_classifier import PREFILTER_STATS, should_skip_llm
+from tfidf_model import load_model as load_tfidf_model, tfidf_pair_similarities
+from llm_cache import TieredResponseCache
+from prompt_budget import PROMPT_BUDGET_STATS, prepare_text_for_llm, prompt_tokens_saved
+from llm_control import LLMEndpointPool, LLMPriorityDispatcher, LLM_PRIORITY, coalesce_request, parse_retry_after
+from dedup_index import (
+    DATE_WINDOW_DAYS, SUMMARY_DISTINCT_THRESHOLD, SUMMARY_MERGE_THRESHOLD,
+    EntityInvertedIndex, adjudication_groups, blocking_keys, candidate_pairs, collapse_exact_duplicates, collapse_reprints,
+    collect_minhash_rows, ensure_minhash_indexes, estimate_jaccard, get_minhash_index, parse_event_partition, remember_texts,
+    same_numbers, word_shingles
+)
+from embedding_index import (
+    EMBEDDING_CANDIDATE_THRESHOLD, EMBEDDING_DUPLICATE_THRESHOLD, collect_embedding_rows, embed_summaries
+)
 
 # Для TF-IDF
 from sklearn.feature_extraction.text import TfidfVectorizer
@@ -20,14 +37,13 @@ import numpy as np
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-# Глобальные кэши для news.db
-gemini_cache = OrderedDict()  # key -> (response, timestamp)
+# Глобальные кэши для news.db (кэш ответов LLM — gemini_cache, см. llm_cache.py)
 duplicate_cache = OrderedDict()  # key -> (is_duplicate, timestamp)
 hard_duplicate_cache = OrderedDict()  # key -> (hash, timestamp)
 soft_duplicate_cache = OrderedDict()  # key -> (similarity, timestamp)
 
 # Размеры кэшей
-MAX_CACHE_SIZE = 1000000
+MAX_CACHE_MEMORY_BYTES = 64 * 1024 * 1024  # горячий уровень кэша LLM в памяти
 MAX_DUPLICATE_CACHE_SIZE = 20000
 MAX_HARD_CACHE_SIZE = 1000
 MAX_SOFT_CACHE_SIZE = 5000
@@ -35,6 +51,17 @@ MAX_SOFT_CACHE_SIZE = 5000
 # TTL в часах
 CACHE_TTL_HOURS = 24
 
+# Интервал фонового сохранения кэшей в БД (секунды)
+CACHE_FLUSH_INTERVAL = 30
+
+# Ключи, изменённые с момента последнего сохранения (сохраняются только они)
+_dirty_cache_keys = {
+    "duplicate_cache": set(),
+    "hard_duplicate_cache": set(),
+    "soft_duplicate_cache": set(),
+}
+_cache_flusher_task = None
+
 # Доверенные источники
 TRUSTED_SOURCES = {"tass.ru", "interfax.ru", "kommersant.ru", "vedomosti.ru"}
 
@@ -136,55 +163,36 @@ EVENT_TYPE_MAPPING = {
 # Список ключевых слов для исключения нерелевантных новостей
 IRRELEVANT_KEYWORDS = []
 
-# Глобальный TF-IDF векторизатор
-_tfidf_vectorizer = TfidfVectorizer(
-    ngram_range=(1, 3),
-    lowercase=True,
-    max_features=5000
-)
+# Корпусная TF-IDF модель (только transform); без неё — локальная подгонка на переданных текстах
+def tfidf_transform(texts):
+    """TF-IDF векторы текстов и имена признаков"""
+    model = load_tfidf_model()
+    if model is not None:
+        return model.transform(texts), model.get_feature_names_out()
+    vectorizer = TfidfVectorizer(ngram_range=(1, 3), lowercase=True, max_features=5000)
+    return vectorizer.fit_transform(texts), vectorizer.get_feature_names_out()
 
 # --- ФУНКЦИИ ЗАГРУЗКИ/СОХРАНЕНИЯ КЭША ДЛЯ news.db ---
-def load_cache():
-    try:
-        conn = sqlite3.connect('news.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT cache_key, response, timestamp FROM gemini_cache ORDER BY timestamp ASC")
-        rows = cursor.fetchall()
-        cache = OrderedDict()
-        for row in rows:
-            try:
-                ts = datetime.fromisoformat(row[2])
-            except:
-                ts = datetime.now()
-            cache[row[0]] = (row[1], ts)
-        return cache
-    except sqlite3.Error as e:
-        logging.error(f"Ошибка загрузки кэша Gemini: {e}")
-        return OrderedDict()
-    finally:
-        conn.close()
+# Таблица кэша дубликатов -> столбец значения
+DUPLICATE_CACHE_COLUMNS = {"duplicate_cache": "value", "hard_duplicate_cache": "summary_hash", "soft_duplicate_cache": "similarity"}
+# При старте читаются только записи в пределах TTL (по индексу timestamp), устаревшие удаляются при сохранении
+FRESH_CACHE_QUERIES = {
+    table: register_query(f"{table}_fresh", f"SELECT cache_key, {column}, timestamp FROM {table} WHERE timestamp >= ? ORDER BY timestamp ASC")
+    for table, column in DUPLICATE_CACHE_COLUMNS.items()
+}
+EXPIRE_CACHE_QUERIES = {
+    table: register_query(f"expire_{table}", f"DELETE FROM {table} WHERE timestamp < ?")
+    for table in DUPLICATE_CACHE_COLUMNS
+}
 
-def save_cache():
-    cleanup_cache(gemini_cache)
-    try:
-        conn = sqlite3.connect('news.db', timeout=30)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM gemini_cache")
-        for key, (value, ts) in gemini_cache.items():
-            cursor.execute("INSERT INTO gemini_cache (cache_key, response, timestamp) VALUES (?, ?, ?)",
-                           (key, value, ts.isoformat()))
-        conn.commit()
-        logging.info("Кэш Gemini сохранен в БД")
-    except sqlite3.Error as e:
-        logging.error(f"Ошибка сохранения кэша Gemini: {e}")
-    finally:
-        conn.close()
+def _cache_cutoff():
+    return (datetime.now() - timedelta(hours=CACHE_TTL_HOURS)).isoformat()
 
 def load_duplicate_cache():
     try:
         conn = sqlite3.connect('news.db')
         cursor = conn.cursor()
-        cursor.execute("SELECT cache_key, value, timestamp FROM duplicate_cache ORDER BY timestamp ASC")
+        cursor.execute(sql_for(FRESH_CACHE_QUERIES["duplicate_cache"]), (_cache_cutoff(),))
         rows = cursor.fetchall()
         cache = OrderedDict()
         for row in rows:
@@ -200,27 +208,11 @@ def load_duplicate_cache():
     finally:
         conn.close()
 
-def save_duplicate_cache():
-    cleanup_cache(duplicate_cache)
-    try:
-        conn = sqlite3.connect('news.db', timeout=30)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM duplicate_cache")
-        for key, (value, ts) in duplicate_cache.items():
-            cursor.execute("INSERT INTO duplicate_cache (cache_key, value, timestamp) VALUES (?, ?, ?)",
-                           (key, int(value), ts.isoformat()))
-        conn.commit()
-        logging.info("Кэш дубликатов сохранен в БД")
-    except sqlite3.Error as e:
-        logging.error(f"Ошибка сохранения кэша дубликатов: {e}")
-    finally:
-        conn.close()
-
 def load_hard_duplicate_cache():
     try:
         conn = sqlite3.connect('news.db')
         cursor = conn.cursor()
-        cursor.execute("SELECT cache_key, summary_hash, timestamp FROM hard_duplicate_cache ORDER BY timestamp ASC")
+        cursor.execute(sql_for(FRESH_CACHE_QUERIES["hard_duplicate_cache"]), (_cache_cutoff(),))
         rows = cursor.fetchall()
         cache = OrderedDict()
         for row in rows:
@@ -236,27 +228,11 @@ def load_hard_duplicate_cache():
     finally:
         conn.close()
 
-def save_hard_duplicate_cache():
-    cleanup_cache(hard_duplicate_cache)
-    try:
-        conn = sqlite3.connect('news.db', timeout=30)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM hard_duplicate_cache")
-        for key, (value, ts) in hard_duplicate_cache.items():
-            cursor.execute("INSERT INTO hard_duplicate_cache (cache_key, summary_hash, timestamp) VALUES (?, ?, ?)",
-                           (key, value, ts.isoformat()))
-        conn.commit()
-        logging.info("Жесткий кэш дубликатов сохранен в БД")
-    except sqlite3.Error as e:
-        logging.error(f"Ошибка сохранения жесткого кэша дубликатов: {e}")
-    finally:
-        conn.close()
-
 def load_soft_duplicate_cache():
     try:
         conn = sqlite3.connect('news.db')
         cursor = conn.cursor()
-        cursor.execute("SELECT cache_key, similarity, timestamp FROM soft_duplicate_cache ORDER BY timestamp ASC")
+        cursor.execute(sql_for(FRESH_CACHE_QUERIES["soft_duplicate_cache"]), (_cache_cutoff(),))
         rows = cursor.fetchall()
         cache = OrderedDict()
         for row in rows:
@@ -272,32 +248,91 @@ def load_soft_duplicate_cache():
     finally:
         conn.close()
 
-def save_soft_duplicate_cache():
-    cleanup_cache(soft_duplicate_cache)
+def cleanup_cache(cache, max_age_hours=CACHE_TTL_HOURS):
+    # Записи добавляются в порядке времени, поэтому устаревшие всегда в начале
+    now = datetime.now()
+    removed = 0
+    while cache:
+        key, (_, timestamp) = next(iter(cache.items()))
+        if (now - timestamp).total_seconds() <= max_age_hours * 3600:
+            break
+        cache.popitem(last=False)
+        removed += 1
+    if removed:
+        logging.info(f"Очищено {removed} устаревших записей из кэша")
+
+def set_cache_entry(table_name, cache, key, value, max_size, timestamp=None):
+    """Запись в кэш с пометкой ключа для инкрементального сохранения."""
+    cache[key] = (value, timestamp or datetime.now())
+    cache.move_to_end(key)
+    _dirty_cache_keys[table_name].add(key)
+    if len(cache) > max_size:
+        cache.popitem(last=False)
+
+# Таблица кэша -> (кэш, столбец значения, преобразование для БД)
+def _cache_tables():
+    return {
+        "duplicate_cache": (duplicate_cache, "value", int),
+        "hard_duplicate_cache": (hard_duplicate_cache, "summary_hash", str),
+        "soft_duplicate_cache": (soft_duplicate_cache, "similarity", float),
+    }
+
+def _collect_dirty_rows(table_name):
+    cache, _, encode = _cache_tables()[table_name]
+    dirty = _dirty_cache_keys[table_name]
+    keys = list(dirty)
+    dirty.clear()
+    rows = []
+    for key in keys:
+        entry = cache.get(key)
+        if entry is not None:
+            value, ts = entry
+            rows.append((key, encode(value), ts.isoformat()))
+    return keys, rows
+
+def _write_cache_rows_to(cursor, table_name, rows):
+    """UPSERT изменённых записей и удаление устаревших по TTL средствами SQL."""
+    _, column, _ = _cache_tables()[table_name]
+    if rows:
+        cursor.executemany(
+            f"INSERT OR REPLACE INTO {table_name} (cache_key, {column}, timestamp) VALUES (?, ?, ?)",
+            rows
+        )
+    cursor.execute(sql_for(EXPIRE_CACHE_QUERIES[table_name]), (_cache_cutoff(),))
+
+async def flush_all_caches_async():
+    """Сохранение изменённых записей всех кэшей через писателя БД (вне event loop)."""
+    pending, rows = gemini_cache.collect_pending_rows()
     try:
-        conn = sqlite3.connect('news.db', timeout=30)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM soft_duplicate_cache")
-        for key, (value, ts) in soft_duplicate_cache.items():
-            cursor.execute("INSERT INTO soft_duplicate_cache (cache_key, similarity, timestamp) VALUES (?, ?, ?)",
-                           (key, value, ts.isoformat()))
-        conn.commit()
-        logging.info("Мягкий кэш похожих событий сохранен в БД")
+        await write(gemini_cache.db_path, lambda cursor: gemini_cache.write_rows_to(cursor, rows))
+        if rows:
+            logging.info(f"Кэш LLM: сохранено {len(rows)} новых ответов")
     except sqlite3.Error as e:
-        logging.error(f"Ошибка сохранения мягкого кэша: {e}")
-    finally:
-        conn.close()
+        gemini_cache.restore_pending(pending)
+        logging.error(f"Ошибка сохранения кэша LLM: {e}")
+    for table_name in _dirty_cache_keys:
+        keys, rows = _collect_dirty_rows(table_name)
+        try:
+            await write(NEWS_DB, lambda cursor, table_name=table_name, rows=rows: _write_cache_rows_to(cursor, table_name, rows))
+            if rows:
+                logging.info(f"Кэш {table_name}: сохранено {len(rows)} изменённых записей")
+        except sqlite3.Error as e:
+            _dirty_cache_keys[table_name].update(keys)
+            logging.error(f"Ошибка сохранения кэша {table_name}: {e}")
+
+async def cache_flush_loop(interval=CACHE_FLUSH_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush_all_caches_async()
+        except Exception as e:
+            logging.error(f"Ошибка фонового сохранения кэшей: {e}")
 
-def cleanup_cache(cache, max_age_hours=CACHE_TTL_HOURS):
-    now = datetime.now()
-    keys_to_delete = [
-        key for key, (_, timestamp) in cache.items()
-        if (now - timestamp).total_seconds() > max_age_hours * 3600
-    ]
-    for key in keys_to_delete:
-        del cache[key]
-    if keys_to_delete:
-        logging.info(f"Очищено {len(keys_to_delete)} устаревших записей из кэша")
+def ensure_cache_flusher():
+    """Запуск фонового сохранения кэшей, если оно ещё не запущено."""
+    global _cache_flusher_task
+    if _cache_flusher_task is None or _cache_flusher_task.done():
+        _cache_flusher_task = asyncio.create_task(cache_flush_loop())
 
 # Инициализация БД и кэшей
 def init_db_extended():
@@ -318,111 +353,92 @@ def init_db_extended():
         conn.close()
 
 init_db_extended()
-gemini_cache = load_cache()
+gemini_cache = TieredResponseCache('news.db', 'gemini_cache', max_memory_bytes=MAX_CACHE_MEMORY_BYTES, ttl_hours=CACHE_TTL_HOURS)
 duplicate_cache = load_duplicate_cache()
 hard_duplicate_cache = load_hard_duplicate_cache()
 soft_duplicate_cache = load_soft_duplicate_cache()
 
-# --- ✅ ГЛОБАЛЬНЫЙ АДАПТИВНЫЙ СЕМАФОР ДЛЯ LLM ---
-class AdaptiveSemaphore:
-    def __init__(self, initial_value=10):
-        self._semaphore = asyncio.Semaphore(initial_value)
-        self._current_value = initial_value
-        self._lock = asyncio.Lock()
-        self._last_429_time = None
-
-    async def acquire(self):
-        await self._semaphore.acquire()
-
-    async def release(self):
-        self._semaphore.release()
-
-    async def __aenter__(self):
-        await self.acquire()
-        return self
-
-    async def __aexit__(self, exc_type, exc, tb):
-        await self.release()
-
-    async def reduce_limit(self, new_limit):
-        async with self._lock:
-            if new_limit < self._current_value:
-                new_sem = asyncio.Semaphore(new_limit)
-                for _ in range(self._current_value - new_limit):
-                    if self._semaphore._value > 0:
-                        self._semaphore.release()
-                        await new_sem.acquire()
-                self._semaphore = new_sem
-                self._current_value = new_limit
-                logging.warning(f"Адаптивный семафор: лимит снижен до {new_limit}")
-
-    async def maybe_increase_limit(self):
-        async with self._lock:
-            if self._last_429_time and (datetime.now() - self._last_429_time).total_seconds() > 60:
-                new_limit = min(self._current_value + 1, 15)
-                if new_limit > self._current_value:
-                    await self.reduce_limit(new_limit)
-                    self._last_429_time = None
-
-    def record_429(self):
-        self._last_429_time = datetime.now()
-
-LLM_SEMAPHORE = AdaptiveSemaphore(initial_value=10)
+# --- ✅ ГЛОБАЛЬНЫЙ ОГРАНИЧИТЕЛЬ СКОРОСТИ ЗАПРОСОВ К LLM (token bucket + AIMD) ---
+# Эндпоинты/ключи LLM: LLM_ENDPOINTS из config.py (список {"url", "api_key", "weight", ...})
+# или единственный GEMINI_API_URL + PROXY_API_KEY
+LLM_POOL = LLMEndpointPool.from_config(
+    globals().get("LLM_ENDPOINTS") or [{"url": GEMINI_API_URL, "api_key": PROXY_API_KEY, "name": "default"}],
+    initial_rate=3.0,
+    max_concurrency=10
+)
+# Интерактивные запросы пользователей обслуживаются раньше дедубликации и фонового мониторинга
+LLM_DISPATCHER = LLMPriorityDispatcher(LLM_POOL)
 
 # --------------------------------------------------
+# Незавершённые запросы к LLM: одинаковые промпты ждут один и тот же результат
+_inflight_llm_requests = {}  # cache_key -> asyncio.Future
+LLM_REQUEST_STATS = {"cache_hits": 0, "coalesced": 0, "sent": 0}
+
 async def send_gemini_request(session, prompt, retries=10, semaphore=None):
-    async with LLM_SEMAPHORE:
-        normalized_prompt = re.sub(r'\s+', ' ', prompt.strip())
-        cache_key = hashlib.md5(normalized_prompt.encode('utf-8')).hexdigest()
-        now = datetime.now()
-        if cache_key in gemini_cache:
-            response, ts = gemini_cache[cache_key]
-            if (now - ts).total_seconds() < CACHE_TTL_HOURS * 3600:
-                return response
-            else:
-                del gemini_cache[cache_key]
+    normalized_prompt = re.sub(r'\s+', ' ', prompt.strip())
+    cache_key = hashlib.md5(normalized_prompt.encode('utf-8')).hexdigest()
+    cached_response = await gemini_cache.get(cache_key)
+    if cached_response is not None:
+        LLM_REQUEST_STATS["cache_hits"] += 1
+        return cached_response
+
+    return await coalesce_request(
+        _inflight_llm_requests, cache_key,
+        lambda: _send_gemini_request_uncached(session, prompt, cache_key, retries),
+        LLM_REQUEST_STATS
+    )
 
-        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {PROXY_API_KEY}"}
-        data = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
-        for attempt in range(retries):
+async def _send_gemini_request_uncached(session, prompt, cache_key, retries):
+    data = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+    for attempt in range(retries):
+        now = datetime.now()
+        delay = 0
+        # Разрешение держится только на время HTTP-запроса, ожидание между попытками — без него
+        async with LLM_DISPATCHER.slot() as endpoint:
+            headers = {"Content-Type": "application/json", "Authorization": f"Bearer {endpoint.api_key}"}
             try:
-                async with session.post(GEMINI_API_URL, headers=headers, json=data, timeout=aiohttp.ClientTimeout(total=60)) as response:
+                async with session.post(endpoint.url, headers=headers, json=data, timeout=aiohttp.ClientTimeout(total=60)) as response:
                     if response.status == 200:
                         result = await response.json()
                         text = result.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "Ошибка")
+                        endpoint.record_success()
                         if text != "Ошибка":
-                            gemini_cache[cache_key] = (text, now)
-                            if len(gemini_cache) > MAX_CACHE_SIZE:
-                                gemini_cache.popitem(last=False)
-                            await LLM_SEMAPHORE.maybe_increase_limit()
+                            gemini_cache.put(cache_key, text, now)
                             return text
                         else:
                             logging.warning(f"LLM вернул 'Ошибка' для промпта: {prompt[:50]}...")
                             return "Ошибка"
                     elif response.status == 429:
-                        LLM_SEMAPHORE.record_429()
-                        delay = min(60, (2 ** attempt) + random.uniform(2, 5))
-                        logging.warning(f"HTTP 429. Попытка {attempt + 1}/{retries}. Ждем {delay:.1f} сек.")
-                        await asyncio.sleep(delay)
-                        await LLM_SEMAPHORE.reduce_limit(max(3, LLM_SEMAPHORE._current_value - 1))
+                        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                        endpoint.record_throttle(retry_after)
+                        # При Retry-After паузу выдерживает ограничитель для всех запросов сразу
+                        delay = 0 if retry_after is not None else min(60, (2 ** attempt) + random.uniform(2, 5))
+                        logging.warning(f"HTTP 429 от {endpoint.name}. Попытка {attempt + 1}/{retries}. Ждем {delay:.1f} сек.")
                     elif response.status in (500, 502, 503, 504):
-                        delay = min(30, (attempt + 1) * 3 + random.uniform(1, 3))
-                        logging.warning(f"HTTP {response.status}. Попытка {attempt + 1}/{retries}. Ждем {delay:.1f} сек.")
-                        await asyncio.sleep(delay)
+                        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                        endpoint.record_throttle(retry_after)
+                        LLM_POOL.record_error(endpoint)
+                        delay = 0 if retry_after is not None else min(30, (attempt + 1) * 3 + random.uniform(1, 3))
+                        logging.warning(f"HTTP {response.status} от {endpoint.name}. Попытка {attempt + 1}/{retries}. Ждем {delay:.1f} сек.")
                     else:
-                        logging.error(f"Неожиданный HTTP {response.status} для промпта: {prompt[:50]}...")
-                        await asyncio.sleep(5)
+                        logging.error(f"Неожиданный HTTP {response.status} от {endpoint.name} для промпта: {prompt[:50]}...")
+                        LLM_POOL.record_error(endpoint)
+                        delay = 5
             except asyncio.TimeoutError:
-                logging.warning(f"Таймаут запроса к LLM (попытка {attempt + 1}/{retries})")
-                await asyncio.sleep(10 + attempt * 2)
+                logging.warning(f"Таймаут запроса к LLM {endpoint.name} (попытка {attempt + 1}/{retries})")
+                LLM_POOL.record_error(endpoint)
+                delay = 10 + attempt * 2
             except aiohttp.ClientError as e:
-                logging.warning(f"Ошибка сети при запросе к LLM: {e}. Попытка {attempt + 1}/{retries}")
-                await asyncio.sleep(5 + attempt * 2)
+                logging.warning(f"Ошибка сети при запросе к LLM {endpoint.name}: {e}. Попытка {attempt + 1}/{retries}")
+                LLM_POOL.record_error(endpoint)
+                delay = 5 + attempt * 2
             except Exception as e:
                 logging.error(f"Необработанное исключение при запросе к LLM: {e}")
-                await asyncio.sleep(10)
-        logging.error(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось выполнить запрос к LLM после {retries} попыток. Промпт: {prompt[:100]}...")
-        return "Ошибка"
+                delay = 10
+        if delay:
+            await asyncio.sleep(delay)
+    logging.error(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось выполнить запрос к LLM после {retries} попыток. Промпт: {prompt[:100]}...")
+    return "Ошибка"
 
 def normalize_text(text):
     if not text:
@@ -465,8 +481,7 @@ def extract_keywords(text, top_n=5):
     if not normalized_text:
         return []
     try:
-        tfidf_matrix = _tfidf_vectorizer.fit_transform([normalized_text])
-        feature_names = _tfidf_vectorizer.get_feature_names_out()
+        tfidf_matrix, feature_names = tfidf_transform([normalized_text])
         tfidf_scores = tfidf_matrix.toarray()[0]
         top_indices = tfidf_scores.argsort()[-top_n:][::-1]
         return [feature_names[i] for i in top_indices if tfidf_scores[i] > 0.1]
@@ -481,23 +496,28 @@ def is_topic_relevant(text, topic):
     normalized_topic = normalize_text(topic)
     if normalized_topic in normalized_text:
         return True
-    topic_keywords = {
-        "ипотека": ["ипотек", "ипотечн", "жилье", "недвижимость", "кредит на жилье"],
-        "кредит": ["кредит", "заем", "ссуд", "потребительский кредит", "автокредит"],
-        "санкции": ["санкци", "ограничен", "блокиров", "запрет"],
-        "технологии": ["технолог", "it", "айти", "инновац", "цифров", "онлайн", "мобильн", "приложен"],
-        "финансы": ["финанс", "капитал", "актив", "прибыль", "убыток", "рентабельность"],
-        "открытие офисов": ["офис", "отделен", "филиал", "точка", "банкомат", "атм"],
-        "штраф": ["штраф", "взыскан", "нарушен", "санкци", "пени", "неустойка"],
-        "жалоба клиента": ["жалоб", "претензи", "недовольств", "обман", "мошенничеств", "суд", "исковое"],
-    }
-    keywords = topic_keywords.get(normalized_topic, [normalized_topic])
+    keywords = TOPIC_KEYWORDS.get(normalized_topic, [normalized_topic])
     for keyword in keywords:
         if keyword in normalized_text:
             return True
     return False
 
 # --- ✅ УЛУЧШЕННАЯ ФУНКЦИЯ is_duplicate С ОБЯЗАТЕЛЬНОЙ LLM-ПРОВЕРКОЙ ---
+def duplicate_cache_key(summary1, summary2):
+    """Ключ кэша дубликатов, не зависящий от порядка выжимок"""
+    sorted_hashes = sorted(hashlib.md5(summary.encode('utf-8')).hexdigest() for summary in (summary1, summary2))
+    return hashlib.md5(":".join(sorted_hashes).encode('utf-8')).hexdigest()
+
+# Типы событий, для которых дубликат возможен без общих сущностей
+ENTITY_OPTIONAL_EVENT_TYPES = ("реклама", "обычная")
+
+def duplicate_precheck(date1, date2, event_type1, entities1, entities2):
+    """Правила, исключающие дубликат без LLM: даты дальше 5 дней или важное событие без общих сущностей"""
+    if abs((date1 - date2).days) > 5:
+        return False
+    common_entities = {e.lower().strip() for e in entities1} & {e.lower().strip() for e in entities2}
+    return bool(common_entities) or event_type1 in ENTITY_OPTIONAL_EVENT_TYPES
+
 async def is_duplicate(session, new_summary, existing_summary, new_date, existing_date, new_event_type, existing_event_type, new_entities, existing_entities, threshold=0.7):
     hash1 = hashlib.md5(new_summary.encode('utf-8')).hexdigest()
     hash2 = hashlib.md5(existing_summary.encode('utf-8')).hexdigest()
@@ -514,19 +534,11 @@ async def is_duplicate(session, new_summary, existing_summary, new_date, existin
     new_event_type = normalize_event_type(new_event_type)
     existing_event_type = normalize_event_type(existing_event_type)
 
-    if abs((new_date - existing_date).days) > 5:
-        logging.debug(f"[{pair_id}] Разница в датах > 5 дней: {abs((new_date - existing_date).days)}")
-        return False
-
-    new_entities_lower = [e.lower().strip() for e in new_entities]
-    existing_entities_lower = [e.lower().strip() for e in existing_entities]
-    common_entities = set(new_entities_lower) & set(existing_entities_lower)
-    if not common_entities and new_event_type not in ["реклама", "обычная"]:
-        logging.debug(f"[{pair_id}] Нет общих сущностей для важного события: {new_entities} vs {existing_entities}")
+    if not duplicate_precheck(new_date, existing_date, new_event_type, new_entities, existing_entities):
+        logging.debug(f"[{pair_id}] Исключено без LLM: даты {new_date.date()}/{existing_date.date()}, сущности {new_entities} vs {existing_entities}")
         return False
 
-    sorted_hashes = sorted([hash1, hash2])
-    combined_key = hashlib.md5(":".join(sorted_hashes).encode('utf-8')).hexdigest()
+    combined_key = duplicate_cache_key(new_summary, existing_summary)
     now = datetime.now()
 
     if combined_key in duplicate_cache:
@@ -581,7 +593,7 @@ async def is_duplicate(session, new_summary, existing_summary, new_date, existin
     if "решение" not in response.lower() and "дубликат" not in response.lower():
         texts = [normalize_text(new_summary), normalize_text(existing_summary)]
         try:
-            tfidf_matrix = _tfidf_vectorizer.fit_transform(texts)
+            tfidf_matrix, _ = tfidf_transform(texts)
             cosine_sim = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
             is_dupe = cosine_sim >= threshold
             trust_score = int(cosine_sim * 100)
@@ -589,15 +601,74 @@ async def is_duplicate(session, new_summary, existing_summary, new_date, existin
             logging.warning(f"[{pair_id}] Ошибка TF-IDF: {e}")
             is_dupe = False
 
-    duplicate_cache[combined_key] = (is_dupe, now)
-    if len(duplicate_cache) > MAX_DUPLICATE_CACHE_SIZE:
-        duplicate_cache.popitem(last=False)
+    set_cache_entry("duplicate_cache", duplicate_cache, combined_key, is_dupe, MAX_DUPLICATE_CACHE_SIZE, now)
 
     logging.info(f"[{pair_id}] Дубликат: {is_dupe}, Доверие: {trust_score}%")
     return is_dupe
 
+# --- ГРУППОВАЯ ПРОВЕРКА ДУБЛИКАТОВ: одно разбиение группы на события вместо k(k-1)/2 попарных запросов ---
+CLUSTER_ADJUDICATION_STATS = {"groups": 0, "pairs": 0, "fallback_groups": 0}
+
+async def adjudicate_group(session, news_items):
+    """
+    Разбиение группы новостей на события одним запросом к LLM.
+    Возвращает список номеров событий для каждой новости или None, если ответ не разобран.
+    """
+    ids = list(range(1, len(news_items) + 1))
+    lines = []
+    for news_id, news in zip(ids, news_items):
+        try:
+            event_date = normalize_date(news["event_date"]).strftime("%Y-%m-%d")
+        except (ValueError, KeyError):
+            event_date = str(news.get("date", ""))
+        lines.append(
+            f"[{news_id}] {news['summary']} | Дата события: {event_date} | "
+            f"Тип: {normalize_event_type(news.get('event_type', ''))} | Сущности: {', '.join(news.get('entities', []))}"
+        )
+    prompt = (
+        "Ты — эксперт по анализу финансовых новостей. Ниже пронумерованные выжимки новостей. "
+        "Разбей их на группы, где каждая группа — ОДНО И ТО ЖЕ конкретное событие.\n"
+        "КРИТЕРИИ ОДНОГО СОБЫТИЯ:\n"
+        "1. Одно и то же конкретное событие (один и тот же штраф ЦБ, одна и та же сделка, одно и то же решение суда).\n"
+        "2. Совпадают ключевые сущности и дата события, даже если формулировки и типы событий отличаются.\n"
+        "РАЗНЫЕ СОБЫТИЯ: разные факты или сущности, одна тема без общего события, разница в датах больше 3 дней.\n"
+        "ВАЖНО: Если есть неуверенность, помещай выжимку в отдельную группу.\n"
+        + "\n".join(lines) + "\n"
+        "Каждый номер должен встретиться ровно в одной группе, одиночные выжимки — отдельными группами.\n"
+        "Дай ответ строго в формате, по строке на группу:\n"
+        "Событие 1: [номера через запятую]\n"
+        "Событие 2: [номера через запятую]"
+    )
+    response = await send_gemini_request(session, prompt)
+    partition = parse_event_partition(response, ids)
+    if partition is None:
+        logging.warning(f"Не удалось разобрать разбиение группы из {len(news_items)} выжимок, попарная проверка")
+        logging.debug(f"Ответ LLM на разбиение: {response}")
+        return None
+    labels = [0] * len(news_items)
+    for label, members in enumerate(partition):
+        for news_id in members:
+            labels[news_id - 1] = label
+    return labels
+
 # --- ✅ УЛУЧШЕННАЯ ПАРАЛЛЕЛЬНАЯ ДЕДУБЛИКАЦИЯ С ОГРАНИЧЕНИЕМ ПАР ---
-async def deduplicate_in_parallel(all_news, session, semaphore=None, similarity_threshold=0.7, max_parallel_pairs=20):
+def representative_rank(news):
+    """Ключ выбора лучшей новости кластера дубликатов"""
+    return (
+        news["source"] in TRUSTED_SOURCES,
+        news["informativeness"],
+        news["category"] in ["Важная", "Риск"],
+        news["date"]
+    )
+
+async def deduplicate_in_parallel(all_news, session, semaphore=None, similarity_threshold=0.7, max_parallel_pairs=20, deadline=None, leftover=None,
+                                  pair_filter=None, verdicts=None):
+    """
+    Попарная LLM-дедубликация. С дедлайном непроверенные к его истечению пары
+    считаются недубликатами, а их проверки дорабатывают в фоне (в leftover) и пополняют кэш.
+    pair_filter(i, j) ограничивает проверяемые пары (например, без пар уже сравнённых новостей),
+    в verdicts добавляются все вынесенные решения (i, j, is_dupe).
+    """
     if len(all_news) <= 1:
         return all_news
 
@@ -609,63 +680,189 @@ async def deduplicate_in_parallel(all_news, session, semaphore=None, similarity_
             event_date = normalize_date(news["event_date"])
         except:
             event_date = normalize_date(news["date"])
-        event_type = normalize_event_type(news.get("event_type", ""))
-        normalized_news.append({**news, "event_date_norm": event_date, "event_type_norm": event_type})
+        normalized_news.append({**news, "event_date_norm": event_date})
+
+    # Кандидаты: близкие даты событий и общая сущность; по шинглам выжимки блокируются
+    # только новости типов, допускающих дубликат без общих сущностей
+    entity_index = EntityInvertedIndex()
+    entity_optional = []
+    for idx, news in enumerate(normalized_news):
+        entity_index.add(idx, news.get("entities", []))
+        entity_optional.append(normalize_event_type(news.get("event_type", "")) in ENTITY_OPTIONAL_EVENT_TYPES)
+    pairs, pair_stats = candidate_pairs([
+        (news["event_date_norm"], blocking_keys(news.get("summary", ""), news.get("entities", []), shingles=entity_optional[idx]))
+        for idx, news in enumerate(normalized_news)
+    ])
+    logging.info(
+        f"Сгенерировано {len(pairs)} пар для дедубликации (дата ±{DATE_WINDOW_DAYS} дня и общий ключ блокировки), "
+        f"отсечено {pair_stats['pruned_pairs']} из {pair_stats['window_pairs']} пар в окне дат"
+    )
 
-    groups_by_type = defaultdict(list)
-    for i, news in enumerate(normalized_news):
-        et = news["event_type_norm"]
-        if et in ["обычная", "реклама", "неизвестно"]:
-            continue
-        groups_by_type[et].append(i)
+    # Оценка Жаккара по MinHash выжимок: явные дубликаты и явно разные события решаются без LLM,
+    # LSH индекса банка добавляет почти-дубликаты, не попавшие в блоки
+    await ensure_minhash_indexes((news.get("bank", ""), "summary") for news in normalized_news)
+    signatures = [summary_signature(news) for news in normalized_news]
+    indices_by_key = defaultdict(list)
+    for idx, (key, _) in enumerate(signatures):
+        indices_by_key[key].append(idx)
+    pair_set = set(pairs)
+    for idx, news in enumerate(normalized_news):
+        index = get_minhash_index(news.get("bank", ""), "summary")
+        for key, _ in index.query(signatures[idx][1], SUMMARY_MERGE_THRESHOLD):
+            for other in indices_by_key.get(key, ()):
+                if other != idx and abs((news["event_date_norm"] - normalized_news[other]["event_date_norm"]).days) <= DATE_WINDOW_DAYS:
+                    pair_set.add((min(idx, other), max(idx, other)))
+
+    # Эмбеддинги выжимок: перефразы без общих слов попадают в кандидаты по косинусному сходству
+    vectors = await asyncio.to_thread(embed_summaries, normalized_news)
+    embedding_scores = None
+    if vectors is not None:
+        embedding_scores = vectors @ vectors.T
+        days = np.array([news["event_date_norm"].toordinal() for news in normalized_news])
+        close = (embedding_scores >= EMBEDDING_CANDIDATE_THRESHOLD) & (np.abs(days[:, None] - days[None, :]) <= DATE_WINDOW_DAYS)
+        rows, cols = np.nonzero(np.triu(close, k=1))
+        before = len(pair_set)
+        pair_set.update(zip(rows.tolist(), cols.tolist()))
+        EMBEDDING_STATS["candidates"] += len(pair_set) - before
+
+    # Пары из LSH и эмбеддингов без общей сущности допустимы только для неважных типов событий
+    pair_set = {
+        (i, j) for i, j in pair_set
+        if entity_index.shares_entity(i, j) or (entity_optional[i] and entity_optional[j])
+    }
+    if pair_filter is not None:
+        pair_set = {pair for pair in pair_set if pair_filter(*pair)}
+
+    # Без LLM объединяются только выжимки с одинаковыми числами и датами (шаблонные новости различаются ими)
+    summaries = [news.get("summary", "") for news in normalized_news]
+    auto_results = []
+    llm_pairs = []
+    for i, j in sorted(pair_set):
+        similarity = estimate_jaccard(signatures[i][1], signatures[j][1])
+        if similarity >= SUMMARY_MERGE_THRESHOLD and same_numbers(summaries[i], summaries[j]):
+            auto_results.append((i, j, True))
+        elif similarity < SUMMARY_DISTINCT_THRESHOLD:
+            MINHASH_STATS["summary_distinct"] += 1
+        else:
+            llm_pairs.append((i, j))
+    MINHASH_STATS["summary_merged"] += len(auto_results)
+    logging.info(
+        f"MinHash выжимок: {len(auto_results)} пар объединено без LLM, "
+        f"{len(pair_set) - len(auto_results) - len(llm_pairs)} разведено, {len(llm_pairs)} осталось"
+    )
 
-    all_indices = list(range(len(normalized_news)))
-    groups_by_type["__all__"] = all_indices
+    # Оставшиеся пары — через пакетный TF-IDF, в LLM уходит только промежуточная полоса
+    tfidf_scores = tfidf_pair_similarities(summaries, llm_pairs)
+    pairs = []
+    tfidf_merged = tfidf_distinct = 0
+    for (i, j), score in zip(llm_pairs, tfidf_scores):
+        numbers_match = same_numbers(summaries[i], summaries[j])
+        if score >= TFIDF_DUPLICATE_THRESHOLD and numbers_match:
+            auto_results.append((i, j, True))
+            tfidf_merged += 1
+        elif numbers_match and embedding_scores is not None and embedding_scores[i, j] >= EMBEDDING_DUPLICATE_THRESHOLD:
+            auto_results.append((i, j, True))
+            EMBEDDING_STATS["merged"] += 1
+        elif score < TFIDF_DISTINCT_THRESHOLD:
+            tfidf_distinct += 1
+        else:
+            pairs.append((i, j))
+    TFIDF_PRESCREEN_STATS["merged"] += tfidf_merged
+    TFIDF_PRESCREEN_STATS["distinct"] += tfidf_distinct
+    MINHASH_STATS["summary_llm"] += len(pairs)
+    logging.info(
+        f"TF-IDF выжимок: {tfidf_merged} пар объединено, {tfidf_distinct} разведено, {len(pairs)} на проверку LLM"
+    )
 
-    pairs = set()
-    for group_indices in groups_by_type.values():
-        n = len(group_indices)
-        if n <= 1:
-            continue
-        for i in range(n):
-            for j in range(i):
-                idx1, idx2 = group_indices[i], group_indices[j]
-                if idx1 == idx2:
-                    continue
-                date1 = normalized_news[idx1]["event_date_norm"]
-                date2 = normalized_news[idx2]["event_date_norm"]
-                if abs((date1 - date2).days) <= 3:
-                    pair = tuple(sorted((idx1, idx2)))
-                    pairs.add(pair)
-
-    pairs = list(pairs)
-    logging.info(f"Сгенерировано {len(pairs)} пар для дедубликации (после фильтрации по типу и дате ±3 дня)")
-
-    if not pairs:
+    if not pairs and not auto_results:
         return all_news
 
+    # Пары, решаемые правилами или кэшем, не попадают в группы для LLM
+    now = datetime.now()
+    adjudication_pairs = []
+    for i, j in pairs:
+        news_i, news_j = normalized_news[i], normalized_news[j]
+        if not duplicate_precheck(news_i["event_date_norm"], news_j["event_date_norm"],
+                                  normalize_event_type(news_i["event_type"]), news_i["entities"], news_j["entities"]):
+            auto_results.append((i, j, False))
+            continue
+        cached = duplicate_cache.get(duplicate_cache_key(news_i["summary"], news_j["summary"]))
+        if cached is not None and (now - cached[1]).total_seconds() < CACHE_TTL_HOURS * 3600:
+            auto_results.append((i, j, bool(cached[0])))
+            continue
+        adjudication_pairs.append((i, j))
+    groups, pairwise_pairs = adjudication_groups(adjudication_pairs, lambda idx: (normalized_news[idx]["event_date_norm"], idx))
+    pairs_by_group = defaultdict(list)
+    group_index = {idx: number for number, group in enumerate(groups) for idx in group}
+    for i, j in adjudication_pairs:
+        if i in group_index and group_index[i] == group_index.get(j):
+            pairs_by_group[group_index[i]].append((i, j))
+    if groups:
+        logging.info(
+            f"Групповая проверка дубликатов: {len(groups)} групп вместо {len(adjudication_pairs) - len(pairwise_pairs)} пар, "
+            f"{len(pairwise_pairs)} пар попарно"
+        )
+
+    async def check_pair(i, j):
+        news_i = all_news[i]
+        news_j = all_news[j]
+        is_dupe = await is_duplicate(
+            session,
+            news_i["summary"], news_j["summary"],
+            news_i["event_date"], news_j["event_date"],
+            news_i["event_type"], news_j["event_type"],
+            news_i["entities"], news_j["entities"],
+            threshold=similarity_threshold
+        )
+        return (i, j, is_dupe)
+
     async def check_pair_limited(pair):
         async with local_sem:
-            i, j = pair
-            news_i = all_news[i]
-            news_j = all_news[j]
-            is_dupe = await is_duplicate(
-                session,
-                news_i["summary"], news_j["summary"],
-                news_i["event_date"], news_j["event_date"],
-                news_i["event_type"], news_j["event_type"],
-                news_i["entities"], news_j["entities"],
-                threshold=similarity_threshold
-            )
-            return (i, j, is_dupe)
+            return [await check_pair(*pair)]
 
-    tasks = [check_pair_limited(pair) for pair in pairs]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+    async def check_group_limited(number):
+        group, group_pairs = groups[number], pairs_by_group[number]
+        async with local_sem:
+            labels = await adjudicate_group(session, [all_news[idx] for idx in group])
+        if labels is None:
+            CLUSTER_ADJUDICATION_STATS["fallback_groups"] += 1
+            fallback = await asyncio.gather(*(check_pair_limited(pair) for pair in group_pairs))
+            return [verdict for pair_verdicts in fallback for verdict in pair_verdicts]
+        CLUSTER_ADJUDICATION_STATS["groups"] += 1
+        CLUSTER_ADJUDICATION_STATS["pairs"] += len(group_pairs)
+        label_of = dict(zip(group, labels))
+        timestamp = datetime.now()
+        group_verdicts = []
+        for i, j in group_pairs:
+            is_dupe = label_of[i] == label_of[j]
+            set_cache_entry("duplicate_cache", duplicate_cache, duplicate_cache_key(all_news[i]["summary"], all_news[j]["summary"]),
+                            is_dupe, MAX_DUPLICATE_CACHE_SIZE, timestamp)
+            group_verdicts.append((i, j, is_dupe))
+        return group_verdicts
+
+    tasks = [check_group_limited(number) for number in range(len(groups))] + [check_pair_limited(pair) for pair in pairwise_pairs]
+    # Проверки дубликатов идут в полосе dedup, внутри мониторинга — в фоновой
+    dedup_lane = "background" if LLM_PRIORITY.get() == "background" else "dedup"
+    priority_token = LLM_PRIORITY.set(dedup_lane)
+    try:
+        results, pending = await wait_with_deadline(tasks, deadline, label="проверка дубликатов")
+    finally:
+        LLM_PRIORITY.reset(priority_token)
+    if pending:
+        if leftover is not None:
+            leftover.extend(pending)
+        else:
+            run_in_background(asyncio.gather(*pending, return_exceptions=True), name="проверка дубликатов после дедлайна")
 
     graph = defaultdict(list)
-    for res in results:
-        if isinstance(res, Exception):
-            continue
+    # Каждая проверка (группа или пара) возвращает список решений по парам
+    llm_results = [
+        verdict for task_verdicts in results
+        if not isinstance(task_verdicts, BaseException) for verdict in task_verdicts
+    ]
+    for res in auto_results + llm_results:
+        if verdicts is not None:
+            verdicts.append(res)
         i, j, is_dupe = res
         if is_dupe:
             graph[i].append(j)
@@ -691,15 +888,7 @@ async def deduplicate_in_parallel(all_news, session, semaphore=None, similarity_
             unique_news.append(all_news[cluster[0]])
         else:
             candidates = [all_news[i] for i in cluster]
-            best = max(
-                candidates,
-                key=lambda x: (
-                    x["source"] in TRUSTED_SOURCES,
-                    x["informativeness"],
-                    x["category"] in ["Важная", "Риск"],
-                    x["date"]
-                )
-            )
+            best = max(candidates, key=representative_rank)
             unique_news.append(best)
             logging.debug(f"Кластер дубликатов ({len(cluster)}): выбрана '{best['summary'][:60]}...'")
 
@@ -717,6 +906,91 @@ def check_bank_name(text, bank_name):
                 return True
     return False
 
+# --- ПОВТОРНОЕ ИСПОЛЬЗОВАНИЕ РЕЗУЛЬТАТОВ АНАЛИЗА ПО СОДЕРЖИМОМУ ---
+ANALYSIS_REUSE_STATS = {"hits": 0, "misses": 0}
+
+def analysis_text_hash(text):
+    return hashlib.md5(normalize_text(text).encode('utf-8')).hexdigest()
+
+STORED_ANALYSIS_QUERY = register_query(
+    "stored_analysis", "SELECT is_relevant, result FROM analysis_results WHERE text_hash = ? AND bank = ?"
+)
+
+async def get_stored_analysis(text_hash, bank_name):
+    """(is_relevant, result) из analysis_results или None, если новость для банка ещё не анализировалась"""
+    try:
+        row = await fetchone(NEWS_DB, STORED_ANALYSIS_QUERY, (text_hash, bank_name))
+        if row is None:
+            return None
+        return bool(row[0]), json.loads(row[1]) if row[1] else None
+    except (sqlite3.Error, ValueError) as e:
+        logging.error(f"Ошибка чтения analysis_results: {e}")
+        return None
+
+async def store_analysis(text_hash, bank_name, result=None):
+    """Сохранение результата анализа; result=None — новость нерелевантна банку"""
+    await save_to_db_async([{"text_hash": text_hash, "bank": bank_name, "result": result}], "analysis_results")
+
+def build_news_from_analysis(news_item, result):
+    """Сборка новости из сохранённого результата анализа с полями конкретного источника"""
+    text = news_item.get("text", "")
+    date = news_item.get("date", "")
+    try:
+        event_date = datetime.strptime(result.get("event_date", ""), "%Y-%m-%d")
+    except ValueError:
+        event_date = normalize_date(date)
+    summary = result.get("summary", "")
+    return {
+        "bank": news_item.get("bank", ""),
+        "reg_number": news_item.get("reg_number", news_item.get("bank", "")),
+        "text": text,
+        "summary": summary,
+        "event_type": result.get("event_type", "неизвестно"),
+        "event_date": event_date,
+        "entities": result.get("entities", []),
+        "date": date,
+        "link": news_item.get("link", ""),
+        "source": news_item.get("link", ""),
+        "category": result.get("category", ""),
+        "sentiment": result.get("sentiment", "Нейтральная"),
+        "informativeness": calculate_informativeness(text),
+        "summary_hash": hashlib.md5(summary.encode('utf-8')).hexdigest()
+    }
+
+# --- ПОЧТИ-ДУБЛИКАТЫ ПО MINHASH/LSH ---
+MINHASH_STATS = {"reprints": 0, "summary_merged": 0, "summary_distinct": 0, "summary_llm": 0}
+
+# Выжимки сравниваются по множествам слов: перефразированные выжимки одного события
+# почти не имеют общих словесных триграмм
+SUMMARY_SHINGLE_SIZE = 1
+
+def _news_day(news, field="date"):
+    return normalize_date(news.get(field) or "").strftime("%Y-%m-%d")
+
+def raw_news_rank(news):
+    """Ключ выбора копии статьи до анализа: доверенный источник, затем самый полный текст"""
+    return (news.get("source") in TRUSTED_SOURCES, len(news.get("text", "")))
+
+# Пакетный TF-IDF предварительный отбор пар выжимок: выше верхнего порога — дубликат,
+# ниже нижнего — разные события, между порогами — решение LLM
+TFIDF_DUPLICATE_THRESHOLD = 0.85
+TFIDF_DISTINCT_THRESHOLD = 0.05
+TFIDF_PRESCREEN_STATS = {"merged": 0, "distinct": 0}
+
+# Эмбеддинги выжимок: добавленные пары-кандидаты и пары, объединённые без LLM
+EMBEDDING_STATS = {"candidates": 0, "merged": 0}
+
+def summary_signature(news):
+    """MinHash-сигнатура выжимки из индекса банка (вычисляется и запоминается при первом обращении)"""
+    summary = news.get("summary", "")
+    key = hashlib.md5(summary.encode('utf-8')).hexdigest()
+    index = get_minhash_index(news.get("bank", ""), "summary")
+    signature = index.get_signature(key)
+    if signature is None:
+        signature = index.signature(word_shingles(summary, size=SUMMARY_SHINGLE_SIZE))
+        index.insert(key, signature, _news_day(news, "event_date"))
+    return key, signature
+
 async def generate_news_dict(news_item, session, topic=None, semaphore=None, is_monitoring=False):
     text = news_item.get("text", "")
     bank_name = news_item.get("bank", "")
@@ -738,6 +1012,19 @@ async def generate_news_dict(news_item, session, topic=None, semaphore=None, is_
         logging.info(f"Новость исключена: банк {bank_name} не найден в тексте. Текст: {text[:100]}...")
         return None
 
+    # Тема уже проверена выше, поэтому сохранённый результат можно использовать для любой темы
+    text_hash = analysis_text_hash(text)
+    stored = await get_stored_analysis(text_hash, bank_name)
+    if stored is not None:
+        ANALYSIS_REUSE_STATS["hits"] += 1
+        is_relevant, result = stored
+        if not is_relevant:
+            logging.info(f"Новость исключена по сохранённому анализу: не релевантна для банка {bank_name}")
+            return None
+        logging.info(f"Использован сохранённый анализ новости для банка {bank_name}")
+        return build_news_from_analysis(news_item, result)
+    ANALYSIS_REUSE_STATS["misses"] += 1
+
     if any(keyword in normalized_text for keyword in IRRELEVANT_KEYWORDS):
         logging.info(f"Новость исключена: содержит нерелевантные ключевые слова для банка {bank_name}. Текст: {text[:100]}...")
         return None
@@ -761,15 +1048,21 @@ async def generate_news_dict(news_item, session, topic=None, semaphore=None, is_
     except ValueError:
         logging.warning(f"Не удалось разобрать дату: {date}")
 
+    if await should_skip_llm(text):
+        logging.info(f"Новость исключена локальным классификатором релевантности. Текст: {text[:100]}...")
+        return None
+
+    llm_text = prepare_text_for_llm(text, lambda sentence: check_bank_name(sentence, bank_name))
+
     prompt_relevance = (
         f"Относится ли новость к банку (АО,ПАО,ООО, КБ) '{bank_name}'{f' и теме \"{topic}\"' if topic else ''}? "
-        f"Текст: '{text}'. "
+        f"Текст: '{llm_text}'. "
         f"Контекст: '{bank_name}' — это банк, предоставляющий финансовые услуги (вклады, ипотека, кредиты, недвижимость, санкции, технологии, финансы, регуляторы, IPO, инфраструктура, установка банкоматов, открытие офисов{' и ' + topic if topic else ''}). "
         f"Исключи новости, где вместо банка '{bank_name}' упоминаются другие организации с похожими названиями (например, 'МТС Юрент', 'МТС Развлечения', 'МТС AdTech', 'МТС Телеком', или 'ЭКСПО-2017' вместо 'ЭКСПОБАНК'),банк может фигурировать в разных финансовых контекстах(повышение рейтинга акций, выкуп земли для строительства и тд) "
         f"Ответь одним словом: Да/Нет"
     )
     prompt_summary = (
-        f"Составь выжимку новости для банка '{bank_name}' на основе текста: '{text}', которая будет содержать важные события и изменения в банке. "
+        f"Составь выжимку новости для банка '{bank_name}' на основе текста: '{llm_text}', которая будет содержать важные события и изменения в банке. "
         f"Укажи тип события, дату события и ключевые сущности (упоминая '{bank_name}' и связанные организации, через запятую). "
         f"При-examples:"
         f"- Текст: 'МТС Банк снизил ставки по ипотеке до 7% с 28 июля.' Выжимка: '{bank_name} снизил ставки по ипотеке до 7% с 28 июля.' Тип события: ипотека. Дата события: 2025-07-28. Ключевые сущности: {bank_name}."
@@ -783,13 +1076,13 @@ async def generate_news_dict(news_item, session, topic=None, semaphore=None, is_
         f"Ключевые сущности: [сущности]"
     )
     prompt_category = (
-        f"Определи категорию новости для банка '{bank_name}': '{text}'. "
+        f"Определи категорию новости для банка '{bank_name}': '{llm_text}'. "
         f"Ответь одним словом: Реклама, Важная, Риск, Обычная. "
         f"Реклама — продукты (вклады, ипотека, кредиты, недвижимость); Важная — IPO, смена руководства, технологии, санкции, установка банкоматов; "
         f"Риск — штрафы, санкции, убытки, жалобы клиентов; Обычная — остальные."
     )
     prompt_sentiment = (
-        f"Определи тональность новости для банка '{bank_name}' на основе текста: '{text}'. "
+        f"Определи тональность новости для банка '{bank_name}' на основе текста: '{llm_text}'. "
         f"Ответь в формате: 'Тональность: [Позитивная/Негативная/Нейтральная]. Объяснение: [краткое объяснение (до 20 слов)]'. "
         f"Критерии:"
         f"- Позитивная: прибыль, рост, новые продукты, технологии, награды, расширение услуг, успешные сделки."
@@ -812,6 +1105,10 @@ async def generate_news_dict(news_item, session, topic=None, semaphore=None, is_
     relevance, summary_response, category, sentiment_response = responses
     if relevance.strip().lower() != "да":
         logging.info(f"Новость исключена: не релевантна для банка {bank_name}. Текст: {text[:100]}...")
+        # С темой ответ "Нет" может означать несоответствие теме, а не банку
+        if not topic:
+            await save_to_db_async([{"bank": bank_name, "text": text, "reason": "llm_relevance"}], "rejected_news")
+            await store_analysis(text_hash, bank_name)
         return None
 
     match_summary = re.search(
@@ -853,6 +1150,8 @@ async def generate_news_dict(news_item, session, topic=None, semaphore=None, is_
     irrelevant_indicators = ["отсутствуют релевантные события", "нет событий", "отсутствует информация"]
     if any(indicator in normalized_summary for indicator in irrelevant_indicators):
         logging.info(f"Новость исключена после вторичной проверки: summary содержит индикатор нерелевантности ({summary[:50]}...). Текст: {text[:100]}...")
+        await save_to_db_async([{"bank": bank_name, "text": text, "reason": "secondary_check"}], "rejected_news")
+        await store_analysis(text_hash, bank_name)
         return None
 
     if not check_bank_name(normalized_summary, bank_name):
@@ -861,6 +1160,7 @@ async def generate_news_dict(news_item, session, topic=None, semaphore=None, is_
             logging.info(f"Добавлено имя банка в summary: {summary[:50]}...")
         else:
             logging.info(f"Новость исключена после вторичной проверки: банк не найден ни в summary, ни в тексте ({summary[:50]}...). Текст: {text[:100]}...")
+            await store_analysis(text_hash, bank_name)
             return None
 
     logging.info(f"Новость прошла вторичную проверку: summary={summary[:50]}..., текст содержит банк={check_bank_name(normalized_text, bank_name)}")
@@ -900,23 +1200,108 @@ async def generate_news_dict(news_item, session, topic=None, semaphore=None, is_
         "informativeness": calculate_informativeness(text),
         "summary_hash": hashlib.md5(summary.encode('utf-8')).hexdigest()
     }
+    await store_analysis(text_hash, bank_name, {
+        "summary": summary,
+        "event_type": event_type,
+        "event_date": event_date.strftime("%Y-%m-%d"),
+        "entities": entities,
+        "category": news_dict["category"],
+        "sentiment": sentiment
+    })
     return news_dict
 
 # --- УСКОРЕННАЯ ФУНКЦИЯ analyze_all_news ---
-async def analyze_all_news(news_list, topic=None, max_per_event=2, similarity_threshold=0.7, is_monitoring=False):
+async def analyze_all_news(news_list, topic=None, max_per_event=2, similarity_threshold=0.7, is_monitoring=False, deadline=None, progress=None):
+    """
+    Полный анализ списка новостей. progress — необязательная корутина-обработчик
+    событий analyze_news_stream (для отображения хода анализа).
+    """
+    # Фоновые продолжения запросов остаются в фоновой полосе
+    lane = "background" if is_monitoring or LLM_PRIORITY.get() == "background" else "interactive"
+    priority_token = LLM_PRIORITY.set(lane)
+    try:
+        final_news = []
+        async with contextlib.aclosing(
+            analyze_news_stream(news_list, topic, max_per_event, similarity_threshold, is_monitoring, deadline)
+        ) as events:
+            async for event in events:
+                if progress is not None:
+                    await progress(event)
+                if event["type"] == "final":
+                    final_news = event["news"]
+        return final_news
+    finally:
+        LLM_PRIORITY.reset(priority_token)
+
+async def _finish_leftover_llm_work(session, pending):
+    """Дожидается LLM-задач, не успевших к дедлайну: их ответы попадают в кэш и хранилище анализа"""
+    try:
+        await asyncio.gather(*pending, return_exceptions=True)
+    finally:
+        await session.close()
+    await flush_all_caches_async()
+    logging.info(f"Фоновое завершение {len(pending)} LLM-задач после дедлайна")
+
+async def analyze_news_stream(news_list, topic=None, max_per_event=2, similarity_threshold=0.7, is_monitoring=False, deadline=None):
+    """
+    Потоковый режим анализа: асинхронный итератор событий по мере готовности.
+      {"type": "started", "found": N, "total": M} — после предварительной фильтрации;
+      {"type": "analyzed", "item": dict | None, "done": k, "total": M} — анализ новости завершён
+        (item=None, если новость отклонена или анализ не удался);
+      {"type": "final", "news": [...]} — итог после дедубликации и отбора по событиям.
+    Полоса приоритета LLM берётся из контекста вызывающего кода.
+    """
     timeout = aiohttp.ClientTimeout(total=120)
     semaphore = asyncio.Semaphore(10)
-    analyzed_news = []
-    async with aiohttp.ClientSession(timeout=timeout) as session:
+    leftover = []
+    item_tasks = []
+    final_news = []
+    ensure_cache_flusher()
+    session = aiohttp.ClientSession(timeout=timeout)
+    try:
         filtered_news = [news for news in news_list if check_bank_name(normalize_text(news.get("text", "")), news.get("bank", ""))]
+        filtered_news, url_collapsed, text_collapsed = collapse_exact_duplicates(filtered_news, raw_news_rank)
+        if url_collapsed or text_collapsed:
+            logging.info(f"Схлопнуто копий до анализа: {url_collapsed} по каноническому URL, {text_collapsed} по SimHash текста")
+        await ensure_minhash_indexes((news.get("bank", ""), "text") for news in filtered_news)
+        filtered_news, text_signatures, reprints = collapse_reprints(
+            filtered_news, analysis_text_hash, _news_day, include_history=is_monitoring
+        )
+        MINHASH_STATS["reprints"] += reprints
         logging.info(f"После предварительной фильтрации: {len(filtered_news)} новостей из {len(news_list)}")
-
-        async def process_news(news_item):
-            return await generate_news_dict(news_item, session, topic, semaphore, is_monitoring)
-
-        tasks = [process_news(news_item) for news_item in filtered_news]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        all_news = [r for r in results if r is not None and not isinstance(r, Exception)]
+        total = len(filtered_news)
+        yield {"type": "started", "found": len(news_list), "total": total}
+
+        async def process_news(index, news_item):
+            return index, await generate_news_dict(news_item, session, topic, semaphore, is_monitoring)
+
+        item_tasks = [asyncio.ensure_future(process_news(i, news_item)) for i, news_item in enumerate(filtered_news)]
+        analyzed_by_index = {}
+        pending = set(item_tasks)
+        done_count = 0
+        while pending:
+            wait_timeout = deadline.remaining() if deadline is not None else None
+            done, pending = await asyncio.wait(pending, timeout=wait_timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                deadline.mark_partial("анализ новостей")
+                logging.warning(
+                    f"Дедлайн запроса истёк: анализ новостей — готово {done_count} из {total}, остальное продолжится в фоне"
+                )
+                break
+            for task in done:
+                done_count += 1
+                item = None
+                if task.cancelled() or task.exception() is not None:
+                    if not task.cancelled():
+                        logging.error(f"Ошибка анализа новости: {task.exception()}")
+                else:
+                    index, item = task.result()
+                    if item is not None:
+                        analyzed_by_index[index] = item
+                yield {"type": "analyzed", "item": item, "done": done_count, "total": total}
+
+        # Исходный порядок новостей сохраняется для дедубликации
+        all_news = [analyzed_by_index[i] for i in sorted(analyzed_by_index)]
 
         logging.info(f"Запуск параллельной дедубликации для {len(all_news)} новостей...")
         # Отдельный семафор для дедубликации
@@ -926,7 +1311,9 @@ async def analyze_all_news(news_list, topic=None, max_per_event=2, similarity_th
             session, 
             semaphore=dedup_sem, 
             similarity_threshold=similarity_threshold,
-            max_parallel_pairs=15
+            max_parallel_pairs=15,
+            deadline=deadline,
+            leftover=leftover
         )
 
         groups = defaultdict(list)
@@ -934,7 +1321,6 @@ async def analyze_all_news(news_list, topic=None, max_per_event=2, similarity_th
             group_key = (normalize_event_type(news["event_type"]), news["event_date"])
             groups[group_key].append(news)
 
-        final_news = []
         for (event_type, event_date), group in groups.items():
             sorted_group = sorted(
                 group,
@@ -952,17 +1338,56 @@ async def analyze_all_news(news_list, topic=None, max_per_event=2, similarity_th
             )
 
         logging.info(f"Анализ завершен: {len(final_news)} финальных новостей")
-        if final_news:
+        logging.info(
+            f"LLM-запросы: отправлено {LLM_REQUEST_STATS['sent']}, из кэша {LLM_REQUEST_STATS['cache_hits']}, "
+            f"объединено с выполняющимися {LLM_REQUEST_STATS['coalesced']}"
+        )
+        logging.info(
+            f"Бюджет промптов: обработано {PROMPT_BUDGET_STATS['items']} текстов, обрезано {PROMPT_BUDGET_STATS['truncated']}, "
+            f"сэкономлено ~{prompt_tokens_saved()} токенов"
+        )
+        logging.info(f"Состояние диспетчера LLM: {LLM_DISPATCHER.snapshot()}")
+        logging.info(
+            f"Предфильтр релевантности: проверено {PREFILTER_STATS['checked']}, отброшено без LLM {PREFILTER_STATS['rejected']}"
+        )
+        if deadline is not None and deadline.partial:
+            # Частичный результат не сохраняем: полный набор запишет фоновое завершение
+            logging.info(f"Частичный результат по дедлайну ({', '.join(deadline.reasons)}), в фоне осталось {len(leftover)} LLM-задач")
+        elif final_news:
             if is_monitoring:
                 from monitoring import save_to_monitoring_db_async
                 await save_to_monitoring_db_async(final_news, table_name="analyzed_monitored_news")
             else:
                 from utils import save_to_db_async
+                for news in final_news:
+                    news.setdefault("topic", topic or "")
                 await save_to_db_async(final_news, table_name="analyzed_news")
 
-        save_cache()
-        save_duplicate_cache()
-        save_hard_duplicate_cache()
-        save_soft_duplicate_cache()
+        # Перепечатки в следующих циклах пропускаются, поэтому запоминаются только тексты с завершённым
+        # анализом; при частичном результате (дедлайн) — ни один, набор ещё не сохранён
+        if deadline is None or not deadline.partial:
+            remember_texts([record for i, record in enumerate(text_signatures) if i in analyzed_by_index])
+        await save_to_db_async(collect_minhash_rows(), "minhash_signatures")
+        await save_to_db_async(collect_embedding_rows(), "news_embeddings")
+        logging.info(
+            f"MinHash: перепечаток {MINHASH_STATS['reprints']}, выжимок объединено без LLM {MINHASH_STATS['summary_merged']}, "
+            f"разведено без LLM {MINHASH_STATS['summary_distinct']}; TF-IDF объединено {TFIDF_PRESCREEN_STATS['merged']}, "
+            f"разведено {TFIDF_PRESCREEN_STATS['distinct']}; эмбеддинги: кандидатов {EMBEDDING_STATS['candidates']}, "
+            f"объединено {EMBEDDING_STATS['merged']}; отправлено в LLM {MINHASH_STATS['summary_llm']}, из них "
+            f"{CLUSTER_ADJUDICATION_STATS['pairs']} решено в {CLUSTER_ADJUDICATION_STATS['groups']} групповых запросах "
+            f"(неразобранных групп {CLUSTER_ADJUDICATION_STATS['fallback_groups']})"
+        )
 
-    return final_news
\ No newline at end of file
+        await flush_all_caches_async()
+        yield {"type": "final", "news": final_news}
+    finally:
+        # Незавершённые анализы (дедлайн или прерванный потребитель) дорабатывают в фоне
+        leftover.extend(task for task in item_tasks if not task.done())
+        if leftover:
+            # Через дедлайн запроса их дожидается фоновое завершение, а не запускает второй анализ параллельно
+            if deadline is not None:
+                deadline.defer(_finish_leftover_llm_work(session, leftover), name="LLM после дедлайна")
+            else:
+                run_in_background(_finish_leftover_llm_work(session, leftover), name="LLM после дедлайна")
+        else:
+            await session.close()
@@ -21,6 +21,10 @@ from email.utils import parsedate_to_datetime
 import sqlite3
 from utils import *
 from news_analyzer import *
+from dedup_index import canonical_url
+from parse_coverage import SOURCES, fetch_with_coverage, plan_missing, report_source_failure
+from news_search import search_analyzed_news, search_parsed_news
+import storage
 
 init_db()  # Инициализация БД при запуске модуля
 
@@ -145,6 +149,7 @@ async def fetch_news_from_apis(bank_name, date_from, date_to, topic=None, is_mon
         for result in results:
             if isinstance(result, Exception):
                 logging.error(f"Ошибка при получении новостей из API: {result}")
+                report_source_failure(f"API: {result}")
             elif result:
                 news_articles.extend(result)
     seen_texts = set()
@@ -263,8 +268,10 @@ async def fetch_newsapi_news(session, bank_name, aliases, date_from, date_to, to
                 return news_articles
             else:
                 logging.error(f"Ошибка в ответе NewsAPI: {data}")
+                report_source_failure("NewsAPI")
     except aiohttp.ClientError as e:
         logging.error(f"Ошибка при запросе к NewsAPI: {e}")
+        report_source_failure("NewsAPI")
     return []
 
 async def fetch_gnews_news(session, bank_name, aliases, date_from, date_to, topic=None):
@@ -312,12 +319,14 @@ async def fetch_gnews_news(session, bank_name, aliases, date_from, date_to, topi
                     return news_articles
                 else:
                     logging.error(f"Ошибка HTTP {response.status} в GNews")
+                    report_source_failure("GNews")
                     if response.status == 429:
                         await asyncio.sleep(2 * (attempt + 1))
                     else:
                         return []
         except aiohttp.ClientError as e:
             logging.error(f"Ошибка при запросе к GNews: {e}")
+            report_source_failure("GNews")
     return []
 
 async def fetch_mediastack_news(session, bank_name, aliases, date_from, date_to, topic=None):
@@ -364,8 +373,10 @@ async def fetch_mediastack_news(session, bank_name, aliases, date_from, date_to,
                 return news_articles
             else:
                 logging.error(f"Ошибка HTTP {response.status} в Mediastack")
+                report_source_failure("Mediastack")
     except aiohttp.ClientError as e:
         logging.error(f"Ошибка при запросе к Mediastack: {e}")
+        report_source_failure("Mediastack")
     return []
 
 async def fetch_currents_news(session, bank_name, aliases, date_from, date_to, topic=None):
@@ -412,8 +423,10 @@ async def fetch_currents_news(session, bank_name, aliases, date_from, date_to, t
                 return news_articles
             else:
                 logging.error(f"Ошибка HTTP {response.status} в Currents")
+                report_source_failure("Currents")
     except aiohttp.ClientError as e:
         logging.error(f"Ошибка при запросе к Currents: {e}")
+        report_source_failure("Currents")
     return []
 
 async def fetch_rss_news(bank_name, date_from, date_to, topic=None, is_monitoring=False):
@@ -431,6 +444,7 @@ async def fetch_rss_news(bank_name, date_from, date_to, topic=None, is_monitorin
         for result in results:
             if isinstance(result, Exception):
                 logging.error(f"Ошибка при парсинге RSS или inkazan: {result}")
+                report_source_failure(f"RSS: {result}")
                 continue
             elif result:
                 for item in result:
@@ -506,6 +520,7 @@ async def parse_single_rss_feed(session, rss_feed, bank_name, reg_number, aliase
                     continue
     except Exception as e:
         logging.error(f"Ошибка при запросе к RSS-ленте {rss_feed}: {e}")
+        report_source_failure(rss_feed)
     return articles
 
 async def fetch_1000bankov_news(bank_name, date_from, date_to, topic=None, is_monitoring=False):
@@ -519,6 +534,7 @@ async def fetch_1000bankov_news(bank_name, date_from, date_to, topic=None, is_mo
             date_to_dt = datetime.strptime(date_to, "%Y-%m-%d").date()
         except ValueError:
             logging.error(f"Неверный формат дат: {date_from}, {date_to}")
+            report_source_failure("1000bankov: даты")
             return []
         async with async_playwright() as p:
             browser = await p.chromium.launch(headless=True)
@@ -569,6 +585,7 @@ async def fetch_1000bankov_news(bank_name, date_from, date_to, topic=None, is_mo
             await browser.close()
     except Exception as e:
         logging.error(f"Ошибка парсинга с сайта 1000bankov: {e}")
+        report_source_failure("1000bankov")
     logging.info(f"Найдено {len(news_data)} новостей с 1000bankov для {bank_name}")
     for item in news_data:
         item["topic"] = topic or ""
@@ -589,6 +606,7 @@ async def scrape_inkazan_news(session, bank_name, aliases, date_from, date_to, t
         async with session.get(url, headers=headers) as response:
             if response.status != 200:
                 logging.warning(f"inkazan.ru недоступен: HTTP {response.status}")
+                report_source_failure("inkazan.ru")
                 return []
             html_content = await response.text()
             soup = BeautifulSoup(html_content, 'html.parser')
@@ -658,6 +676,7 @@ async def scrape_inkazan_news(session, bank_name, aliases, date_from, date_to, t
                     logging.error(f"Ошибка при обработке новости с inkazan.ru: {e}")
     except Exception as e:
         logging.error(f"Ошибка при запросе к inkazan.ru: {e}")
+        report_source_failure("inkazan.ru")
     return articles
 
 async def parse_channel(client, channel, bank_name, date_from, date_to, topic, aliases, reg_number):
@@ -694,9 +713,11 @@ async def parse_channel(client, channel, bank_name, date_from, date_to, topic, a
             await asyncio.sleep(e.seconds + random.uniform(0, 2))
         except UnauthorizedError:
             logging.error(f"Неавторизованный доступ к каналу {channel}")
+            report_source_failure(f"telegram_{channel}")
             break
         except Exception as e:
             logging.error(f"Ошибка парсинга канала {channel}: {e}")
+            report_source_failure(f"telegram_{channel}")
             break
     return all_messages
 
@@ -709,6 +730,7 @@ async def fetch_telegram_news(bank_name, date_from, date_to, topic=None, task_id
     if not session_info:
         session_type = "мониторинга" if is_monitoring else "ручного парсинга"
         logging.warning(f"Нет доступных сессий {session_type} для парсинга Telegram для {bank_name}, task_id={task_id}")
+        report_source_failure("telegram: нет сессии")
         return []
     client = None
     try:
@@ -723,6 +745,7 @@ async def fetch_telegram_news(bank_name, date_from, date_to, topic=None, task_id
         client.session._execute('PRAGMA busy_timeout = 5000')
         if not await client.is_user_authorized():
             logging.error(f"Сессия {session_info['name']} недействительна.")
+            report_source_failure("telegram: недействительная сессия")
             try:
                 os.remove(f"sessions/{session_info['name']}.session")
                 logging.info(f"Удалена недействительная сессия {session_info['name']}")
@@ -750,6 +773,7 @@ async def fetch_telegram_news(bank_name, date_from, date_to, topic=None, task_id
             await save_to_db_async(all_messages, "parsed_news")
     except Exception as e:
         logging.error(f"Ошибка при парсинге Telegram для {bank_name} (task_id={task_id}): {e}")
+        report_source_failure("telegram")
     finally:
         release_session(session_info)
         if client and client.is_connected():
@@ -834,33 +858,45 @@ async def process_telegram_task(session_info, task, is_monitoring=False):
 
 # --- ИСПРАВЛЕННЫЕ ФУНКЦИИ ЧТЕНИЯ ИЗ БД ---
 
-def get_analyzed_news_for_period(bank_name, date_from, date_to, topic=None):
-    """Чтение новостей из analyzed_news, если период покрыт СВЕЖИМ парсингом (менее 1 часа)"""
+PARSE_HISTORY_QUERY = storage.register_query("parse_history_by_bank", '''
+    SELECT last_parse_time, last_from, last_to FROM parse_history WHERE bank = ?
+''')
+ANALYZED_FOR_PERIOD_QUERY = storage.register_query("analyzed_news_for_period", '''
+    SELECT bank, reg_number, text, summary, event_type, event_date, entities, date, link, source, category, sentiment, informativeness
+    FROM analyzed_news
+    WHERE bank = ? 
+    AND date >= ?
+    AND date <= ?
+    AND (topic = ? OR ? = '')
+''')
+PARSED_FOR_PERIOD_QUERY = storage.register_query("parsed_news_for_period", '''
+    SELECT bank, reg_number, text, date, link, source, topic
+    FROM parsed_news
+    WHERE bank = ? 
+    AND date >= ?
+    AND date <= ?
+    AND (topic = ? OR ? = '')
+''')
+
+async def get_analyzed_news_for_period(bank_name, date_from, date_to, topic=None):
+    """
+    Чтение новостей из analyzed_news, если период покрыт всеми группами источников
+    и последний парсинг банка СВЕЖИЙ (менее 1 часа)
+    """
     try:
-        conn = sqlite3.connect('news.db', timeout=30)
-        cursor = conn.cursor()
         topic = topic or ""
-        cursor.execute('''
-            SELECT last_parse_time, last_from, last_to FROM parse_history WHERE bank = ?
-        ''', (bank_name,))
-        result = cursor.fetchone()
-        if result and result[1] is not None and result[2] is not None:
-            last_parse_str, last_from, last_to = result
-            last_parse = datetime.strptime(last_parse_str, "%Y-%m-%d %H:%M:%S")
-            if (datetime.now() - last_parse) < timedelta(hours=1) and last_from <= date_from and date_to <= last_to:
-                cursor.execute('''
-                    SELECT bank, reg_number, text, summary, event_type, event_date, entities, date, link, source, category, sentiment, informativeness
-                    FROM analyzed_news
-                    WHERE bank = ? 
-                    AND date >= ?
-                    AND date <= ?
-                    AND (topic = ? OR ? = '')
-                ''', (bank_name, date_from, date_to, topic, topic))
-                rows = cursor.fetchall()
+        result = await storage.fetchone(storage.NEWS_DB, PARSE_HISTORY_QUERY, (bank_name,))
+        if result:
+            last_parse = datetime.strptime(result[0], "%Y-%m-%d %H:%M:%S")
+            missing = await plan_missing(bank_name, topic, date_from, date_to)
+            if (datetime.now() - last_parse) < timedelta(hours=1) and not any(missing.values()):
+                rows = await storage.fetchall(
+                    storage.NEWS_DB, ANALYZED_FOR_PERIOD_QUERY, (bank_name, date_from, date_to, topic, topic)
+                )
                 logging.info(f"Найдено {len(rows)} новостей в кэше analyzed для {bank_name} за {date_from}-{date_to} (период покрыт)")
                 return [{
                     "bank": row[0], "reg_number": row[1], "text": row[2], "summary": row[3],
-                    "event_type": row[4], "event_date": row[5], "entities": row[6].split(",") if row[6] else [],
+                    "event_type": row[4], "event_date": row[5], "entities": parse_entities(row[6]),
                     "date": row[7], "link": row[8], "source": row[9], "category": row[10],
                     "sentiment": row[11], "informativeness": row[12]
                 } for row in rows]
@@ -870,28 +906,15 @@ def get_analyzed_news_for_period(bank_name, date_from, date_to, topic=None):
     except sqlite3.Error as e:
         logging.error(f"Ошибка чтения из БД analyzed_news: {e}")
         return None
-    finally:
-        if 'conn' in locals() and conn:
-            conn.close()
 
-def get_parsed_news_for_period(bank_name, date_from, date_to, topic=None):
+async def get_parsed_news_for_period(bank_name, date_from, date_to, topic=None):
     """
     Чтение ВСЕХ сырых новостей из parsed_news за период.
     Убран фильтр по last_fetch_time, так как parsed_news - это хранилище, а не кэш.
     """
     try:
-        conn = sqlite3.connect('news.db', timeout=30)
-        cursor = conn.cursor()
         topic = topic or ""
-        cursor.execute('''
-            SELECT bank, reg_number, text, date, link, source, topic
-            FROM parsed_news
-            WHERE bank = ? 
-            AND date >= ?
-            AND date <= ?
-            AND (topic = ? OR ? = '')
-        ''', (bank_name, date_from, date_to, topic, topic))
-        rows = cursor.fetchall()
+        rows = await storage.fetchall(storage.NEWS_DB, PARSED_FOR_PERIOD_QUERY, (bank_name, date_from, date_to, topic, topic))
         logging.info(f"Найдено {len(rows)} сырых новостей в parsed_news для {bank_name} за {date_from}-{date_to}")
         return [{
             "bank": row[0], "reg_number": row[1], "text": row[2], "date": row[3],
@@ -900,30 +923,44 @@ def get_parsed_news_for_period(bank_name, date_from, date_to, topic=None):
     except sqlite3.Error as e:
         logging.error(f"Ошибка чтения из БД parsed_news: {e}")
         return []
-    finally:
-        if 'conn' in locals() and conn:
-            conn.close()
-
-def get_parse_history(bank_name):
-    """Получение last_parse_time, last_from, last_to из parse_history"""
-    try:
-        conn = sqlite3.connect('news.db', timeout=30)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT last_parse_time, last_from, last_to FROM parse_history WHERE bank = ?
-        ''', (bank_name,))
-        result = cursor.fetchone()
-        return result
-    except sqlite3.Error as e:
-        logging.error(f"Ошибка чтения parse_history: {e}")
-        return None
-    finally:
-        conn.close()
 
 # --- ГЛАВНАЯ ИСПРАВЛЕННАЯ ФУНКЦИЯ ---
 
-async def fetch_all_news(selected_bank, date_from, date_to, topic=None, chat_id=None, is_monitoring=False):
-    """Сбор всех новостей с корректным объединением данных."""
+async def get_topic_news_from_index(selected_bank, date_from, date_to, topic, deadline=None, progress=None):
+    """
+    Ответ на запрос с темой по периоду, уже собранному без темы, из полнотекстового индекса (BM25):
+    при свежем общем парсинге — готовые выжимки analyzed_news, иначе найденные сырые новости
+    анализируются с темой (повторные анализы берутся из хранилища результатов).
+    None, если период без темы покрыт не полностью или индекс недоступен.
+    """
+    missing = await plan_missing(selected_bank, "", date_from, date_to)
+    if any(missing.values()):
+        return None
+    parse_info = await storage.fetchone(storage.NEWS_DB, PARSE_HISTORY_QUERY, (selected_bank,))
+    if parse_info and (datetime.now() - datetime.strptime(parse_info[0], "%Y-%m-%d %H:%M:%S")) < timedelta(hours=1):
+        analyzed_news = await search_analyzed_news(selected_bank, topic, date_from, date_to)
+        if analyzed_news is not None:
+            logging.info(f"Тема '{topic}' для {selected_bank} за {date_from}-{date_to}: {len(analyzed_news)} выжимок из индекса")
+            return analyzed_news
+    raw_news = await search_parsed_news(selected_bank, topic, date_from, date_to)
+    if raw_news is None:
+        return None
+    logging.info(f"Тема '{topic}' для {selected_bank} за {date_from}-{date_to}: {len(raw_news)} сырых новостей из индекса, анализ")
+    analyzed_news = await analyze_all_news(raw_news, topic=topic, is_monitoring=False, deadline=deadline, progress=progress)
+    if deadline is not None and deadline.partial:
+        deadline.defer(
+            _complete_in_background(selected_bank, date_from, date_to, topic, False, list(deadline.deferred), raw_news),
+            name=f"доанализ {selected_bank}"
+        )
+    return analyzed_news
+
+async def fetch_all_news(selected_bank, date_from, date_to, topic=None, chat_id=None, is_monitoring=False, deadline=None, progress=None):
+    """
+    Сбор всех новостей с корректным объединением данных.
+    При переданном deadline возвращает то, что готово к его истечению (deadline.partial),
+    а сбор и анализ остального завершаются в фоне и наполняют кэш для следующего запроса.
+    progress получает события хода анализа (см. analyze_news_stream).
+    """
     logging.info(f"Начало сбора всех новостей для {selected_bank}, chat_id={chat_id}, даты: {date_from} - {date_to}, тема: {topic}, monitoring={is_monitoring}")
     
     if is_monitoring:
@@ -935,108 +972,144 @@ async def fetch_all_news(selected_bank, date_from, date_to, topic=None, chat_id=
         return analyzed_news
 
     # 1. Проверяем кэш проанализированных новостей (analyzed_news)
-    analyzed_news = get_analyzed_news_for_period(selected_bank, date_from, date_to, topic)
+    analyzed_news = await get_analyzed_news_for_period(selected_bank, date_from, date_to, topic)
     if analyzed_news is not None:
         logging.info(f"Возвращаем новости из analyzed_news для {selected_bank} за {date_from}-{date_to} (len: {len(analyzed_news)})")
         return analyzed_news
 
-    # 2. Получаем историю парсинга
-    parse_info = get_parse_history(selected_bank)
-    if parse_info:
-        last_parse_time, last_from, last_to = parse_info
-        last_parse_dt = datetime.strptime(last_parse_time, "%Y-%m-%d %H:%M:%S")
-        fresh = (datetime.now() - last_parse_dt) < timedelta(hours=4)
-    else:
-        fresh = False
-        last_from = None
-        last_to = None
-
-    date_from_dt = datetime.strptime(date_from, "%Y-%m-%d").date()
-    date_to_dt = datetime.strptime(date_to, "%Y-%m-%d").date()
-    if last_from:
-        last_from_dt = datetime.strptime(last_from, "%Y-%m-%d").date()
-        last_to_dt = datetime.strptime(last_to, "%Y-%m-%d").date()
-    else:
-        last_from_dt = None
-        last_to_dt = None
+    # 1а. Тема по периоду, уже собранному без темы, — из полнотекстового индекса без повторного парсинга
+    if topic:
+        indexed_news = await get_topic_news_from_index(selected_bank, date_from, date_to, topic, deadline, progress)
+        if indexed_news is not None:
+            return indexed_news
 
-    # 3. Определяем, какие периоды нужно допарсить
-    periods_to_parse = []
-    if last_from_dt is None or last_to_dt is None:
-        # Никогда не парсили — парсим весь период
-        periods_to_parse.append((date_from, date_to))
-    else:
-        # Допарсинг прошлого
-        if date_from_dt < last_from_dt:
-            end = (last_from_dt - timedelta(days=1)).strftime("%Y-%m-%d")
-            periods_to_parse.append((date_from, end))
-        # Допарсинг будущего/настоящего
-        if date_to_dt > last_to_dt:
-            start = (last_to_dt + timedelta(days=1)).strftime("%Y-%m-%d")
-            periods_to_parse.append((start, date_to))
+    # 2. Недостающие поддиапазоны периода по каждой группе источников
+    plan = await plan_missing(selected_bank, topic, date_from, date_to)
 
-    # 4. Парсим недостающие периоды и сохраняем СЫРЫЕ данные
-    for start, end in periods_to_parse:
-        logging.info(f"Допарсинг недостающего периода для {selected_bank}: {start} по {end}")
-        missing_news = await _perform_full_parsing(selected_bank, start, end, topic, chat_id, is_monitoring)
+    # 3. Парсим только недостающее и сохраняем СЫРЫЕ данные; группа источников
+    # отмечает диапазон покрытым только при успешном сборе. Сбор ограничен так,
+    # чтобы анализу осталось ANALYSIS_RESERVE_SECONDS (при короткой доле бюджета — половина)
+    if any(plan.values()):
+        for source, ranges in plan.items():
+            if ranges:
+                logging.info(f"Допарсинг {source} для {selected_bank}: {', '.join(f'{start} по {end}' for start, end in ranges)}")
+        fetch_deadline = (
+            deadline.reserve(min(ANALYSIS_RESERVE_SECONDS, deadline.seconds / 2)) if deadline is not None else None
+        )
+        missing_news = await _perform_full_parsing(selected_bank, date_from, date_to, topic, chat_id, is_monitoring, fetch_deadline, plan)
         await save_to_db_async(missing_news, "parsed_news")
+    else:
+        logging.info(f"Период {date_from}-{date_to} для {selected_bank} полностью покрыт всеми источниками")
 
-    # 5. Обновляем историю парсинга
-    new_last_from = min(date_from_dt, last_from_dt) if last_from_dt else date_from_dt
-    new_last_to = max(date_to_dt, last_to_dt) if last_to_dt else date_to_dt
-    await update_parse_time(selected_bank, new_last_from.strftime("%Y-%m-%d"), new_last_to.strftime("%Y-%m-%d"))
+    # 4. Обновляем историю парсинга; период, не собранный полностью, обновит фоновое завершение
+    fetch_partial = deadline is not None and deadline.partial
+    if not fetch_partial:
+        await update_parse_time(selected_bank, date_from, date_to)
 
-    # 6. Главное изменение: Получаем ВСЕ сырые новости за запрошенный период из БД
-    all_raw_news = get_parsed_news_for_period(selected_bank, date_from, date_to, topic)
+    # 5. Главное изменение: Получаем ВСЕ сырые новости за запрошенный период из БД
+    all_raw_news = await get_parsed_news_for_period(selected_bank, date_from, date_to, topic)
 
-    # 7. Анализируем ВСЕ собранные сырые данные
+    # 6. Анализируем ВСЕ собранные сырые данные
     logging.info(f"Анализ всех ({len(all_raw_news)}) сырых новостей для {selected_bank} за {date_from}-{date_to}")
-    analyzed_news = await analyze_all_news(all_raw_news, topic=topic, is_monitoring=False)
-    if analyzed_news:
+    analyzed_news = await analyze_all_news(all_raw_news, topic=topic, is_monitoring=False, deadline=deadline, progress=progress)
+    if deadline is not None and deadline.partial:
+        # Одно фоновое завершение: дожидается досбора источников и незавершённых анализов,
+        # затем анализирует период целиком (готовое берётся из кэша и хранилища результатов)
+        deadline.defer(
+            _complete_in_background(selected_bank, date_from, date_to, topic, fetch_partial, list(deadline.deferred)),
+            name=f"досбор и доанализ {selected_bank}"
+        )
+    elif analyzed_news:
         await save_to_db_async(analyzed_news, "analyzed_news")
 
-    logging.info(f"Объединенные и проанализированные новости для {selected_bank} {date_from}-{date_to}: {len(analyzed_news)}")
+    logging.info(f"Объединенные и проанализированные новости для {selected_bank} {date_from}-{date_to}: {len(analyzed_news)}"
+                 f"{' (частично, дедлайн)' if deadline is not None and deadline.partial else ''}")
     return analyzed_news
 
-async def _perform_full_parsing(selected_bank, date_from, date_to, topic, chat_id, is_monitoring):
-    """Выполняет полный парсинг и возвращает сырые новости."""
-    task_id = f"{chat_id}_{selected_bank}_{int(datetime.now().timestamp())}_{'monitoring' if is_monitoring else 'main'}"
-    all_news = []
-    seen_links = set()
-    tasks = [
-        fetch_news_from_apis(selected_bank, date_from, date_to, topic, is_monitoring),
-        fetch_rss_news(selected_bank, date_from, date_to, topic, is_monitoring),
-        fetch_1000bankov_news(selected_bank, date_from, date_to, topic, is_monitoring),
-        fetch_telegram_news(selected_bank, date_from, date_to, topic, task_id, is_monitoring)
-    ]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+async def _complete_in_background(selected_bank, date_from, date_to, topic, update_history, pending, raw_news=None):
+    """
+    Фоновое завершение запроса после дедлайна: дожидается досбора источников и
+    незавершённых анализов (pending), обновляет историю парсинга и анализирует период
+    целиком в фоновой полосе LLM.
+    Уже готовые ответы берутся из кэша и хранилища результатов, поэтому
+    повторный анализ стоит только недостающих запросов. raw_news — уже отобранные
+    сырые новости (поиск по индексу) вместо всех новостей периода.
+    """
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+    if update_history:
+        await update_parse_time(selected_bank, date_from, date_to)
+    all_raw_news = raw_news if raw_news is not None else await get_parsed_news_for_period(selected_bank, date_from, date_to, topic)
+    priority_token = LLM_PRIORITY.set("background")
+    try:
+        analyzed_news = await analyze_all_news(all_raw_news, topic=topic, is_monitoring=False)
+    finally:
+        LLM_PRIORITY.reset(priority_token)
+    if analyzed_news:
+        await save_to_db_async(analyzed_news, "analyzed_news")
+    logging.info(f"Фоновое завершение для {selected_bank} {date_from}-{date_to}: {len(analyzed_news)} новостей")
+
+def _merge_source_results(results, all_news, seen_links):
     for result in results:
-        if isinstance(result, Exception):
+        if isinstance(result, BaseException):
             logging.error(f"Ошибка при сборе новостей: {result}")
             continue
         elif result:
             for news in result:
-                if news["link"] not in seen_links:
+                # UTM-метки, мобильные и AMP-версии одной статьи дают один канонический URL
+                link = canonical_url(news["link"])
+                if link not in seen_links:
                     all_news.append(news)
-                    seen_links.add(news["link"])
+                    seen_links.add(link)
+
+async def _save_late_sources(selected_bank, pending):
+    """Дожидается источников, не успевших к дедлайну, и сохраняет их новости в parsed_news"""
+    results = await asyncio.gather(*pending, return_exceptions=True)
+    late_news = []
+    _merge_source_results(results, late_news, set())
+    await save_to_db_async(late_news, "parsed_news")
+    logging.info(f"Фоновый сбор для {selected_bank} завершён: сохранено {len(late_news)} новостей из запоздавших источников")
+
+async def _perform_full_parsing(selected_bank, date_from, date_to, topic, chat_id, is_monitoring, deadline=None, plan=None):
+    """
+    Выполняет парсинг и возвращает сырые новости. plan — недостающие диапазоны по группам
+    источников (см. plan_missing); без него каждая группа собирает весь период.
+    """
+    task_id = f"{chat_id}_{selected_bank}_{int(datetime.now().timestamp())}_{'monitoring' if is_monitoring else 'main'}"
+    all_news = []
+    seen_links = set()
+    if plan is None:
+        plan = {source: [(date_from, date_to)] for source in SOURCES}
+    fetchers = {
+        "apis": lambda start, end: fetch_news_from_apis(selected_bank, start, end, topic, is_monitoring),
+        "rss": lambda start, end: fetch_rss_news(selected_bank, start, end, topic, is_monitoring),
+        "1000bankov": lambda start, end: fetch_1000bankov_news(selected_bank, start, end, topic, is_monitoring),
+        "telegram": lambda start, end: fetch_telegram_news(selected_bank, start, end, topic, task_id, is_monitoring)
+    }
+    tasks = [
+        fetch_with_coverage(selected_bank, source, topic, start, end, fetchers[source](start, end))
+        for source, ranges in plan.items()
+        for start, end in ranges
+    ]
+    results, pending = await wait_with_deadline(tasks, deadline, label=f"сбор источников для {selected_bank}")
+    _merge_source_results(results, all_news, seen_links)
+    if pending:
+        # Источники, не уложившиеся в дедлайн, дописывают parsed_news в фоне
+        deadline.defer(_save_late_sources(selected_bank, pending), name=f"сбор {selected_bank}")
     logging.info(f"Собрано {len(all_news)} сырых новостей для {selected_bank} из всех источников после фильтрации дубликатов")
     return all_news
 
 async def update_parse_time(bank_name, date_from, date_to):
     """Обновляет время последнего парсинга для банка с периодом"""
     try:
-        conn = sqlite3.connect('news.db', timeout=30)
-        cursor = conn.cursor()
-        cursor.execute('''
+        await storage.execute(storage.NEWS_DB, '''
             INSERT OR REPLACE INTO parse_history (bank, last_parse_time, last_from, last_to) 
             VALUES (?, CURRENT_TIMESTAMP, ?, ?)
         ''', (bank_name, date_from, date_to))
-        conn.commit()
         logging.info(f"Обновлено время последнего парсинга для {bank_name} с периодом {date_from}-{date_to}")
     except sqlite3.Error as e:
         logging.error(f"Ошибка обновления parse_history для {bank_name}: {e}")
-    finally:
-        conn.close()
+
 async def fetch_all_news_parallel(bank_list, date_from, date_to, topic=None, chat_id=None, is_monitoring=False):
     """Параллельный сбор новостей для нескольких банков."""
     if not bank_list:
@@ -0,0 +1,172 @@
+# news_search.py (полнотекстовый индекс FTS5 по сырым текстам и выжимкам, поиск по теме с ранжированием BM25)
+
+import logging
+import re
+import sqlite3
+
+from storage import NEWS_DB, fetchall, register_query
+
+# unicode61 приводит кириллицу к нижнему регистру и делит по буквам/цифрам; remove_diacritics 2 — для латиницы
+FTS_TOKENIZER = "unicode61 remove_diacritics 2"
+
+# Максимум новостей, возвращаемых поиском по теме
+FTS_RESULT_LIMIT = 500
+
+# Слова темы короче этого (предлоги, союзы) в запрос не попадают
+MIN_TERM_LENGTH = 3
+
+# Слова длиннее порога ищутся по основе без двух последних букв (окончания): "санкции" -> "санкц*"
+STEM_MIN_LENGTH = 6
+
+# Ключевые основы известных тем (общие для фильтра при сборе и для полнотекстового поиска)
+TOPIC_KEYWORDS = {
+    "ипотека": ["ипотек", "ипотечн", "жилье", "недвижимость", "кредит на жилье"],
+    "кредит": ["кредит", "заем", "ссуд", "потребительский кредит", "автокредит"],
+    "санкции": ["санкци", "ограничен", "блокиров", "запрет"],
+    "технологии": ["технолог", "it", "айти", "инновац", "цифров", "онлайн", "мобильн", "приложен"],
+    "финансы": ["финанс", "капитал", "актив", "прибыль", "убыток", "рентабельность"],
+    "открытие офисов": ["офис", "отделен", "филиал", "точка", "банкомат", "атм"],
+    "штраф": ["штраф", "взыскан", "нарушен", "санкци", "пени", "неустойка"],
+    "жалоба клиента": ["жалоб", "претензи", "недовольств", "обман", "мошенничеств", "суд", "исковое"],
+}
+
+# Индексируемые таблицы: FTS-таблица -> (таблица с содержимым, столбец текста)
+FTS_TABLES = {
+    "parsed_news_fts": ("parsed_news", "text"),
+    "analyzed_news_fts": ("analyzed_news", "summary"),
+}
+
+FTS_AVAILABLE = True
+
+SEARCH_PARSED_QUERY = register_query("fts_parsed_news", '''
+    SELECT p.bank, p.reg_number, p.text, p.date, p.link, p.source, p.topic
+    FROM parsed_news_fts
+    JOIN parsed_news p ON p.id = parsed_news_fts.rowid
+    WHERE parsed_news_fts MATCH ? AND p.bank = ? AND p.date >= ? AND p.date <= ?
+    ORDER BY bm25(parsed_news_fts)
+    LIMIT ?
+''')
+SEARCH_ANALYZED_QUERY = register_query("fts_analyzed_news", '''
+    SELECT a.bank, a.reg_number, a.text, a.summary, a.event_type, a.event_date, a.entities, a.date, a.link,
+           a.source, a.category, a.sentiment, a.informativeness, a.summary_hash
+    FROM analyzed_news_fts
+    JOIN analyzed_news a ON a.id = analyzed_news_fts.rowid
+    WHERE analyzed_news_fts MATCH ? AND a.bank = ? AND a.date >= ? AND a.date <= ?
+    ORDER BY bm25(analyzed_news_fts)
+    LIMIT ?
+''')
+
+
+def create_fts_tables(cursor):
+    """
+    FTS5-таблицы с внешним содержимым и триггеры, поддерживающие их при вставке, удалении
+    и изменении текста. Новая таблица заполняется из существующих строк (rebuild).
+    Без FTS5 в сборке SQLite поиск по индексу отключается.
+    """
+    global FTS_AVAILABLE
+    try:
+        for fts_table, (table, column) in FTS_TABLES.items():
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts_table,))
+            exists = cursor.fetchone() is not None
+            cursor.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+                    {column}, content='{table}', content_rowid='id', tokenize='{FTS_TOKENIZER}'
+                )
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {table} BEGIN
+                    INSERT INTO {fts_table} (rowid, {column}) VALUES (new.id, new.{column});
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {table} BEGIN
+                    INSERT INTO {fts_table} ({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE OF {column} ON {table} BEGIN
+                    INSERT INTO {fts_table} ({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+                    INSERT INTO {fts_table} (rowid, {column}) VALUES (new.id, new.{column});
+                END
+            ''')
+            if not exists:
+                cursor.execute(f"INSERT INTO {fts_table} ({fts_table}) VALUES ('rebuild')")
+                logging.info(f"Создан полнотекстовый индекс {fts_table} по {table}.{column}")
+    except sqlite3.OperationalError as e:
+        FTS_AVAILABLE = False
+        logging.warning(f"Полнотекстовый индекс недоступен ({e}), поиск по теме идёт через парсинг")
+
+
+def _normalize(text):
+    text = re.sub(r'[^\w\s]', ' ', (text or "").lower().strip())
+    return re.sub(r'\s+', ' ', text)
+
+
+def _term(word, stem):
+    if stem and len(word) >= STEM_MIN_LENGTH:
+        word = word[:-2]
+    return f'"{word}"*'
+
+
+def topic_fts_query(topic):
+    """
+    Выражение MATCH для темы: известная тема — любая из её основ (OR), многословная основа — фразой;
+    произвольная тема — все значимые слова по основам (AND). None, если искать нечего.
+    """
+    normalized_topic = _normalize(topic)
+    keywords = TOPIC_KEYWORDS.get(normalized_topic)
+    if keywords:
+        alternatives = []
+        for keyword in keywords:
+            words = keyword.split()
+            if len(words) > 1:
+                alternatives.append(f'"{keyword}"')
+            elif len(keyword) >= MIN_TERM_LENGTH:
+                alternatives.append(_term(keyword, stem=False))
+        return " OR ".join(alternatives) or None
+    terms = [_term(word, stem=True) for word in normalized_topic.split() if len(word) >= MIN_TERM_LENGTH]
+    return " AND ".join(terms) or None
+
+
+async def search_parsed_news(bank_name, topic, date_from, date_to, limit=FTS_RESULT_LIMIT):
+    """Сырые новости банка за период по теме, самые релевантные (BM25) первыми; None без индекса"""
+    query = topic_fts_query(topic)
+    if not FTS_AVAILABLE or query is None:
+        return None
+    try:
+        rows = await fetchall(NEWS_DB, SEARCH_PARSED_QUERY, (query, bank_name, date_from, date_to, limit))
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка полнотекстового поиска по parsed_news ({query}): {e}")
+        return None
+    return [{
+        "bank": row[0], "reg_number": row[1], "text": row[2], "date": row[3],
+        "link": row[4], "source": row[5], "topic": row[6]
+    } for row in rows]
+
+
+async def search_analyzed_news(bank_name, topic, date_from, date_to, limit=FTS_RESULT_LIMIT):
+    """Проанализированные новости банка за период по теме (выжимки), без повторов выжимок; None без индекса"""
+    from utils import parse_entities
+
+    query = topic_fts_query(topic)
+    if not FTS_AVAILABLE or query is None:
+        return None
+    try:
+        rows = await fetchall(NEWS_DB, SEARCH_ANALYZED_QUERY, (query, bank_name, date_from, date_to, limit))
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка полнотекстового поиска по analyzed_news ({query}): {e}")
+        return None
+    news_list = []
+    seen_hashes = set()
+    for row in rows:
+        summary_hash = row[13] or row[3]
+        if summary_hash in seen_hashes:
+            continue
+        seen_hashes.add(summary_hash)
+        news_list.append({
+            "bank": row[0], "reg_number": row[1], "text": row[2], "summary": row[3],
+            "event_type": row[4], "event_date": row[5], "entities": parse_entities(row[6]),
+            "date": row[7], "link": row[8], "source": row[9], "category": row[10],
+            "sentiment": row[11], "informativeness": row[12]
+        })
+    return news_list
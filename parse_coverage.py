@@ -0,0 +1,190 @@
+# parse_coverage.py (покрытие парсинга: непересекающиеся интервалы дат по банку, группе источников и теме,
+# планирование недостающих поддиапазонов)
+
+import contextvars
+import logging
+from datetime import datetime, timedelta
+
+from storage import NEWS_DB, fetchall, register_query, sql_for, write
+
+# Группы источников сбора (по одной задаче на диапазон в _perform_full_parsing)
+SOURCES = ("apis", "rss", "1000bankov", "telegram")
+
+# День сбора (и более поздние даты) считается покрытым только в тот же день и не дольше этого срока (часы):
+# новости за него ещё появляются
+OPEN_DAY_TTL_HOURS = 4
+
+DATE_FORMAT = "%Y-%m-%d"
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Сбои источника в текущем сборе (список на время fetch_with_coverage, виден и дочерним задачам)
+_source_failures = contextvars.ContextVar("source_failures", default=None)
+
+COVERAGE_QUERY = register_query("parse_coverage_by_bank", '''
+    SELECT source, date_from, date_to, fetched_at FROM parse_coverage
+    WHERE bank = ? AND topic = ?
+''')
+SOURCE_COVERAGE_QUERY = register_query("parse_coverage_by_source", '''
+    SELECT date_from, date_to, fetched_at FROM parse_coverage
+    WHERE bank = ? AND topic = ? AND source = ?
+''')
+DELETE_SOURCE_COVERAGE_QUERY = register_query(
+    "delete_parse_coverage_by_source", "DELETE FROM parse_coverage WHERE bank = ? AND topic = ? AND source = ?"
+)
+
+
+def create_coverage_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS parse_coverage (
+            bank TEXT,
+            topic TEXT,
+            source TEXT,
+            date_from TEXT,
+            date_to TEXT,
+            fetched_at TEXT,
+            PRIMARY KEY (bank, topic, source, date_from)
+        )
+    ''')
+
+
+# --- ИНТЕРВАЛЫ ---
+def _to_date(value):
+    return datetime.strptime(value, DATE_FORMAT).date() if isinstance(value, str) else value
+
+
+def merge_intervals(intervals):
+    """
+    Объединение пересекающихся и смежных интервалов дат (start, end, fetched_at) в непересекающиеся.
+    У объединённого интервала время сбора — самое позднее из исходных.
+    """
+    merged = []
+    for start, end, fetched_at in sorted(intervals):
+        if merged and start <= merged[-1][1] + timedelta(days=1):
+            last_start, last_end, last_fetched = merged[-1]
+            merged[-1] = (last_start, max(last_end, end), max(last_fetched, fetched_at))
+        else:
+            merged.append((start, end, fetched_at))
+    return merged
+
+
+def subtract_intervals(start, end, covered):
+    """Поддиапазоны [start, end], не покрытые непересекающимися отсортированными интервалами covered"""
+    missing = []
+    cursor = start
+    for covered_start, covered_end in covered:
+        if covered_end < cursor:
+            continue
+        if covered_start > end:
+            break
+        if covered_start > cursor:
+            missing.append((cursor, covered_start - timedelta(days=1)))
+        cursor = max(cursor, covered_end + timedelta(days=1))
+        if cursor > end:
+            break
+    if cursor <= end:
+        missing.append((cursor, end))
+    return missing
+
+
+def effective_interval(start, end, fetched_at, now=None):
+    """
+    Фактически покрытая часть интервала: даты до дня сбора покрыты всегда, день сбора и позже —
+    только пока сбор свежий (тот же день, не старше OPEN_DAY_TTL_HOURS). None, если ничего не покрыто.
+    """
+    now = now or datetime.now()
+    fetched_day = fetched_at.date()
+    if end < fetched_day:
+        return start, end
+    if fetched_day == now.date() and now - fetched_at < timedelta(hours=OPEN_DAY_TTL_HOURS):
+        return start, end
+    closed_end = fetched_day - timedelta(days=1)
+    return (start, closed_end) if closed_end >= start else None
+
+
+def _parse_row(date_from, date_to, fetched_at, now):
+    interval = effective_interval(
+        _to_date(date_from), _to_date(date_to), datetime.strptime(fetched_at, TIMESTAMP_FORMAT), now
+    )
+    if interval is None:
+        return None
+    return interval[0], interval[1], datetime.strptime(fetched_at, TIMESTAMP_FORMAT)
+
+
+# --- ПЛАНИРОВАНИЕ И ЗАПИСЬ ---
+async def plan_missing(bank, topic, date_from, date_to, sources=SOURCES):
+    """Недостающие поддиапазоны периода по группам источников: {source: [(from, to), ...]} в строках дат"""
+    topic = topic or ""
+    now = datetime.now()
+    covered = {source: [] for source in sources}
+    rows = await fetchall(NEWS_DB, COVERAGE_QUERY, (bank, topic))
+    for source, row_from, row_to, fetched_at in rows:
+        if source not in covered:
+            continue
+        interval = _parse_row(row_from, row_to, fetched_at, now)
+        if interval is not None:
+            covered[source].append(interval)
+    start, end = _to_date(date_from), _to_date(date_to)
+    plan = {}
+    for source, intervals in covered.items():
+        merged = [(interval_start, interval_end) for interval_start, interval_end, _ in merge_intervals(intervals)]
+        plan[source] = [
+            (missing_start.strftime(DATE_FORMAT), missing_end.strftime(DATE_FORMAT))
+            for missing_start, missing_end in subtract_intervals(start, end, merged)
+        ]
+    return plan
+
+
+async def record_coverage(bank, source, topic, date_from, date_to):
+    """Отметка успешно собранного диапазона: интервалы группы источника объединяются и перезаписываются"""
+    topic = topic or ""
+    now = datetime.now().replace(microsecond=0)
+
+    def operation(cursor):
+        cursor.execute(sql_for(SOURCE_COVERAGE_QUERY), (bank, topic, source))
+        intervals = [
+            interval for interval in (_parse_row(*row, now) for row in cursor.fetchall())
+            if interval is not None
+        ]
+        intervals.append((_to_date(date_from), _to_date(date_to), now))
+        merged = merge_intervals(intervals)
+        cursor.execute(sql_for(DELETE_SOURCE_COVERAGE_QUERY), (bank, topic, source))
+        cursor.executemany('''
+            INSERT INTO parse_coverage (bank, topic, source, date_from, date_to, fetched_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [
+            (bank, topic, source, start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT), fetched_at.strftime(TIMESTAMP_FORMAT))
+            for start, end, fetched_at in merged
+        ])
+        return len(merged)
+
+    await write(NEWS_DB, operation)
+
+
+def report_source_failure(reason):
+    """Отметка сбоя источника в текущем сборе: его диапазон не будет записан как покрытый"""
+    failures = _source_failures.get()
+    if failures is not None:
+        failures.append(reason)
+
+
+async def fetch_with_coverage(bank, source, topic, date_from, date_to, coroutine):
+    """
+    Выполнение сбора группы источников за диапазон; при успехе (без исключения и без
+    report_source_failure) диапазон записывается в покрытие.
+    """
+    failures = []
+    token = _source_failures.set(failures)
+    try:
+        result = await coroutine
+    finally:
+        _source_failures.reset(token)
+    if failures:
+        logging.warning(
+            f"Покрытие {source} для {bank} за {date_from}-{date_to} не записано: сбои ({'; '.join(failures[:3])})"
+        )
+    else:
+        try:
+            await record_coverage(bank, source, topic, date_from, date_to)
+        except Exception as e:
+            logging.error(f"Ошибка записи покрытия {source} для {bank}: {e}")
+    return result
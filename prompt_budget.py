@@ -0,0 +1,97 @@
+# prompt_budget.py (подготовка текста новости для промптов LLM: очистка и бюджет токенов)
+
+import html
+import re
+
+from utils import normalize_text_for_aliases
+
+# Максимум токенов текста новости в одном промпте
+LLM_TEXT_TOKEN_BUDGET = 600
+# Число промптов в generate_news_dict, в которые встраивается текст
+PROMPTS_PER_NEWS = 4
+PROMPT_BUDGET_STATS = {"items": 0, "truncated": 0, "tokens_before": 0, "tokens_after": 0}
+
+# Служебные фразы: ссылки на другие материалы, подписки, подписи к фото, маркировка рекламы
+BOILERPLATE_PATTERNS = [
+    r"читайте также[^.!?\n]*",
+    r"подписывайтесь на[^.!?\n]*",
+    r"подпишись на[^.!?\n]*",
+    r"больше новостей[^.!?\n]*",
+    r"фото:\s*[^.!?\n]*",
+    r"источник:\s*[^.!?\n]*",
+    r"\bреклама\.?\s*erid[^\s]*",
+    r"#\w+",
+]
+_BOILERPLATE_RE = re.compile("|".join(BOILERPLATE_PATTERNS), re.IGNORECASE)
+_URL_RE = re.compile(r"https?://\S+|www\.\S+")
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+
+def estimate_tokens(text):
+    # Около 3 символов на токен для русского текста
+    return (len(text) + 2) // 3
+
+
+def strip_markup(text):
+    text = re.sub(r"<(script|style)[^>]*>.*?</\1>", " ", text, flags=re.IGNORECASE | re.DOTALL)
+    text = re.sub(r"<br\s*/?>|</p>|</div>|</li>", "\n", text, flags=re.IGNORECASE)
+    text = re.sub(r"<[^>]+>", " ", text)
+    return html.unescape(text)
+
+
+def prepare_text_for_llm(text, mentions_bank, max_tokens=LLM_TEXT_TOKEN_BUDGET):
+    """
+    Очистка текста перед встраиванием в промпты: удаление разметки, ссылок и
+    служебных фраз, повторов заголовка/анонса и обрезка до бюджета токенов.
+    При обрезке сохраняются первое предложение и предложения, для которых
+    mentions_bank(предложение) истинно (упоминания банка).
+    """
+    if not text:
+        return ""
+    tokens_before = estimate_tokens(text)
+    cleaned = strip_markup(text)
+    cleaned = _URL_RE.sub(" ", cleaned)
+    cleaned = _BOILERPLATE_RE.sub(" ", cleaned)
+    cleaned = re.sub(r"\s+([.,!?;:])", r"\1", cleaned)
+    cleaned = re.sub(r"([.!?])(?:\s*[.!?])+", r"\1", cleaned)
+
+    # Повторы (заголовок и анонс RSS часто дублируют начало статьи)
+    sentences = []
+    seen = set()
+    for raw_sentence in _SENTENCE_SPLIT_RE.split(cleaned):
+        sentence = re.sub(r"\s+", " ", raw_sentence).strip()
+        key = normalize_text_for_aliases(sentence)
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        sentences.append(sentence)
+
+    result = " ".join(sentences)
+    if estimate_tokens(result) > max_tokens:
+        # Приоритет: первое предложение, затем упоминания банка, затем остальное по порядку
+        order = [0] + [i for i in range(1, len(sentences)) if mentions_bank(sentences[i])]
+        order += [i for i in range(1, len(sentences)) if i not in set(order)]
+        selected = set()
+        used = 0
+        for i in order:
+            cost = estimate_tokens(sentences[i]) + 1
+            if used + cost > max_tokens:
+                continue
+            selected.add(i)
+            used += cost
+        if not selected:
+            result = sentences[0][:max_tokens * 3]
+        else:
+            result = " ".join(sentences[i] for i in sorted(selected))
+        PROMPT_BUDGET_STATS["truncated"] += 1
+
+    PROMPT_BUDGET_STATS["items"] += 1
+    PROMPT_BUDGET_STATS["tokens_before"] += tokens_before
+    PROMPT_BUDGET_STATS["tokens_after"] += estimate_tokens(result)
+    return result
+
+
+def prompt_tokens_saved():
+    """Сэкономленные токены во всех промптах с текстом новости"""
+    saved = PROMPT_BUDGET_STATS["tokens_before"] - PROMPT_BUDGET_STATS["tokens_after"]
+    return saved * PROMPTS_PER_NEWS
@@ -0,0 +1,214 @@
+# relevance_classifier.py (локальный предфильтр релевантности новостей перед запросами к LLM)
+
+import argparse
+import asyncio
+import logging
+import os
+import pickle
+import sqlite3
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
+
+from storage import register_query, sql_for
+from utils import normalize_text_for_aliases
+
+# Путь к обученной модели
+MODEL_PATH = "models/relevance_model.pkl"
+
+# Новости с вероятностью релевантности ниже порога отбрасываются без LLM
+RELEVANCE_THRESHOLD = 0.15
+
+# Минимальное число примеров каждого класса для обучения
+MIN_SAMPLES_PER_CLASS = 50
+
+# Количество LLM-запросов, которое тратится на одну новость в generate_news_dict
+LLM_CALLS_PER_NEWS = 4
+
+# Статистика предфильтра за время работы процесса
+PREFILTER_STATS = {"checked": 0, "rejected": 0}
+
+_model = None
+_model_loaded = False
+
+# Обучающая выборка читается целиком, полный просмотр ожидаем
+RELEVANT_TEXTS_QUERY = register_query(
+    "classifier_relevant_texts", "SELECT DISTINCT text FROM analyzed_news WHERE text IS NOT NULL AND text != ''", full_scan=True
+)
+# Отклонение в rejected_news — решение для конкретного банка, а признаки классификатора — только текст:
+# отрицательный пример — текст, который не был принят ни для одного банка
+REJECTED_TEXTS_QUERY = register_query("classifier_rejected_texts", '''
+    SELECT DISTINCT text FROM rejected_news
+    WHERE text IS NOT NULL AND text != '' AND text NOT IN (SELECT text FROM analyzed_news WHERE text IS NOT NULL)
+''', full_scan=True)
+
+
+def load_training_data(db_path='news.db'):
+    """
+    Загрузка размеченных примеров: analyzed_news — релевантные (хотя бы для одного банка),
+    rejected_news — отклонённые LLM для всех банков, для которых текст проверялся
+    """
+    texts, labels = [], []
+    try:
+        conn = sqlite3.connect(db_path, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute(sql_for(RELEVANT_TEXTS_QUERY))
+        for (text,) in cursor.fetchall():
+            texts.append(text)
+            labels.append(1)
+        cursor.execute(sql_for(REJECTED_TEXTS_QUERY))
+        for (text,) in cursor.fetchall():
+            texts.append(text)
+            labels.append(0)
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка загрузки обучающей выборки для классификатора: {e}")
+    finally:
+        if 'conn' in locals() and conn:
+            conn.close()
+    return texts, labels
+
+
+def build_pipeline():
+    return Pipeline([
+        ("tfidf", TfidfVectorizer(
+            preprocessor=normalize_text_for_aliases,
+            ngram_range=(1, 2),
+            sublinear_tf=True,
+            min_df=2,
+            max_features=50000
+        )),
+        ("clf", LogisticRegression(class_weight="balanced", max_iter=1000))
+    ])
+
+
+def _has_enough_samples(labels):
+    positives = sum(labels)
+    negatives = len(labels) - positives
+    if positives < MIN_SAMPLES_PER_CLASS or negatives < MIN_SAMPLES_PER_CLASS:
+        logging.warning(
+            f"Недостаточно данных для классификатора: релевантных {positives}, отклонённых {negatives} "
+            f"(нужно минимум {MIN_SAMPLES_PER_CLASS} каждого класса)"
+        )
+        return False
+    return True
+
+
+def train_model(db_path='news.db', model_path=MODEL_PATH):
+    """Обучение классификатора на сохранённых новостях и сохранение на диск"""
+    global _model, _model_loaded
+    texts, labels = load_training_data(db_path)
+    if not _has_enough_samples(labels):
+        return None
+    pipeline = build_pipeline()
+    pipeline.fit(texts, labels)
+    os.makedirs(os.path.dirname(model_path) or ".", exist_ok=True)
+    with open(model_path, "wb") as f:
+        pickle.dump(pipeline, f)
+    _model = pipeline
+    _model_loaded = True
+    logging.info(f"Классификатор релевантности обучен на {len(texts)} примерах и сохранён в {model_path}")
+    return pipeline
+
+
+def load_model(model_path=MODEL_PATH):
+    """Однократная загрузка модели; при отсутствии файла предфильтр отключён"""
+    global _model, _model_loaded
+    if _model_loaded:
+        return _model
+    _model_loaded = True
+    if not os.path.exists(model_path):
+        logging.info("Модель классификатора релевантности не найдена, предфильтр отключён")
+        return None
+    try:
+        with open(model_path, "rb") as f:
+            _model = pickle.load(f)
+        logging.info(f"Классификатор релевантности загружен из {model_path}")
+    except Exception as e:
+        logging.error(f"Ошибка загрузки классификатора релевантности: {e}")
+        _model = None
+    return _model
+
+
+def predict_relevance(text):
+    """Вероятность релевантности новости или None, если модель недоступна"""
+    model = load_model()
+    if model is None or not text:
+        return None
+    try:
+        return float(model.predict_proba([text])[0][1])
+    except Exception as e:
+        logging.warning(f"Ошибка предсказания классификатора релевантности: {e}")
+        return None
+
+
+async def should_skip_llm(text, threshold=RELEVANCE_THRESHOLD):
+    """True, если новость уверенно нерелевантна и её не нужно отправлять в LLM (модель — в потоке)"""
+    score = await asyncio.to_thread(predict_relevance, text)
+    if score is None:
+        return False
+    PREFILTER_STATS["checked"] += 1
+    if score < threshold:
+        PREFILTER_STATS["rejected"] += 1
+        return True
+    return False
+
+
+def evaluate_model(db_path='news.db', threshold=RELEVANCE_THRESHOLD, test_size=0.25):
+    """Офлайн-оценка: точность/полнота на отложенной выборке и сэкономленные LLM-запросы"""
+    texts, labels = load_training_data(db_path)
+    if not _has_enough_samples(labels):
+        return None
+    train_texts, test_texts, train_labels, test_labels = train_test_split(
+        texts, labels, test_size=test_size, stratify=labels, random_state=42
+    )
+    pipeline = build_pipeline()
+    pipeline.fit(train_texts, train_labels)
+    scores = pipeline.predict_proba(test_texts)[:, 1]
+
+    kept_tp = sum(1 for s, y in zip(scores, test_labels) if s >= threshold and y == 1)
+    kept_fp = sum(1 for s, y in zip(scores, test_labels) if s >= threshold and y == 0)
+    dropped_fn = sum(1 for s, y in zip(scores, test_labels) if s < threshold and y == 1)
+    dropped_tn = sum(1 for s, y in zip(scores, test_labels) if s < threshold and y == 0)
+
+    precision = kept_tp / (kept_tp + kept_fp) if kept_tp + kept_fp else 0.0
+    recall = kept_tp / (kept_tp + dropped_fn) if kept_tp + dropped_fn else 0.0
+    dropped = dropped_tn + dropped_fn
+    report = {
+        "threshold": threshold,
+        "test_size": len(test_labels),
+        "precision": precision,
+        "recall": recall,
+        "dropped": dropped,
+        "lost_relevant": dropped_fn,
+        "llm_calls_saved": dropped * LLM_CALLS_PER_NEWS,
+        "llm_calls_saved_share": dropped / len(test_labels) if test_labels else 0.0,
+    }
+    return report
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Локальный классификатор релевантности новостей")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--db", default="news.db")
+    parser.add_argument("--threshold", type=float, default=RELEVANCE_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.command == "train":
+        train_model(args.db)
+    else:
+        report = evaluate_model(args.db, threshold=args.threshold)
+        if report is None:
+            return
+        print(f"Порог: {report['threshold']:.2f}, тестовых примеров: {report['test_size']}")
+        print(f"Precision (оставленные релевантны): {report['precision']:.3f}")
+        print(f"Recall (релевантные сохранены): {report['recall']:.3f}")
+        print(f"Отброшено без LLM: {report['dropped']} ({report['llm_calls_saved_share']:.1%}), "
+              f"из них релевантных: {report['lost_relevant']}")
+        print(f"Сэкономлено LLM-запросов: {report['llm_calls_saved']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+# storage.py (общий слой доступа к SQLite: WAL, одна задача-писатель на базу с очередью и пакетными коммитами,
+# чтение в пуле потоков с постоянными соединениями, именованные запросы с замером времени,
+# миграция индексов и проверка планов запросов)
+
+import argparse
+import asyncio
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+NEWS_DB = 'news.db'
+MONITORING_DB = 'monitoring.db'
+
+# Максимум операций в одной транзакции писателя
+WRITE_BATCH_MAX = 200
+
+# Ожидание блокировки БД (мс) для соединений, открытых вне писателя
+BUSY_TIMEOUT_MS = 30000
+
+# Потоки чтения; у каждого потока своё соединение с каждой базой
+READ_POOL_SIZE = 4
+
+# Запросы дольше порога (мс) логируются как медленные
+SLOW_QUERY_MS = 200
+
+# Размер кэша скомпилированных выражений на соединение
+CACHED_STATEMENTS = 256
+
+_writers = {}
+_read_executor = None
+_thread_local = threading.local()
+
+# Именованные запросы: текст фиксирован, поэтому sqlite3 переиспользует скомпилированное
+# выражение из кэша постоянного соединения. Запросы со списком IN (...) регистрируются
+# с подстановкой {placeholders}, которая раскрывается в sql_for
+QUERIES = {}
+QUERY_DATABASES = {}
+
+# Запросы, которым полный просмотр таблицы нужен по смыслу (загрузка корпуса, кэша целиком)
+FULL_SCAN_QUERIES = set()
+
+# Статистика по запросам: имя -> {"count", "total_ms", "max_ms"}
+QUERY_STATS = defaultdict(lambda: {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+
+
+def connect(db_path):
+    """
+    Соединение с WAL и synchronous=NORMAL: читатели не ждут писателя,
+    а коммит не делает fsync на каждую транзакцию (только на контрольных точках).
+    """
+    conn = sqlite3.connect(
+        db_path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False, cached_statements=CACHED_STATEMENTS
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    return conn
+
+
+def enable_wal(db_path):
+    """Перевод файла БД в режим WAL (сохраняется в файле, вызывается при инициализации)"""
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000)
+    try:
+        mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        logging.info(f"Режим журнала {db_path}: {mode}")
+    finally:
+        conn.close()
+
+
+class DBWriter:
+    """
+    Единственный писатель базы: операции из очереди выполняются в отдельном потоке
+    на одном соединении, подряд идущие операции объединяются в одну транзакцию
+    (до WRITE_BATCH_MAX). Операция — функция от курсора; её результат возвращается
+    ожидающему. При ошибке пакета операции повторяются по одной, чтобы ошибка
+    одной записи не отменяла остальные.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._queue = None
+        self._task = None
+        self._conn = None
+        # Один поток: соединение SQLite используется только из него
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"writer-{db_path}")
+        self.stats = {"operations": 0, "transactions": 0, "errors": 0}
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def submit(self, operation):
+        """Постановка операции в очередь; возвращает future с её результатом"""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((operation, future))
+        return future
+
+    async def execute(self, operation):
+        return await self.submit(operation)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < WRITE_BATCH_MAX and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            outcomes = await loop.run_in_executor(self._executor, self._write_batch, [op for op, _ in batch])
+            for (_, future), (ok, value) in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = connect(self.db_path)
+        return self._conn
+
+    def _write_batch(self, operations):
+        conn = self._connection()
+        try:
+            cursor = conn.cursor()
+            results = [(True, operation(cursor)) for operation in operations]
+            conn.commit()
+            self.stats["operations"] += len(operations)
+            self.stats["transactions"] += 1
+            return results
+        except Exception as e:
+            conn.rollback()
+            if len(operations) == 1:
+                # Единственная операция уже выполнялась: повтор дал бы ту же ошибку
+                self.stats["errors"] += 1
+                return [(False, e)]
+        return [self._write_one(operation) for operation in operations]
+
+    def _write_one(self, operation):
+        conn = self._connection()
+        try:
+            result = operation(conn.cursor())
+            conn.commit()
+            self.stats["operations"] += 1
+            self.stats["transactions"] += 1
+            return True, result
+        except Exception as e:
+            conn.rollback()
+            self.stats["errors"] += 1
+            return False, e
+
+
+def get_writer(db_path=NEWS_DB):
+    writer = _writers.get(db_path)
+    if writer is None:
+        writer = DBWriter(db_path)
+        _writers[db_path] = writer
+    return writer
+
+
+async def write(db_path, operation):
+    """Выполнение операции записи (функции от курсора) через писателя базы"""
+    return await get_writer(db_path).execute(operation)
+
+
+async def executemany(db_path, sql, rows):
+    """Пакетная вставка строк одной операцией; возвращает число изменённых строк"""
+    rows = list(rows)
+    if not rows:
+        return 0
+
+    def operation(cursor):
+        cursor.executemany(sql, rows)
+        return cursor.rowcount
+
+    return await write(db_path, operation)
+
+
+async def execute(db_path, sql, params=()):
+    def operation(cursor):
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+    return await write(db_path, operation)
+
+
+# --- ЧТЕНИЕ ---
+def register_query(name, sql, db_path=NEWS_DB, full_scan=False):
+    """
+    Регистрация именованного запроса; возвращает имя для вызовов fetchall/fetchone/sql_for.
+    Все зарегистрированные запросы проходят проверку планов (check_query_plans).
+    """
+    QUERIES[name] = sql
+    QUERY_DATABASES[name] = db_path
+    if full_scan:
+        FULL_SCAN_QUERIES.add(name)
+    return name
+
+
+def sql_for(query, placeholders=None):
+    """Текст запроса по имени (или сам текст); placeholders — число параметров списка IN (...)"""
+    sql = QUERIES.get(query, query)
+    if placeholders is not None:
+        sql = sql.replace("{placeholders}", ",".join(["?"] * placeholders))
+    return sql
+
+
+def _read_connection(db_path):
+    connections = getattr(_thread_local, "connections", None)
+    if connections is None:
+        connections = _thread_local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = connect(db_path)
+        conn.execute("PRAGMA query_only=ON")
+        connections[db_path] = conn
+    return conn
+
+
+def _record_timing(name, started):
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    stats = QUERY_STATS[name]
+    stats["count"] += 1
+    stats["total_ms"] += elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+    if elapsed_ms >= SLOW_QUERY_MS:
+        logging.warning(f"Медленный запрос {name}: {elapsed_ms:.0f} мс")
+
+
+def _run_read(db_path, name, function):
+    started = time.perf_counter()
+    try:
+        return function(_read_connection(db_path))
+    finally:
+        _record_timing(name, started)
+
+
+async def read(db_path, function, name="read"):
+    """Выполнение function(conn) в пуле потоков чтения на постоянном соединении потока"""
+    global _read_executor
+    if _read_executor is None:
+        _read_executor = ThreadPoolExecutor(max_workers=READ_POOL_SIZE, thread_name_prefix="sqlite-read")
+    return await asyncio.get_running_loop().run_in_executor(_read_executor, _run_read, db_path, name, function)
+
+
+async def fetchall(db_path, query, params=(), placeholders=None):
+    """Строки запроса; query — имя зарегистрированного запроса или текст SQL"""
+    sql = sql_for(query, placeholders)
+    name = query if query in QUERIES else "sql"
+    return await read(db_path, lambda conn: conn.execute(sql, params).fetchall(), name)
+
+
+async def fetchone(db_path, query, params=(), placeholders=None):
+    sql = sql_for(query, placeholders)
+    name = query if query in QUERIES else "sql"
+    return await read(db_path, lambda conn: conn.execute(sql, params).fetchone(), name)
+
+
+def query_stats_report(top=10):
+    """Строка с самыми затратными по суммарному времени запросами"""
+    ranked = sorted(QUERY_STATS.items(), key=lambda item: item[1]["total_ms"], reverse=True)[:top]
+    return "; ".join(
+        f"{name}: {stats['count']} шт., среднее {stats['total_ms'] / stats['count']:.1f} мс, макс {stats['max_ms']:.0f} мс"
+        for name, stats in ranked if stats["count"]
+    )
+
+
+# --- ИНДЕКСЫ И ПЛАНЫ ЗАПРОСОВ ---
+def create_indexes(cursor, indexes):
+    """
+    Миграция индексов: indexes — список (имя, таблица, столбцы). Создаются только
+    отсутствующие; PRAGMA optimize обновляет статистику планировщика, если она устарела.
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    existing = {row[0] for row in cursor.fetchall()}
+    for name, table, columns in indexes:
+        if name in existing:
+            continue
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+        logging.info(f"Создан индекс {name} на {table} ({', '.join(columns)})")
+    cursor.execute("PRAGMA optimize")
+
+
+def plan_full_scans(conn, sql):
+    """
+    Шаги плана с полным просмотром: SCAN таблицы или обход всего некрывающего индекса
+    (с чтением строки таблицы на каждую запись). Обход покрывающего индекса допустим.
+    """
+    sql = sql_for(sql, placeholders=1)
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", [None] * sql.count("?")).fetchall()
+    return [
+        row[3] for row in plan
+        if row[3].startswith("SCAN") and "COVERING INDEX" not in row[3]
+        and "CONSTANT ROW" not in row[3] and "SUBQUERY" not in row[3] and "VIRTUAL TABLE" not in row[3]
+    ]
+
+
+def check_query_plans(db_paths=None):
+    """
+    EXPLAIN QUERY PLAN для всех зарегистрированных запросов. Возвращает список
+    (имя, описание проблемы): полный просмотр таблицы или ошибку подготовки запроса.
+    """
+    problems = []
+    connections = {}
+    try:
+        for name, sql in sorted(QUERIES.items()):
+            db_path = QUERY_DATABASES[name]
+            if name in FULL_SCAN_QUERIES or (db_paths is not None and db_path not in db_paths):
+                continue
+            if db_path not in connections:
+                connections[db_path] = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000)
+            try:
+                scans = plan_full_scans(connections[db_path], sql)
+            except sqlite3.Error as e:
+                problems.append((name, f"ошибка подготовки: {e}"))
+                continue
+            problems.extend((name, scan) for scan in scans)
+    finally:
+        for conn in connections.values():
+            conn.close()
+    for name, problem in problems:
+        logging.error(f"План запроса {name}: {problem}")
+    return problems
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Обслуживание баз SQLite")
+    parser.add_argument("command", choices=["check-plans"])
+    parser.parse_args()
+    # Модули регистрируют свои запросы при импорте (в модуле storage, а не в __main__);
+    # news_parser при импорте инициализирует news.db, включая миграцию индексов
+    import storage
+    import news_parser, monitoring, embedding_index, dedup_index, tfidf_model, relevance_classifier  # noqa: F401
+    monitoring.init_monitoring_db()
+    if storage.check_query_plans():
+        sys.exit(1)
+    logging.info(f"Проверено запросов: {len(storage.QUERIES)}, полных просмотров нет")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import sqlite3
+from datetime import date, datetime
+
+import pytest
+
+import dedup_index
+from dedup_index import (
+    DuplicateClusterIndex, MinHashLSHIndex, adjudication_groups, candidate_pairs, canonical_url, collapse_reprints,
+    load_minhash_index, parse_event_partition, remember_texts, same_numbers, word_shingles
+)
+
+
+def rank(item):
+    return item["informativeness"]
+
+
+def news(score):
+    return {"informativeness": score}
+
+
+def test_restore_rebuilds_clusters():
+    index = DuplicateClusterIndex(rank=rank)
+    index.restore([("a", "a", news(1)), ("b", "a", news(3)), ("c", "c", news(2))])
+    assert index.find("b") == "a"
+    assert {root: len(members) for root, members in index.members.items()} == {"a": 2, "c": 1}
+    assert index.representative("a") == news(3)
+    assert not index.collect_dirty()
+
+
+def test_restore_when_root_expired():
+    index = DuplicateClusterIndex(rank=rank)
+    # Корень "a" вышел из окна хранения, "b" и "c" остались в его кластере
+    index.restore([("b", "a", news(1)), ("c", "a", news(2)), ("d", "d", news(1))])
+    assert index.find("b") == index.find("c") == "b"
+    assert index.find("d") == "d"
+    assert len(index.members) == 2
+    # Узлы с новым корнем перезаписываются
+    assert {key: root for key, root, _ in index.collect_dirty()} == {"b": "b", "c": "b"}
+
+
+def test_union_merges_smaller_cluster_into_larger():
+    index = DuplicateClusterIndex(rank=rank)
+    for key in "abc":
+        index.add(key, news(1))
+    index.union("a", "b")
+    assert index.union("c", "b") == "a"
+    assert index.members == {"a": {"a", "b", "c"}}
+
+
+def test_canonical_url_strips_tracking_and_mirrors():
+    assert canonical_url("http://www.m.example.com/news/1/amp/?utm_source=tg&id=5&fbclid=x#top") == \
+        "https://example.com/news/1?id=5"
+    assert canonical_url("https://example.com/news/1/") == "https://example.com/news/1"
+    assert canonical_url("https://t.me/s/channel/42") == "https://t.me/channel/42"
+    assert canonical_url("https://example.com/a?b=2&a=1") == "https://example.com/a?a=1&b=2"
+
+
+def test_canonical_url_keeps_non_urls():
+    assert canonical_url("newsapi") == "newsapi"
+    assert canonical_url(None) == ""
+
+
+def test_same_numbers_separates_templated_news():
+    assert not same_numbers("Ставка повышена до 7% с 28 июля", "Ставка повышена до 8% с 28 июля")
+    assert not same_numbers("Выплаты с 1 июля", "Выплаты с 1 августа")
+    assert same_numbers("Ставка 7,5% с 1 мая", "С 1 мая ставка 7.5%")
+
+
+def filler_text(number):
+    # Длинный текст, в котором отличается только одно число: почти полное совпадение шинглов
+    words = [a + b + c for a in "вгджзк" for b in "лмнпрст" for c in "аоу"]
+    return " ".join(words[:60]) + f" ставка {number}% годовых " + " ".join(words[60:])
+
+
+def collapse(news_list, include_history=False):
+    return collapse_reprints(
+        news_list, lambda text: hashlib.md5(text.encode("utf-8")).hexdigest(), lambda news: news["date"],
+        include_history=include_history
+    )
+
+
+@pytest.fixture
+def text_index(monkeypatch):
+    index = MinHashLSHIndex()
+    monkeypatch.setattr(dedup_index, "_minhash_indexes", {("Банк", "text"): index})
+    return index
+
+
+def test_collapse_reprints_in_batch(text_index):
+    original = {"bank": "Банк", "date": "2026-10-01", "text": filler_text(7)}
+    reprint = {"bank": "Банк", "date": "2026-10-01", "text": filler_text(7).upper() + "!"}
+    templated = {"bank": "Банк", "date": "2026-10-01", "text": filler_text(8)}
+    kept, records, reprints = collapse([original, reprint, templated])
+    # Шаблонная новость с другим числом перепечаткой не считается
+    assert kept == [original, templated]
+    assert reprints == 1
+    assert [record[0] for record in records] == ["Банк", "Банк"]
+    assert not len(text_index)
+
+
+def test_collapse_reprints_against_history(text_index):
+    news = {"bank": "Банк", "date": "2026-10-01", "text": filler_text(7)}
+    _, records, _ = collapse([news])
+    remember_texts(records)
+    copy = dict(news, text=news["text"] + " ")
+    # Индекс банка учитывается только в мониторинге
+    assert collapse([copy])[0] == [copy]
+    assert collapse([copy], include_history=True)[0] == []
+
+
+def test_load_minhash_index_expires_old_rows(tmp_path):
+    db_path = str(tmp_path / "news.db")
+    index = MinHashLSHIndex()
+    signature = index.signature(word_shingles(filler_text(7))).tobytes()
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE minhash_signatures (bank TEXT, kind TEXT, item_key TEXT, signature BLOB, item_date TEXT, "
+        "numbers TEXT, PRIMARY KEY (bank, kind, item_key))"
+    )
+    today = datetime.now().strftime("%Y-%m-%d")
+    conn.executemany("INSERT INTO minhash_signatures VALUES (?, ?, ?, ?, ?, ?)", [
+        ("Банк", "text", "fresh", signature, today, "7"),
+        ("Банк", "text", "old", signature, "2000-01-01", "7"),
+    ])
+    conn.commit()
+    conn.close()
+
+    loaded = asyncio.run(load_minhash_index("Банк", "text", db_path=db_path))
+    assert "fresh" in loaded and "old" not in loaded
+    assert loaded.numbers("fresh") == "7"
+    conn = sqlite3.connect(db_path)
+    assert [row[0] for row in conn.execute("SELECT item_key FROM minhash_signatures")] == ["fresh"]
+    conn.close()
+
+
+def test_candidate_pairs_need_shared_key_within_date_window():
+    items = [
+        (date(2026, 10, 1), {"сбер", "штраф"}),
+        (date(2026, 10, 3), {"штраф"}),
+        (date(2026, 10, 9), {"штраф"}),  # вне окна дат
+        (date(2026, 10, 2), {"ипотека"}),  # нет общего ключа
+    ]
+    pairs, stats = candidate_pairs(items, window_days=3)
+    assert pairs == [(0, 1)]
+    assert stats["window_pairs"] == 3
+    assert stats["pruned_pairs"] == 2
+
+
+def test_frequent_keys_do_not_block():
+    day = date(2026, 10, 1)
+    # Ключ "банк" есть у всех новостей пакета — он не создаёт пар
+    items = [(day, {"банк", f"событие{number // 2}"}) for number in range(30)]
+    pairs, stats = candidate_pairs(items)
+    assert pairs == [(number, number + 1) for number in range(0, 30, 2)]
+    assert stats["candidate_pairs"] == 15 and stats["stop_keys"] == 1
+    assert stats["pruned_pairs"] == 30 * 29 // 2 - 15
+
+
+def test_adjudication_groups_split_components():
+    # Компонента 0-1-2-3 — одна группа, пара 4-5 проверяется попарно
+    pairs = [(0, 1), (1, 2), (2, 3), (4, 5)]
+    groups, pairwise = adjudication_groups(pairs, order_key=lambda idx: idx)
+    assert groups == [[0, 1, 2, 3]]
+    assert pairwise == [(4, 5)]
+
+
+def test_adjudication_groups_chunk_large_components():
+    pairs = [(0, idx) for idx in range(1, 7)]
+    # Части по порядку order_key (обратный порядок индексов), пары между частями — попарно
+    groups, pairwise = adjudication_groups(pairs, order_key=lambda idx: -idx, min_size=3, max_size=3)
+    assert groups == [[6, 5, 4], [3, 2, 1]]
+    assert pairwise == pairs
+    # Хвост меньше min_size в группу не попадает
+    groups, pairwise = adjudication_groups(pairs, order_key=lambda idx: idx, min_size=3, max_size=5)
+    assert groups == [[0, 1, 2, 3, 4]]
+    assert pairwise == [(0, 5), (0, 6)]
+
+
+def test_parse_event_partition():
+    response = "Событие 1: [1, 3]\nСобытие 2: 2\nсобытие 3: [4; 5]"
+    assert parse_event_partition(response, [1, 2, 3, 4, 5]) == [{1, 3}, {2}, {4, 5}]
+    # Повтор или пропуск номера — ответ не разобран
+    assert parse_event_partition("Событие 1: [1, 2]\nСобытие 2: [2, 3]", [1, 2, 3]) is None
+    assert parse_event_partition("Событие 1: [1, 2]", [1, 2, 3]) is None
+    assert parse_event_partition(None, [1]) is None
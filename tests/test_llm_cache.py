@@ -0,0 +1,56 @@
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+from llm_cache import TieredResponseCache
+from storage import write
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "news.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE gemini_cache (cache_key TEXT PRIMARY KEY, response TEXT, timestamp TIMESTAMP)")
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_memory_tier_is_bounded_by_bytes(db_path):
+    cache = TieredResponseCache(db_path, max_memory_bytes=2000)
+    for number in range(10):
+        cache.put(f"key{number}", "ответ" * 50)
+    assert cache.memory_bytes <= 2000
+    assert 0 < len(cache) < 10
+    # Вытесняются самые старые записи, а несохранённые ответы остаются доступны
+    assert "key9" in cache._hot and "key0" not in cache._hot
+    assert asyncio.run(cache.get("key0")) == "ответ" * 50
+    assert cache.stats["disk_hits"] == 1
+
+
+def test_saved_responses_are_loaded_lazily(db_path):
+    async def scenario():
+        cache = TieredResponseCache(db_path)
+        cache.put("fresh", "свежий ответ")
+        cache.put("old", "старый ответ", datetime.now() - timedelta(hours=48))
+        _, rows = cache.collect_pending_rows()
+        await write(db_path, lambda cursor: cache.write_rows_to(cursor, rows))
+
+        restarted = TieredResponseCache(db_path)
+        assert len(restarted) == 0
+        value = await restarted.get("fresh")
+        return restarted, value, await restarted.get("old"), await restarted.get("missing")
+
+    restarted, value, old, missing = asyncio.run(scenario())
+    assert value == "свежий ответ"
+    assert old is None and missing is None
+    assert len(restarted) == 1
+    assert restarted.stats == {"memory_hits": 0, "disk_hits": 1, "misses": 2}
+    # Устаревшая запись удалена при сохранении, ответы хранятся сжатыми
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT cache_key, response FROM gemini_cache").fetchall()
+    conn.close()
+    assert [key for key, _ in rows] == ["fresh"]
+    assert isinstance(rows[0][1], bytes)
@@ -0,0 +1,183 @@
+import asyncio
+
+import pytest
+
+import llm_control
+from llm_control import LLMPriorityDispatcher, LLMRateController, coalesce_request
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(llm_control.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_token_bucket_refills_at_rate(clock):
+    controller = LLMRateController(initial_rate=2.0, max_concurrency=10, burst=2)
+    assert controller.try_acquire() is None
+    assert controller.try_acquire() == pytest.approx(0.5)
+    clock[0] += 0.5
+    assert controller.try_acquire() is None
+    # Запас токенов не превышает burst
+    clock[0] += 10
+    assert controller.try_acquire() is None
+    assert controller.try_acquire() is None
+    assert controller.try_acquire() is not None
+
+
+def test_concurrency_limit(clock):
+    controller = LLMRateController(initial_rate=100.0, max_concurrency=1)
+    assert controller.try_acquire() is None
+    clock[0] += 1
+    assert controller.try_acquire() is not None
+    controller.release_nowait()
+    assert controller.try_acquire() is None
+
+
+def test_aimd_decrease_once_per_window(clock):
+    controller = LLMRateController(initial_rate=4.0, min_rate=0.5, decrease_factor=0.5, decrease_window=2.0)
+    controller.record_throttle()
+    assert controller.rate == pytest.approx(2.0)
+    # Пачка одновременных 429 снижает скорость один раз
+    controller.record_throttle()
+    assert controller.rate == pytest.approx(2.0)
+    clock[0] += 2
+    controller.record_throttle()
+    assert controller.rate == pytest.approx(1.0)
+    for _ in range(5):
+        clock[0] += 2
+        controller.record_throttle()
+    assert controller.rate == pytest.approx(0.5)
+
+
+def test_aimd_additive_increase(clock):
+    controller = LLMRateController(initial_rate=2.0, max_rate=2.2, additive_step=0.2)
+    controller.record_success()
+    assert controller.rate == pytest.approx(2.1)
+    for _ in range(10):
+        controller.record_success()
+    assert controller.rate == pytest.approx(2.2)
+
+
+def test_retry_after_pauses_grants(clock):
+    controller = LLMRateController(initial_rate=10.0)
+    controller.record_throttle(retry_after=5)
+    assert controller.try_acquire() == pytest.approx(5)
+    clock[0] += 6
+    assert controller.try_acquire() is None
+
+
+class ImmediateController:
+    """Ограничитель без ограничений: порядок выдачи определяет только диспетчер"""
+
+    async def acquire(self):
+        return self
+
+    async def release(self, grant=None):
+        pass
+
+    def snapshot(self):
+        return {}
+
+
+def test_dispatcher_serves_interactive_first():
+    async def scenario():
+        dispatcher = LLMPriorityDispatcher(ImmediateController())
+        order = []
+
+        async def request(lane):
+            async with dispatcher.slot(lane):
+                order.append(lane)
+
+        lanes = ["background", "dedup", "interactive", "background", "dedup", "interactive"]
+        await asyncio.gather(*(request(lane) for lane in lanes))
+        dispatcher._task.cancel()
+        return order, dispatcher.stats
+
+    order, stats = asyncio.run(scenario())
+    assert order == ["interactive", "interactive", "dedup", "dedup", "background", "background"]
+    assert stats["background"]["preempted"] > 0
+
+
+def test_dispatcher_weighted_share():
+    async def scenario():
+        dispatcher = LLMPriorityDispatcher(ImmediateController(), weights={"interactive": 8, "dedup": 3, "background": 1})
+        order = []
+
+        async def request(lane):
+            async with dispatcher.slot(lane):
+                order.append(lane)
+
+        await asyncio.gather(*(request("dedup") for _ in range(8)), *(request("interactive") for _ in range(8)))
+        dispatcher._task.cancel()
+        return order
+
+    order = asyncio.run(scenario())
+    # За первые 11 разрешений полосы получают доли по весам 8:3
+    assert order[:11].count("interactive") == 8
+    assert order[:11].count("dedup") == 3
+
+
+def test_identical_requests_are_coalesced():
+    async def scenario():
+        inflight, stats = {}, {"coalesced": 0, "sent": 0}
+        calls = []
+
+        async def request():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "ответ"
+
+        results = await asyncio.gather(*(coalesce_request(inflight, "key", request, stats) for _ in range(3)))
+        return results, calls, stats, inflight
+
+    results, calls, stats, inflight = asyncio.run(scenario())
+    assert results == ["ответ"] * 3
+    assert len(calls) == 1
+    assert stats == {"coalesced": 2, "sent": 1}
+    assert not inflight
+
+
+def test_owner_cancellation_does_not_cancel_waiters():
+    async def scenario():
+        inflight = {}
+        started = asyncio.Event()
+
+        async def request():
+            started.set()
+            await asyncio.sleep(0.01)
+            return "ответ"
+
+        owner = asyncio.ensure_future(coalesce_request(inflight, "key", request))
+        await started.wait()
+        waiters = [asyncio.ensure_future(coalesce_request(inflight, "key", request)) for _ in range(2)]
+        await asyncio.sleep(0)
+        owner.cancel()
+        results = await asyncio.gather(*waiters)
+        return owner, results
+
+    owner, results = asyncio.run(scenario())
+    assert owner.cancelled()
+    # Ожидающие повторяют запрос без отменённого владельца
+    assert results == ["ответ", "ответ"]
+
+
+def test_waiter_cancellation_keeps_request_running():
+    async def scenario():
+        inflight = {}
+
+        async def request():
+            await asyncio.sleep(0.01)
+            return "ответ"
+
+        owner = asyncio.ensure_future(coalesce_request(inflight, "key", request))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(coalesce_request(inflight, "key", request))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        return await owner, waiter
+
+    result, waiter = asyncio.run(scenario())
+    assert result == "ответ"
+    assert waiter.cancelled()
@@ -0,0 +1,22 @@
+from news_search import topic_fts_query
+
+
+def test_known_topic_uses_keyword_alternatives():
+    assert topic_fts_query("Ипотека") == '"ипотек"* OR "ипотечн"* OR "жилье"* OR "недвижимость"* OR "кредит на жилье"'
+
+
+def test_known_topic_skips_short_keywords():
+    assert '"it"' not in topic_fts_query("технологии")
+
+
+def test_free_topic_requires_all_stems():
+    assert topic_fts_query("слияние банков") == '"слиян"* AND "банк"*'
+
+
+def test_short_words_and_punctuation_are_dropped():
+    assert topic_fts_query("IPO в Москве!") == '"ipo"* AND "моск"*'
+
+
+def test_empty_topic():
+    assert topic_fts_query("") is None
+    assert topic_fts_query("и в на") is None
@@ -0,0 +1,48 @@
+from datetime import date, datetime
+
+from parse_coverage import effective_interval, merge_intervals, subtract_intervals
+
+
+def d(day, month=10):
+    return date(2026, month, day)
+
+
+def test_merge_overlapping_and_adjacent_intervals():
+    early = datetime(2026, 10, 5, 12, 0)
+    late = datetime(2026, 10, 6, 9, 0)
+    merged = merge_intervals([
+        (d(10), d(12), early),
+        (d(1), d(3), early),
+        (d(4), d(6), late),  # смежный с 1–3
+        (d(11), d(15), late),  # пересекается с 10–12
+    ])
+    assert merged == [(d(1), d(6), late), (d(10), d(15), late)]
+
+
+def test_merge_keeps_gap():
+    fetched = datetime(2026, 10, 5)
+    assert merge_intervals([(d(1), d(2), fetched), (d(4), d(5), fetched)]) == [
+        (d(1), d(2), fetched), (d(4), d(5), fetched)
+    ]
+
+
+def test_subtract_returns_uncovered_ranges():
+    covered = [(d(3), d(5)), (d(8), d(9))]
+    assert subtract_intervals(d(1), d(10), covered) == [(d(1), d(2)), (d(6), d(7)), (d(10), d(10))]
+
+
+def test_subtract_fully_covered_and_uncovered():
+    assert subtract_intervals(d(3), d(4), [(d(1), d(10))]) == []
+    assert subtract_intervals(d(3), d(4), []) == [(d(3), d(4))]
+    assert subtract_intervals(d(3), d(4), [(d(5), d(6))]) == [(d(3), d(4))]
+
+
+def test_open_day_expires():
+    now = datetime(2026, 10, 10, 18, 0)
+    # Сбор сегодня два часа назад — покрыт весь интервал
+    assert effective_interval(d(1), d(10), datetime(2026, 10, 10, 16, 0), now) == (d(1), d(10))
+    # Сбор вчера — день сбора и позже снова открыты
+    assert effective_interval(d(1), d(10), datetime(2026, 10, 9, 16, 0), now) == (d(1), d(8))
+    # Интервал целиком до дня сбора не устаревает
+    assert effective_interval(d(1), d(5), datetime(2026, 10, 9, 16, 0), now) == (d(1), d(5))
+    assert effective_interval(d(9), d(10), datetime(2026, 10, 9, 16, 0), now) is None
@@ -0,0 +1,39 @@
+import pytest
+
+from prompt_budget import PROMPT_BUDGET_STATS, estimate_tokens, prepare_text_for_llm
+
+
+def mentions_bank(sentence):
+    return "Сбербанк" in sentence
+
+
+@pytest.fixture(autouse=True)
+def fresh_stats(monkeypatch):
+    for key in PROMPT_BUDGET_STATS:
+        monkeypatch.setitem(PROMPT_BUDGET_STATS, key, 0)
+
+
+def test_markup_links_boilerplate_and_repeats_are_removed():
+    text = (
+        "<p>Сбербанк снизил ставки.</p><p>Сбербанк снизил ставки.</p>"
+        "Подробнее на https://example.com/news. Читайте также: другие новости. #банки"
+    )
+    assert prepare_text_for_llm(text, mentions_bank) == "Сбербанк снизил ставки. Подробнее на."
+
+
+def test_long_text_is_cut_to_token_budget():
+    filler = [f"Общее предложение номер {number} без упоминаний." for number in range(100)]
+    text = " ".join(["Главная новость дня."] + filler + ["Сбербанк объявил о сделке."])
+    result = prepare_text_for_llm(text, mentions_bank, max_tokens=50)
+    assert estimate_tokens(result) <= 50
+    # Первое предложение и упоминание банка сохраняются раньше остальных
+    assert result.startswith("Главная новость дня.")
+    assert result.endswith("Сбербанк объявил о сделке.")
+    assert PROMPT_BUDGET_STATS["truncated"] == 1
+    assert PROMPT_BUDGET_STATS["tokens_after"] < PROMPT_BUDGET_STATS["tokens_before"]
+
+
+def test_short_text_is_not_truncated():
+    assert prepare_text_for_llm("Банк открыл офис.", mentions_bank) == "Банк открыл офис."
+    assert prepare_text_for_llm("", mentions_bank) == ""
+    assert PROMPT_BUDGET_STATS["truncated"] == 0
@@ -0,0 +1,75 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import relevance_classifier
+from relevance_classifier import PREFILTER_STATS, load_training_data, should_skip_llm, train_model
+
+RELEVANT = [
+    "Банк повысил ставки по вкладам для частных клиентов",
+    "Центробанк отозвал лицензию у банка за нарушения",
+    "Банк выдал рекордный объём ипотечных кредитов",
+    "Кредитная организация сократила ставки по кредитам",
+]
+IRRELEVANT = [
+    "Футбольный матч завершился вничью после пенальти",
+    "В театре прошла премьера нового спектакля",
+    "Синоптики обещают снег и гололёд в выходные",
+    "Хоккейная команда выиграла кубок сезона",
+]
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "news.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE analyzed_news (text TEXT)")
+    conn.execute("CREATE TABLE rejected_news (text TEXT)")
+    conn.executemany("INSERT INTO analyzed_news VALUES (?)", [
+        (f"{text} {number}",) for number in range(20) for text in RELEVANT
+    ])
+    conn.executemany("INSERT INTO rejected_news VALUES (?)", [
+        (f"{text} {number}",) for number in range(20) for text in IRRELEVANT
+    ])
+    # Отклонён для одного банка, но принят для другого — не отрицательный пример
+    conn.execute("INSERT INTO rejected_news VALUES (?)", (f"{RELEVANT[0]} 0",))
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture(autouse=True)
+def fresh_model(monkeypatch):
+    monkeypatch.setattr(relevance_classifier, "_model", None)
+    monkeypatch.setattr(relevance_classifier, "_model_loaded", False)
+    monkeypatch.setitem(PREFILTER_STATS, "checked", 0)
+    monkeypatch.setitem(PREFILTER_STATS, "rejected", 0)
+
+
+def test_accepted_texts_are_not_negative_examples(db_path):
+    texts, labels = load_training_data(db_path)
+    assert labels.count(1) == 80 and labels.count(0) == 80
+    assert (f"{RELEVANT[0]} 0", 0) not in zip(texts, labels)
+
+
+def test_skips_only_confidently_irrelevant_news(db_path, tmp_path):
+    assert train_model(db_path, model_path=str(tmp_path / "model.pkl")) is not None
+    assert asyncio.run(should_skip_llm("Футбольный матч завершился вничью, снег и гололёд в выходные"))
+    assert not asyncio.run(should_skip_llm("Банк снизил ставки по ипотечным кредитам"))
+    assert PREFILTER_STATS == {"checked": 2, "rejected": 1}
+
+
+def test_without_model_nothing_is_skipped(monkeypatch):
+    # Файл модели не найден: предфильтр отключён
+    monkeypatch.setattr(relevance_classifier, "_model_loaded", True)
+    assert not asyncio.run(should_skip_llm("Футбольный матч завершился вничью"))
+    assert PREFILTER_STATS["checked"] == 0
+
+
+def test_too_few_examples_do_not_train(db_path, tmp_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("DELETE FROM rejected_news WHERE rowid > 10")
+    conn.commit()
+    conn.close()
+    assert train_model(db_path, model_path=str(tmp_path / "model.pkl")) is None
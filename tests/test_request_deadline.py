@@ -0,0 +1,31 @@
+import pytest
+
+import utils
+from utils import RequestDeadline
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(utils.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_reserve_leaves_budget_for_next_stage(clock):
+    deadline = RequestDeadline(90)
+    phase = deadline.reserve(30)
+    assert phase.remaining() == pytest.approx(60)
+    phase.mark_partial("сбор новостей")
+    assert deadline.partial and deadline.reasons == ["сбор новостей"]
+
+
+def test_share_splits_remaining_budget(clock):
+    deadline = RequestDeadline(60)
+    first = deadline.share(3)
+    assert first.remaining() == pytest.approx(20)
+    # Недоиспользованное первым этапом время переходит к следующим
+    clock[0] += 5
+    second = deadline.share(2)
+    assert second.remaining() == pytest.approx(27.5)
+    assert deadline.share(1).remaining() == pytest.approx(55)
+    assert not deadline.partial
@@ -0,0 +1,96 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import storage
+from storage import NEWS_DB, DBWriter, check_query_plans, plan_full_scans
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "writer.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, value TEXT)")
+    conn.commit()
+    conn.close()
+    return path
+
+
+def insert(item_id):
+    def operation(cursor):
+        cursor.execute("INSERT INTO items (id, value) VALUES (?, ?)", (item_id, f"v{item_id}"))
+        return item_id
+    return operation
+
+
+def stored_ids(db_path):
+    conn = sqlite3.connect(db_path)
+    ids = [row[0] for row in conn.execute("SELECT id FROM items ORDER BY id")]
+    conn.close()
+    return ids
+
+
+def test_writer_batches_queued_operations(db_path):
+    async def scenario():
+        writer = DBWriter(db_path)
+        return writer, await asyncio.gather(*(writer.execute(insert(item_id)) for item_id in range(50)))
+
+    writer, results = asyncio.run(scenario())
+    assert results == list(range(50))
+    assert stored_ids(db_path) == list(range(50))
+    assert writer.stats["operations"] == 50
+    # Операции, поставленные в очередь одновременно, записываются несколькими транзакциями, а не пятьюдесятью
+    assert writer.stats["transactions"] <= 2
+
+
+def test_failed_operation_does_not_cancel_batch(db_path):
+    async def scenario():
+        writer = DBWriter(db_path)
+        # Повтор id 1 нарушает первичный ключ
+        return writer, await asyncio.gather(*(writer.execute(insert(item_id)) for item_id in (1, 2, 1, 3)), return_exceptions=True)
+
+    writer, results = asyncio.run(scenario())
+    assert results[:2] == [1, 2] and results[3] == 3
+    assert isinstance(results[2], sqlite3.IntegrityError)
+    assert stored_ids(db_path) == [1, 2, 3]
+    assert writer.stats["errors"] == 1
+
+
+def test_single_failed_operation_is_not_rerun(db_path):
+    calls = []
+
+    def failing(cursor):
+        calls.append(1)
+        raise sqlite3.OperationalError("ошибка записи")
+
+    async def scenario():
+        writer = DBWriter(db_path)
+        with pytest.raises(sqlite3.OperationalError):
+            await writer.execute(failing)
+        return writer
+
+    writer = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert writer.stats == {"operations": 0, "transactions": 0, "errors": 1}
+
+
+def test_plan_full_scans_flags_unindexed_filter(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "plans.db"))
+    conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, bank TEXT, day TEXT)")
+    conn.execute("CREATE INDEX idx_items_bank ON items (bank)")
+    assert plan_full_scans(conn, "SELECT id FROM items WHERE bank = ?") == []
+    assert plan_full_scans(conn, "SELECT id FROM items WHERE day = ?")
+    conn.close()
+
+
+def test_registered_news_queries_use_indexes(tmp_path, monkeypatch):
+    # Схема news.db создаётся в пустом каталоге, запросы регистрируются модулями при импорте
+    monkeypatch.chdir(tmp_path)
+    import utils, dedup_index, embedding_index, news_search, parse_coverage, relevance_classifier, tfidf_model  # noqa: F401
+    from llm_cache import TieredResponseCache
+
+    TieredResponseCache(NEWS_DB, "gemini_cache")
+    utils.init_db()
+    assert "expire_gemini_cache" in storage.QUERIES
+    assert check_query_plans([NEWS_DB]) == []
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+
+from tfidf_model import tfidf_pair_similarities
+from utils import normalize_text_for_aliases
+
+TEXTS = [
+    "ЦБ оштрафовал банк за нарушения при выдаче кредитов",
+    "Банк оштрафован ЦБ за нарушения при выдаче кредитов",
+    "Банк запустил новую программу семейной ипотеки",
+    "Погода на выходные: дожди и похолодание",
+]
+
+
+def test_pair_scores_match_full_cosine_matrix():
+    pairs = [(0, 1), (0, 2), (1, 3), (2, 3)]
+    vectorizer = TfidfVectorizer(preprocessor=normalize_text_for_aliases, ngram_range=(1, 2), sublinear_tf=True)
+    expected = cosine_similarity(vectorizer.fit_transform(TEXTS))
+    scores = tfidf_pair_similarities(TEXTS, pairs)
+    assert scores == pytest.approx([expected[i, j] for i, j in pairs])
+    assert scores[0] > scores[1] > 0
+    assert scores[3] == 0
+
+
+def test_degenerate_inputs():
+    assert len(tfidf_pair_similarities(TEXTS, [])) == 0
+    # Пустой словарь: пары не решаются без LLM
+    assert np.isnan(tfidf_pair_similarities(["", "!!!"], [(0, 1)])).all()
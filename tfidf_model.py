@@ -0,0 +1,164 @@
+# tfidf_model.py (корпусная TF-IDF модель для ключевых слов и сходства текстов, обучается периодически в фоне)
+
+import argparse
+import asyncio
+import logging
+import os
+import pickle
+import sqlite3
+import time
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from storage import register_query, sql_for
+from utils import normalize_text_for_aliases
+
+# Путь к обученной модели
+MODEL_PATH = "models/tfidf_corpus.pkl"
+
+# Модель старше этого срока переобучается в фоне (часы)
+REFRESH_HOURS = 24
+
+# Интервал проверки свежести модели фоновой задачей (секунды)
+REFRESH_CHECK_SECONDS = 3600
+
+# Минимальный и максимальный (последние записи) размер корпуса
+MIN_DOCUMENTS = 200
+MAX_DOCUMENTS = 20000
+
+_model = None
+_model_loaded = False
+
+# Корпус читается целиком (последние записи), полный просмотр ожидаем
+CORPUS_TEXTS_QUERY = register_query(
+    "tfidf_corpus_texts",
+    "SELECT text FROM parsed_news WHERE text IS NOT NULL AND text != '' ORDER BY id DESC LIMIT ?",
+    full_scan=True
+)
+CORPUS_SUMMARIES_QUERY = register_query(
+    "tfidf_corpus_summaries",
+    "SELECT summary FROM analyzed_news WHERE summary IS NOT NULL AND summary != '' ORDER BY id DESC LIMIT ?",
+    full_scan=True
+)
+
+
+def load_corpus(db_path='news.db', limit=MAX_DOCUMENTS):
+    """Корпус: последние сырые тексты parsed_news и выжимки analyzed_news"""
+    documents = []
+    try:
+        conn = sqlite3.connect(db_path, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute(sql_for(CORPUS_TEXTS_QUERY), (limit,))
+        documents.extend(row[0] for row in cursor.fetchall())
+        cursor.execute(sql_for(CORPUS_SUMMARIES_QUERY), (limit,))
+        documents.extend(row[0] for row in cursor.fetchall())
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка загрузки корпуса для TF-IDF модели: {e}")
+    finally:
+        if 'conn' in locals() and conn:
+            conn.close()
+    return documents
+
+
+def build_vectorizer():
+    return TfidfVectorizer(
+        preprocessor=normalize_text_for_aliases,
+        ngram_range=(1, 3),
+        sublinear_tf=True,
+        min_df=2,
+        max_df=0.5,
+        max_features=100000
+    )
+
+
+def tfidf_pair_similarities(texts, pairs):
+    """Косинусное сходство TF-IDF для пар индексов: один fit по всему пакету и одно умножение разреженных матриц"""
+    if not pairs:
+        return np.zeros(0)
+    vectorizer = TfidfVectorizer(preprocessor=normalize_text_for_aliases, ngram_range=(1, 2), sublinear_tf=True)
+    try:
+        matrix = vectorizer.fit_transform(texts)
+    except ValueError as e:
+        # Пустой словарь (например, только цифры): NaN не проходит ни один порог, пары уходят в LLM
+        logging.warning(f"Пакетный TF-IDF недоступен: {e}")
+        return np.full(len(pairs), np.nan)
+    # Строки нормированы (l2), поэтому произведение — матрица косинусных сходств
+    similarity = (matrix @ matrix.T).tocsr()
+    rows = np.fromiter((i for i, _ in pairs), dtype=np.int64, count=len(pairs))
+    cols = np.fromiter((j for _, j in pairs), dtype=np.int64, count=len(pairs))
+    return np.asarray(similarity[rows, cols]).ravel()
+
+
+def train_model(db_path='news.db', model_path=MODEL_PATH):
+    """Обучение модели на корпусе и сохранение на диск; текущая модель заменяется целиком"""
+    global _model, _model_loaded
+    documents = load_corpus(db_path)
+    if len(documents) < MIN_DOCUMENTS:
+        logging.warning(f"Недостаточно документов для TF-IDF модели: {len(documents)} (нужно минимум {MIN_DOCUMENTS})")
+        return None
+    vectorizer = build_vectorizer()
+    vectorizer.fit(documents)
+    os.makedirs(os.path.dirname(model_path) or ".", exist_ok=True)
+    tmp_path = model_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(vectorizer, f)
+    os.replace(tmp_path, model_path)
+    # Обученная модель только читается (transform), поэтому замена ссылки безопасна для параллельных вызовов
+    _model = vectorizer
+    _model_loaded = True
+    logging.info(
+        f"TF-IDF модель обучена на {len(documents)} документах "
+        f"({len(vectorizer.vocabulary_)} признаков) и сохранена в {model_path}"
+    )
+    return vectorizer
+
+
+def load_model(model_path=MODEL_PATH):
+    """Однократная загрузка модели; при отсутствии файла используется подгонка на месте"""
+    global _model, _model_loaded
+    if _model_loaded:
+        return _model
+    _model_loaded = True
+    if not os.path.exists(model_path):
+        logging.info("TF-IDF модель не найдена, ключевые слова и сходство считаются без корпуса")
+        return None
+    try:
+        with open(model_path, "rb") as f:
+            _model = pickle.load(f)
+        logging.info(f"TF-IDF модель загружена из {model_path}")
+    except Exception as e:
+        logging.error(f"Ошибка загрузки TF-IDF модели: {e}")
+        _model = None
+    return _model
+
+
+def model_age_hours(model_path=MODEL_PATH):
+    if not os.path.exists(model_path):
+        return None
+    return (time.time() - os.path.getmtime(model_path)) / 3600
+
+
+async def refresh_model_periodically(db_path='news.db', model_path=MODEL_PATH):
+    """Фоновое переобучение устаревшей модели в отдельном потоке"""
+    while True:
+        age = model_age_hours(model_path)
+        if age is None or age >= REFRESH_HOURS:
+            try:
+                await asyncio.to_thread(train_model, db_path, model_path)
+            except Exception as e:
+                logging.error(f"Ошибка фонового обучения TF-IDF модели: {e}")
+        await asyncio.sleep(REFRESH_CHECK_SECONDS)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Корпусная TF-IDF модель новостей")
+    parser.add_argument("command", choices=["train"])
+    parser.add_argument("--db", default="news.db")
+    args = parser.parse_args()
+    train_model(args.db)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,15 +6,33 @@ from datetime import datetime, timedelta
 import sqlite3
 import re
 import asyncio
+import json
+import time
 
-# --- Глобальная асинхронная блокировка для базы данных ---
-DB_WRITE_LOCK = asyncio.Lock()
-# ------------------------------------------------------
+from storage import MONITORING_DB, NEWS_DB, create_indexes, enable_wal, fetchall, register_query, sql_for, write
+from parse_coverage import create_coverage_table
+from news_search import create_fts_tables
+
+# Составные индексы под фактические запросы: (имя, таблица, столбцы).
+# Равенство — первым, диапазон дат — следом, остальные фильтры — в хвосте индекса
+NEWS_INDEXES = [
+    ("idx_parsed_bank_date_topic", "parsed_news", ("bank", "date", "topic")),
+    ("idx_analyzed_bank_date_topic", "analyzed_news", ("bank", "date", "topic")),
+    ("idx_analyzed_bank_hash", "analyzed_news", ("bank", "summary_hash")),
+]
+
+
+# Однократное заполнение news_entities по всем проанализированным новостям (полный просмотр ожидаем)
+ENTITY_BACKFILL_QUERY = register_query(
+    "entity_backfill", "SELECT bank, summary_hash, entities, event_date FROM analyzed_news WHERE summary_hash IS NOT NULL",
+    full_scan=True
+)
 
 
 def init_db():
     """Инициализация базы данных SQLite"""
     try:
+        enable_wal(NEWS_DB)
         conn = sqlite3.connect('news.db')
         cursor = conn.cursor()
 
@@ -64,6 +82,7 @@ def init_db():
                 sentiment TEXT,
                 informativeness INTEGER,
                 summary_hash TEXT,
+                topic TEXT DEFAULT '',
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
@@ -76,6 +95,66 @@ def init_db():
                 ALTER TABLE analyzed_news ADD COLUMN summary_hash TEXT
             ''')
             logging.info("Добавлен столбец summary_hash в таблицу analyzed_news")
+        # Тема запроса, под которую новость анализировалась (по ней фильтрует чтение кэша analyzed)
+        if 'topic' not in columns:
+            cursor.execute("ALTER TABLE analyzed_news ADD COLUMN topic TEXT DEFAULT ''")
+            logging.info("Добавлен столбец topic в таблицу analyzed_news")
+
+        # Новости, отклонённые LLM (обучающая выборка для локального классификатора)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rejected_news (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bank TEXT,
+                text TEXT,
+                reason TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Результаты анализа по содержимому новости (общие для всех запросов, тем и мониторинга)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analysis_results (
+                text_hash TEXT,
+                bank TEXT,
+                is_relevant INTEGER,
+                result TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (text_hash, bank)
+            )
+        ''')
+
+        # MinHash-сигнатуры сырых текстов и выжимок по банкам (скользящее окно для поиска почти-дубликатов)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS minhash_signatures (
+                bank TEXT,
+                kind TEXT,
+                item_key TEXT,
+                signature BLOB,
+                item_date TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (bank, kind, item_key)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_minhash_bank_kind_date ON minhash_signatures (bank, kind, item_date)")
+        # Числа и даты текста (numbers_key): перепечаткой считается только текст с теми же числами
+        cursor.execute("PRAGMA table_info(minhash_signatures)")
+        if 'numbers' not in [col[1] for col in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE minhash_signatures ADD COLUMN numbers TEXT")
+            logging.info("Добавлен столбец numbers в таблицу minhash_signatures")
+
+        # Кэш эмбеддингов выжимок (вектор float32) по банку, хэшу выжимки и бэкенду кодировщика
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS news_embeddings (
+                bank TEXT,
+                summary_hash TEXT,
+                backend TEXT,
+                vector BLOB,
+                item_date TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (bank, summary_hash, backend)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_bank_backend_date ON news_embeddings (bank, backend, item_date)")
 
         # Таблица кэша для запросов к Gemini API
         cursor.execute('''
@@ -132,6 +211,9 @@ def init_db():
             cursor.execute('ALTER TABLE parse_history ADD COLUMN last_to TEXT')
         logging.info("Добавлены столбцы last_from и last_to в parse_history")
 
+        # Покрытие парсинга интервалами дат по банку, теме и группе источников
+        create_coverage_table(cursor)
+
         # Индексы
         cursor.execute("PRAGMA table_info(analyzed_news)")
         columns = [col[1] for col in cursor.fetchall()]
@@ -142,9 +224,31 @@ def init_db():
             """)
             logging.info("Создан индекс idx_event_date_hash")
 
+        # Индексы по времени для удаления устаревших записей кэшей
+        for cache_table in ("gemini_cache", "duplicate_cache", "hard_duplicate_cache", "soft_duplicate_cache"):
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{cache_table}_timestamp ON {cache_table} (timestamp)")
+
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_parsed_date ON parsed_news (date)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_analyzed_date ON analyzed_news (date)")
 
+        # Нормализованные сущности проанализированных новостей; заполняется при сохранении
+        create_entity_table(cursor)
+        cursor.execute("SELECT 1 FROM news_entities LIMIT 1")
+        if cursor.fetchone() is None:
+            cursor.execute(sql_for(ENTITY_BACKFILL_QUERY))
+            rows = [
+                row for bank, summary_hash, entities, event_date in cursor.fetchall()
+                for row in entity_rows(bank, summary_hash, parse_entities(entities), event_date)
+            ]
+            if rows:
+                save_entity_rows(cursor, rows)
+                logging.info(f"Заполнена таблица news_entities: {len(rows)} записей")
+
+        create_indexes(cursor, NEWS_INDEXES)
+
+        # Полнотекстовый индекс по сырым текстам и выжимкам (поиск по теме без повторного парсинга)
+        create_fts_tables(cursor)
+
         conn.commit()
         logging.info("База данных news.db инициализирована.")
     except sqlite3.Error as e:
@@ -155,68 +259,95 @@ def init_db():
 
 
 async def save_to_db_async(data, table_name):
-    """Асинхронное сохранение данных в базу с блокировкой для предотвращения конфликтов."""
+    """Асинхронное сохранение данных в базу через писателя news.db (пакетные executemany)."""
     if not data:
         return
 
-    async with DB_WRITE_LOCK:
-        try:
-            conn = sqlite3.connect('news.db', timeout=30)
-            cursor = conn.cursor()
-
-            if table_name == "parsed_news":
-                for item in data:
-                    cursor.execute('''
-                        INSERT OR IGNORE INTO parsed_news (
-                            bank, reg_number, text, date, link, source, topic, is_monitoring, last_fetch_time
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-                    ''', (
-                        item.get("bank", ""),
-                        item.get("reg_number", ""),
-                        item.get("text", ""),
-                        item.get("date", ""),
-                        item.get("link", ""),
-                        item.get("source", ""),
-                        item.get("topic", ""),
-                        item.get("is_monitoring", False)
-                    ))
-            elif table_name == "analyzed_news":
-                for item in data:
-                    event_date_str = item.get("event_date", "")
-                    if isinstance(event_date_str, datetime):
-                        event_date_str = event_date_str.strftime("%Y-%m-%d")
-                    entities_str = ",".join(item.get("entities", []))
-                    summary_hash = item.get("summary_hash", "")
-                    cursor.execute('''
-                        INSERT OR REPLACE INTO analyzed_news (
-                            bank, reg_number, text, summary, event_type, event_date,
-                            entities, date, link, source, category, sentiment, informativeness, summary_hash
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        item.get("bank", ""),
-                        item.get("reg_number", ""),
-                        item.get("text", ""),
-                        item.get("summary", ""),
-                        item.get("event_type", ""),
-                        event_date_str,
-                        entities_str,
-                        item.get("date", ""),
-                        item.get("link", ""),
-                        item.get("source", ""),
-                        item.get("category", ""),
-                        item.get("sentiment", ""),
-                        item.get("informativeness", 0),
-                        summary_hash
-                    ))
-
-            conn.commit()
-            logging.info(f"Данные сохранены в таблицу {table_name}, {len(data)} записей")
-        except sqlite3.Error as e:
-            logging.error(f"Ошибка сохранения данных в таблицу {table_name}: {e}")
-        finally:
-            if 'conn' in locals() and conn:
-                conn.close()
-    await asyncio.sleep(0.01)
+    def operation(cursor):
+        if table_name == "parsed_news":
+            cursor.executemany('''
+                INSERT OR IGNORE INTO parsed_news (
+                    bank, reg_number, text, date, link, source, topic, is_monitoring, last_fetch_time
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', [(
+                item.get("bank", ""),
+                item.get("reg_number", ""),
+                item.get("text", ""),
+                item.get("date", ""),
+                item.get("link", ""),
+                item.get("source", ""),
+                item.get("topic", ""),
+                item.get("is_monitoring", False)
+            ) for item in data])
+        elif table_name == "analyzed_news":
+            rows = []
+            entity_rows_all = []
+            for item in data:
+                event_date_str = item.get("event_date", "")
+                if isinstance(event_date_str, datetime):
+                    event_date_str = event_date_str.strftime("%Y-%m-%d")
+                summary_hash = item.get("summary_hash", "")
+                rows.append((
+                    item.get("bank", ""),
+                    item.get("reg_number", ""),
+                    item.get("text", ""),
+                    item.get("summary", ""),
+                    item.get("event_type", ""),
+                    event_date_str,
+                    json.dumps(item.get("entities", []), ensure_ascii=False),
+                    item.get("date", ""),
+                    item.get("link", ""),
+                    item.get("source", ""),
+                    item.get("category", ""),
+                    item.get("sentiment", ""),
+                    item.get("informativeness", 0),
+                    summary_hash,
+                    item.get("topic", "")
+                ))
+                entity_rows_all.extend(entity_rows(item.get("bank", ""), summary_hash, item.get("entities", []), event_date_str))
+            cursor.executemany('''
+                INSERT OR REPLACE INTO analyzed_news (
+                    bank, reg_number, text, summary, event_type, event_date,
+                    entities, date, link, source, category, sentiment, informativeness, summary_hash, topic
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            save_entity_rows(cursor, entity_rows_all)
+        elif table_name == "analysis_results":
+            cursor.executemany('''
+                INSERT OR REPLACE INTO analysis_results (text_hash, bank, is_relevant, result)
+                VALUES (?, ?, ?, ?)
+            ''', [(
+                item.get("text_hash", ""),
+                item.get("bank", ""),
+                int(item.get("result") is not None),
+                json.dumps(item["result"], ensure_ascii=False) if item.get("result") is not None else None
+            ) for item in data])
+        elif table_name == "minhash_signatures":
+            cursor.executemany('''
+                INSERT OR IGNORE INTO minhash_signatures (bank, kind, item_key, signature, item_date, numbers)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [
+                (item["bank"], item["kind"], item["item_key"], item["signature"], item.get("item_date", ""), item.get("numbers"))
+                for item in data
+            ])
+        elif table_name == "news_embeddings":
+            cursor.executemany('''
+                INSERT OR IGNORE INTO news_embeddings (bank, summary_hash, backend, vector, item_date)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [
+                (item["bank"], item["summary_hash"], item["backend"], item["vector"], item.get("item_date", ""))
+                for item in data
+            ])
+        elif table_name == "rejected_news":
+            cursor.executemany('''
+                INSERT INTO rejected_news (bank, text, reason) VALUES (?, ?, ?)
+            ''', [(item.get("bank", ""), item.get("text", ""), item.get("reason", "")) for item in data])
+
+    try:
+        await write(NEWS_DB, operation)
+        logging.info(f"Данные сохранены в таблицу {table_name}, {len(data)} записей")
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка сохранения данных в таблицу {table_name}: {e}")
 
 
 def save_to_db(data, table_name):
@@ -280,3 +411,209 @@ def normalize_text_for_aliases(text):
     text = re.sub(r'[^\w\s]', ' ', text.lower())
     text = re.sub(r'\s+', ' ', text.strip())
     return text
+
+
+# --- СУЩНОСТИ НОВОСТЕЙ ---
+def normalize_entity(entity):
+    return normalize_text_for_aliases(str(entity)) if entity else ""
+
+
+def parse_entities(value):
+    """Список сущностей из столбца entities: JSON-массив или старый формат через запятую"""
+    if not value:
+        return []
+    if isinstance(value, list):
+        return value
+    try:
+        entities = json.loads(value)
+        if isinstance(entities, list):
+            return entities
+    except (ValueError, TypeError):
+        pass
+    return [entity.strip() for entity in value.split(",") if entity.strip()]
+
+
+def create_entity_table(cursor):
+    """Таблица сущность -> новость (по банку и хэшу выжимки) с индексом по сущности"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS news_entities (
+            bank TEXT,
+            summary_hash TEXT,
+            entity TEXT,
+            raw_entity TEXT,
+            event_date TEXT,
+            PRIMARY KEY (bank, summary_hash, entity)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_news_entities_entity ON news_entities (entity, bank, event_date)")
+
+
+def entity_rows(bank, summary_hash, entities, event_date):
+    if isinstance(event_date, datetime):
+        event_date = event_date.strftime("%Y-%m-%d")
+    rows = {}
+    for entity in entities or []:
+        normalized = normalize_entity(entity)
+        if normalized and normalized not in rows:
+            rows[normalized] = (bank, summary_hash, normalized, str(entity).strip(), event_date or "")
+    return list(rows.values())
+
+
+def save_entity_rows(cursor, rows):
+    cursor.executemany('''
+        INSERT OR IGNORE INTO news_entities (bank, summary_hash, entity, raw_entity, event_date)
+        VALUES (?, ?, ?, ?, ?)
+    ''', rows)
+
+
+# Поиск новостей по сущности: (БД, таблица новостей, столбец банка, с фильтром по банку) -> имя запроса
+ENTITY_NEWS_QUERIES = {
+    (db_path, with_bank): register_query(
+        f"news_by_entity_{news_table}{'_bank' if with_bank else ''}",
+        f'''
+            SELECT n.{bank_column}, n.summary, n.event_type, n.event_date, n.entities, n.date, n.link,
+                   n.source, n.category, n.sentiment, n.informativeness
+            FROM news_entities e
+            JOIN {news_table} n ON n.{bank_column} = e.bank AND n.summary_hash = e.summary_hash
+            WHERE e.entity = ?{' AND e.bank = ?' if with_bank else ''} AND e.event_date >= ? AND e.event_date <= ?
+            GROUP BY e.bank, e.summary_hash
+            ORDER BY e.event_date DESC
+            LIMIT ?
+        ''',
+        db_path
+    )
+    for db_path, news_table, bank_column in ((NEWS_DB, "analyzed_news", "bank"), (MONITORING_DB, "analyzed_monitored_news", "bank_name"))
+    for with_bank in (False, True)
+}
+
+
+async def find_news_by_entity(entity, bank=None, date_from=None, date_to=None, limit=100, db_path=NEWS_DB):
+    """Новости, упоминающие сущность (поиск по индексу news_entities), новые первыми"""
+    normalized = normalize_entity(entity)
+    if not normalized:
+        return []
+    params = [normalized] + ([bank] if bank else []) + [date_from or "", date_to or "9999-12-31", limit]
+    try:
+        rows = await fetchall(db_path, ENTITY_NEWS_QUERIES[(db_path, bool(bank))], params)
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка поиска новостей по сущности {entity}: {e}")
+        return []
+    return [{
+        "bank": row[0], "summary": row[1], "event_type": row[2], "event_date": row[3],
+        "entities": parse_entities(row[4]), "date": row[5], "link": row[6], "source": row[7],
+        "category": row[8], "sentiment": row[9], "informativeness": row[10]
+    } for row in rows]
+
+
+# --- ДЕДЛАЙН ИНТЕРАКТИВНОГО ЗАПРОСА ---
+
+# Бюджет времени на сбор и анализ новостей по запросу пользователя (секунды)
+INTERACTIVE_DEADLINE_SECONDS = 90
+
+# Часть бюджета, которую сбор источников оставляет анализу (секунды)
+ANALYSIS_RESERVE_SECONDS = 30
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+BACKGROUND_TASKS = set()
+
+
+class RequestDeadline:
+    """
+    Бюджет времени запроса, который передаётся через сбор и анализ новостей.
+    После истечения вызывающий код возвращает уже готовое и помечает результат
+    частичным, а незавершённая работа продолжается в фоне и наполняет кэши.
+    """
+
+    def __init__(self, seconds=INTERACTIVE_DEADLINE_SECONDS):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.partial = False
+        self.reasons = []
+        self.deferred = []  # фоновые продолжения работы, не уложившейся в бюджет
+        self._parent = None
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def reserve(self, seconds):
+        """
+        Дедлайн этапа, истекающий на seconds раньше общего: бюджет остаётся следующим этапам.
+        Частичность, причины и фоновые продолжения этапа — общие с исходным дедлайном.
+        """
+        return self._phase(self.expires_at - seconds, max(0.0, self.seconds - seconds))
+
+    def share(self, parts):
+        """
+        Дедлайн этапа с равной долей оставшегося бюджета на parts этапов (например, банков запроса):
+        первый этап не выбирает весь бюджет, а недоиспользованное время переходит к следующим.
+        """
+        seconds = self.remaining() / max(1, parts)
+        return self._phase(time.monotonic() + seconds, seconds)
+
+    def _phase(self, expires_at, seconds):
+        phase = RequestDeadline(0)
+        phase.expires_at = min(expires_at, self.expires_at)
+        phase.seconds = seconds
+        phase.reasons = self.reasons
+        phase.deferred = self.deferred
+        phase._parent = self
+        return phase
+
+    def mark_partial(self, reason):
+        self.partial = True
+        if reason not in self.reasons:
+            self.reasons.append(reason)
+        if self._parent is not None:
+            self._parent.mark_partial(reason)
+
+    def defer(self, aw, name=None):
+        task = run_in_background(aw, name)
+        self.deferred.append(task)
+        return task
+
+
+def run_in_background(aw, name=None):
+    """Запуск задачи в фоне с удержанием ссылки и логированием ошибок"""
+    task = asyncio.ensure_future(aw)
+    BACKGROUND_TASKS.add(task)
+
+    def _done(t):
+        BACKGROUND_TASKS.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            logging.error(f"Ошибка фоновой задачи {name or t}: {t.exception()}")
+
+    task.add_done_callback(_done)
+    return task
+
+
+async def wait_with_deadline(aws, deadline=None, label="задачи"):
+    """
+    Ожидание задач не дольше оставшегося бюджета дедлайна.
+    Возвращает (результаты завершённых задач в исходном порядке, незавершённые задачи).
+    Исключения возвращаются как результаты, как в gather(return_exceptions=True).
+    Незавершённые задачи не отменяются — ими распоряжается вызывающий код.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    if not tasks:
+        return [], []
+    if deadline is None:
+        return await asyncio.gather(*tasks, return_exceptions=True), []
+    done, pending = await asyncio.wait(tasks, timeout=deadline.remaining())
+    results = []
+    for task in tasks:
+        if task not in done:
+            continue
+        if task.cancelled():
+            results.append(asyncio.CancelledError())
+        elif task.exception() is not None:
+            results.append(task.exception())
+        else:
+            results.append(task.result())
+    if pending:
+        deadline.mark_partial(label)
+        logging.warning(f"Дедлайн запроса истёк: {label} — готово {len(done)} из {len(tasks)}, остальное продолжится в фоне")
+    return results, list(pending)